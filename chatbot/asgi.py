@@ -0,0 +1,253 @@
+"""ASGI entry point for the chatbot API with an asyncio chat path.
+
+    uvicorn chatbot.asgi:application --port 5000
+
+/chat, /chat_stream and /get_history are served by coroutines: the Gemini
+call goes through an async HTTP client and the session store and history
+reads and writes (SQLite) run in threads, so one worker process can hold
+hundreds of chats in flight instead of one per thread.  Every other route
+(uploads, new/delete chat) is handed to the Flask app in chatbot.chat,
+which shares the same session store.
+"""
+import asyncio
+import functools
+import json
+import os
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags
+
+from chatbot import chat, metrics
+from chatbot.history import history_etag, history_query
+from chatbot.upstream import AsyncGeminiClient, CircuitOpenError
+
+gemini = AsyncGeminiClient(
+    chat.GEMINI_BASE_URL, chat.API_KEY, chat.GEMINI_MODEL,
+    pool_size=int(os.getenv("GEMINI_ASYNC_POOL_SIZE", "256")),
+    # Share the breaker so both paths agree on upstream health
+    breaker=chat.gemini.breaker,
+    **chat.GEMINI_OPTIONS,
+)
+
+flask_app = WsgiToAsgi(chat.app)
+
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+async def read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        return json.loads(body or b"{}")
+    except ValueError:
+        return {}
+
+
+async def send_json(send, data, status=200):
+    body = json.dumps(data).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())] + CORS_HEADERS,
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def instrumented(route):
+    """Request timing for a coroutine view, under the Flask route's name.
+
+    metrics.begin_request() labels a thread, not a coroutine, so the
+    views pass route to their spans themselves.
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        async def wrapper(scope, receive, send):
+            started = time.perf_counter()
+            status = 500
+
+            async def send_and_record(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                await send(message)
+
+            try:
+                await view(scope, receive, send_and_record)
+            finally:
+                metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, status=status)
+        return wrapper
+    return decorate
+
+
+def start_turn(data):
+    """Validate a chat request and record the user's message.
+
+    Returns (session_id, user_message, cache key, cached answer or None),
+    or None for an unknown session.
+    """
+    session_id = data.get("session_id")
+    user_message = data.get("message")
+    if not chat.session_store.append_message(session_id, "user", user_message):
+        return None
+    chat.save_to_db(session_id, "user", user_message)
+    chat.touch_document(session_id)
+    key = chat.answer_cache_key(session_id, user_message)
+    cached = None if data.get("no_cache") else chat.ready_answer(session_id, user_message, key)
+    return session_id, user_message, key, cached
+
+
+@instrumented("chat")
+async def chat_view(scope, receive, send):
+    turn = await asyncio.to_thread(start_turn, await read_json(receive))
+    if turn is None:
+        await send_json(send, {"success": False, "error": "Invalid session ID"}, 400)
+        return
+    session_id, user_message, key, model_text = turn
+
+    if model_text is None:
+        try:
+            # A map-reduce prompt makes upstream calls of its own
+            with metrics.span("build_prompt", route="chat"):
+                prompt = await asyncio.to_thread(chat.build_prompt, session_id, user_message)
+            with metrics.span("gemini", route="chat"):
+                model_text = await chat.inflight.ado(chat.answer_cache_key(session_id, prompt),
+                                                     lambda: gemini.generate(prompt))
+        except CircuitOpenError:
+            metrics.UPSTREAM_ERRORS.inc(kind="circuit_open")
+            await send_json(send, {"success": False, "error": "Gemini API is temporarily unavailable."}, 503)
+            return
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(kind="error")
+            print("Error connecting to Gemini API:", str(e))
+            await send_json(send, {"success": False, "error": "Error connecting to Gemini API."})
+            return
+        # The cache's disk tier is SQLite too
+        await asyncio.to_thread(chat.response_cache.set, key, model_text)
+
+    await asyncio.to_thread(chat.record_reply, session_id, model_text)
+    await send_json(send, {"success": True, "response": model_text})
+
+
+async def replay(text):
+    yield text
+
+
+@instrumented("chat_stream")
+async def chat_stream_view(scope, receive, send):
+    turn = await asyncio.to_thread(start_turn, await read_json(receive))
+    if turn is None:
+        await send_json(send, {"success": False, "error": "Invalid session ID"}, 400)
+        return
+    session_id, user_message, key, cached = turn
+
+    if cached is not None:
+        pieces = replay(cached)
+    else:
+        try:
+            with metrics.span("build_prompt", route="chat_stream"):
+                prompt = await asyncio.to_thread(chat.build_prompt, session_id, user_message)
+            with metrics.span("gemini", route="chat_stream"):
+                pieces = await gemini.stream(prompt)
+        except CircuitOpenError:
+            metrics.UPSTREAM_ERRORS.inc(kind="circuit_open")
+            await send_json(send, {"success": False, "error": "Gemini API is temporarily unavailable."}, 503)
+            return
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(kind="error")
+            print("Error connecting to Gemini API:", str(e))
+            await send_json(send, {"success": False, "error": "Error connecting to Gemini API."})
+            return
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no")] + CORS_HEADERS,
+    })
+
+    async def event(data, name=None):
+        await send({"type": "http.response.body",
+                    "body": chat.sse_event(data, name).encode(), "more_body": True})
+
+    parts = []
+    try:
+        async for text in pieces:
+            parts.append(text)
+            await event({"text": text})
+    except Exception as e:
+        metrics.UPSTREAM_ERRORS.inc(kind="stream")
+        print("Error streaming from Gemini API:", str(e))
+        await event({"error": "Error connecting to Gemini API."}, "error")
+    else:
+        model_text = "".join(parts)
+        if cached is None:
+            await asyncio.to_thread(chat.response_cache.set, key, model_text)
+        await asyncio.to_thread(chat.record_reply, session_id, model_text)
+        await event({"done": True}, "done")
+    await send({"type": "http.response.body", "body": b""})
+
+
+@instrumented("get_history")
+async def get_history_view(scope, receive, send):
+    session_id = scope["path"][len("/get_history/"):]
+    args = {name: values[-1] for name, values in parse_qs(scope.get("query_string", b"").decode()).items()}
+    try:
+        query = history_query(args, chat.HISTORY_PAGE_MAX)
+    except ValueError:
+        await send_json(send, {"success": False, "error": "since, before and limit must be integers"}, 400)
+        return
+
+    version = await asyncio.to_thread(chat.history_store.version, session_id)
+    etag = history_etag(version, *query)
+    headers = [(b"etag", f'"{etag}"'.encode()), (b"cache-control", b"no-cache")] + CORS_HEADERS
+    if_none_match = dict(scope["headers"]).get(b"if-none-match")
+    if if_none_match and parse_etags(if_none_match.decode()).contains(etag):
+        await send({"type": "http.response.start", "status": 304, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"application/json")] + headers})
+    # Each chunk is one batch of rows read in a thread
+    chunks = await asyncio.to_thread(chat.history_store.json_chunks, session_id, *query)
+    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+        await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await gemini.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def route(scope):
+    method, path = scope["method"], scope["path"]
+    if method == "POST" and path == "/chat":
+        return chat_view
+    if method == "POST" and path == "/chat_stream":
+        return chat_stream_view
+    if method == "GET" and path.startswith("/get_history/"):
+        return get_history_view
+    # Everything else, including CORS preflights, is handled by Flask
+    return flask_app
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
+        return
+    await route(scope)(scope, receive, send)
@@ -0,0 +1,750 @@
+"""Benchmarks for the chatbot service, run against a local fake Gemini server.
+
+    python -m chatbot.bench retrieval
+    python -m chatbot.bench async --latency 0.5
+    python -m chatbot.bench extraction
+    python -m chatbot.bench normalize
+    python -m chatbot.bench map_reduce --window 100000
+    python -m chatbot.bench overview
+    python -m chatbot.bench local_answers
+    python -m chatbot.bench load --users 20 --turns 5 --json load.json
+
+Each benchmark runs the Flask app in a temporary working directory so the
+uploads folder and databases of the checkout are never touched.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import platform
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chatbot.fake_gemini import FakeGemini
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_PDFS = sorted(glob.glob(os.path.join(ROOT, "uploads", "*.pdf")))
+SAMPLE_DOCUMENTS = SAMPLE_PDFS + sorted(glob.glob(os.path.join(ROOT, "media", "uploads", "*.docx")))
+
+QUESTIONS = [
+    "What is the credit count for the course?",
+    "Which email address and phone number are listed?",
+    "Summarise the evaluation pattern and grading.",
+    "What are the prerequisites for the signals and systems course?",
+    "List the skills and projects mentioned.",
+]
+
+# Questions about the bundled PDFs, with a pattern a right local answer
+# matches, or None where only the model can answer.  The local answerer's
+# rules were written against LOOKUP_QUESTIONS; HELD_OUT_QUESTIONS were
+# written afterwards and not tuned on, so only they say how it routes
+# questions it has not seen.  Contact details are matched by shape rather
+# than copied out of the resume.
+EMAIL_ANSWER = r"Email: \S+@\S+"
+PHONE_ANSWER = r"Phone: \+?\d{10}"
+LOOKUP_QUESTIONS = {
+    "amrita-btech-electrical-and-computer-engineering-curriculum-syllabus-2023.pdf": [
+        ("What is the credit count for Digital Electronics?", "3 credits"),
+        ("How many credits is Signals and Systems?", "4 credits"),
+        ("How many credits does Machine Learning carry?", "4 credits"),
+        ("What are the credits for Electric Machines?", "3 credits"),
+        ("Credits for Operating Systems?", "3 credits"),
+        ("What is the credit count for 23ELC101?", "2 credits"),
+        ("How many credits is Project Phase I?", "6 credits"),
+        ("What is the course code for Engineering Graphics and 3D Modelling?", "23MEE102"),
+        ("What is the course code of Data Structures and Algorithms?", "23ELC213"),
+        ("What is the credit count for the course?", None),
+        ("How many credits does Technical Communication carry?", None),
+        ("Summarise the evaluation pattern and grading.", None),
+        ("What are the prerequisites for the signals and systems course?", None),
+        ("Explain the course outcomes of Digital Electronics.", None),
+        ("Which textbooks are used for Control Systems?", None),
+        ("Which email address and phone number are listed?", None),
+    ],
+    "resume.pdf": [
+        ("What email is on this resume?", EMAIL_ANSWER),
+        ("What is the phone number?", PHONE_ANSWER),
+        ("Which email address and phone number are listed?", EMAIL_ANSWER),
+        ("What is his date of birth?", r"\d{2}\.\d{2}\.\d{4}"),
+        ("What is the mobile number?", PHONE_ANSWER),
+        ("List the skills and projects mentioned.", None),
+        ("Summarise his professional experience.", None),
+        ("What is the LinkedIn profile?", None),
+        ("Which programming languages does he know?", None),
+        ("Why is he a good fit for an embedded role?", None),
+    ],
+}
+HELD_OUT_QUESTIONS = {
+    "amrita-btech-electrical-and-computer-engineering-curriculum-syllabus-2023.pdf": [
+        ("Credits of Control Systems?", "4 credits"),
+        ("How many credits is Power Electronics and Drives?", "3 credits"),
+        ("What is the course code of Computer Networks and IoT?", "23ELC312"),
+        ("How many credits does Microcontrollers and Applications carry?", "4 credits"),
+        ("Give me the course code for Computer Programming", "23ELC114"),
+        ("Does the syllabus mention email etiquette?", None),
+        ("Is a phone allowed in the exam?", None),
+        ("Are credits transferable between semesters?", None),
+        ("Which course has the most credits?", None),
+        ("What is the code of conduct for students?", None),
+        ("What is the minimum attendance required?", None),
+        ("List the lab courses in semester 5.", None),
+    ],
+    "resume.pdf": [
+        ("Give me his phone number.", PHONE_ANSWER),
+        ("What is his email id?", EMAIL_ANSWER),
+        ("Does the resume mention email marketing experience?", None),
+        ("Has he built a phone app?", None),
+        ("What email client does he use?", None),
+        ("Which phone models has he tested?", None),
+        ("What is his GitHub username?", None),
+        ("Where did he do his MBA?", None),
+        ("What is the CGPA?", r"6\.1"),
+        ("Which university was the MBA from?", r"Madurai"),
+        ("What is the notice period?", None),
+    ],
+}
+
+
+def load_app(fake):
+    """Import chatbot.chat pointed at the fake server, inside a temp dir."""
+    os.environ["GEMINI_BASE_URL"] = fake.url
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    # History goes to a throwaway SQLite database unless DB_* say otherwise
+    os.environ.setdefault("DB_ENGINE", "django.db.backends.sqlite3")
+    os.environ.setdefault("DB_NAME", os.path.join(workdir, "db.sqlite3"))
+    os.chdir(workdir)
+    from chatbot import chat
+    from django.core.management import call_command
+    call_command("migrate", verbosity=0)
+    return chat
+
+
+def upload_document(client, session_id, path):
+    """Upload through the Flask test client and wait for extraction."""
+    with open(path, "rb") as f:
+        resp = client.post("/upload", data={"session_id": session_id, "file": (f, os.path.basename(path))})
+    data = resp.get_json()
+    if data.get("success") and "job_id" not in data:
+        # Served from the document store without extraction
+        return {"state": "done"}
+    while data.get("success") and data.get("state") != "done":
+        if data.get("state") == "failed":
+            return data
+        time.sleep(0.05)
+        data = client.get(f"/upload_status/{data['job_id']}").get_json()
+    return data
+
+
+def bench_retrieval(args):
+    """Prompt size and /chat latency: whole document vs retrieved chunks."""
+    results = []
+    with FakeGemini(latency=args.latency, per_kb_latency=args.per_kb_latency) as fake:
+        chat = load_app(fake)
+        client = chat.app.test_client()
+
+        for path in SAMPLE_PDFS:
+            session_id = os.path.basename(path)
+            client.post("/new_chat", json={"session_id": session_id})
+            start = time.perf_counter()
+            status = upload_document(client, session_id, path)
+            upload_s = time.perf_counter() - start
+            if status.get("state") != "done":
+                print(f"skipping {session_id}: {status}", file=sys.stderr)
+                continue
+
+            for mode, enabled in (("full", False), ("retrieval", True)):
+                chat.RETRIEVAL_ENABLED = enabled
+                fake.reset_stats()
+                latencies = []
+                for question in QUESTIONS:
+                    start = time.perf_counter()
+                    client.post("/chat", json={"session_id": session_id, "message": question, "no_cache": True})
+                    latencies.append(time.perf_counter() - start)
+                results.append({
+                    "document": session_id,
+                    "document_chars": len(chat.session_store.get(session_id).text),
+                    "chunks": len(chat.session_store.get(session_id).index),
+                    "upload_s": round(upload_s, 3),
+                    "mode": mode,
+                    "avg_request_bytes": fake.bytes_received // max(fake.requests, 1),
+                    "mean_latency_ms": round(statistics.mean(latencies) * 1000, 1),
+                    "max_latency_ms": round(max(latencies) * 1000, 1),
+                })
+
+    print(f"{'document':<40} {'mode':<10} {'req bytes':>10} {'mean ms':>9} {'max ms':>9}")
+    for row in results:
+        print(f"{row['document'][:40]:<40} {row['mode']:<10} {row['avg_request_bytes']:>10} "
+              f"{row['mean_latency_ms']:>9} {row['max_latency_ms']:>9}")
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_asgi(app):
+    """Run an ASGI app under uvicorn in a background thread, return its URL."""
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}", server
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def latency_summary(name, concurrency, latencies, wall_s):
+    latencies = sorted(latencies)
+    return {
+        "path": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "wall_s": round(wall_s, 3),
+        "rps": round(len(latencies) / wall_s, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1),
+    }
+
+
+def rss_bytes():
+    """Resident set size of this process (Linux), or 0 where unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def run_metadata(args):
+    """What a result was measured on, so runs can be compared across commits."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k != "json"},
+    }
+
+
+def serve_wsgi(app):
+    """Run a WSGI app on a threaded werkzeug server in the background."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", free_port(), app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.port}", server
+
+
+def bench_async(args):
+    """Concurrent /chat calls: asyncio path vs a fixed pool of sync threads."""
+    import aiohttp
+
+    results = []
+    with FakeGemini(latency=args.latency) as fake:
+        chat = load_app(fake)
+        from chatbot import asgi
+        url, server = serve_asgi(asgi.application)
+
+        async def drive(concurrency):
+            connector = aiohttp.TCPConnector(limit=concurrency)
+            async with aiohttp.ClientSession(url, connector=connector) as client:
+                await client.post("/new_chat", json={"session_id": "load"})
+
+                async def one(i):
+                    start = time.perf_counter()
+                    async with client.post("/chat", json={"session_id": "load", "message": f"question {i}"}) as resp:
+                        resp.raise_for_status()
+                        await resp.read()
+                    return time.perf_counter() - start
+
+                start = time.perf_counter()
+                latencies = await asyncio.gather(*(one(i) for i in range(concurrency)))
+                return latencies, time.perf_counter() - start
+
+        for concurrency in args.concurrency:
+            latencies, wall_s = asyncio.run(drive(concurrency))
+            results.append(latency_summary("asgi", concurrency, latencies, wall_s))
+
+        # Baseline: the Flask app with a fixed number of worker threads
+        client = chat.app.test_client()
+        client.post("/new_chat", json={"session_id": "load"})
+
+        def one(i):
+            start = time.perf_counter()
+            client.post("/chat", json={"session_id": "load", "message": f"question {i}"})
+            return time.perf_counter() - start
+
+        for concurrency in args.concurrency:
+            with ThreadPoolExecutor(args.threads) as pool:
+                start = time.perf_counter()
+                latencies = list(pool.map(one, range(concurrency)))
+                wall_s = time.perf_counter() - start
+            results.append(latency_summary(f"flask x{args.threads} threads", concurrency, latencies, wall_s))
+        server.should_exit = True
+
+    print(f"{'path':<22} {'conc':>5} {'wall s':>8} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for row in results:
+        print(f"{row['path']:<22} {row['concurrency']:>5} {row['wall_s']:>8} {row['rps']:>8} "
+              f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['max_ms']:>8}")
+    return results
+
+
+def bench_extraction(args):
+    """Pages per second per backend: inline in one process vs the worker pool."""
+    from chatbot.extraction import EXTRACTORS, ExtractionJobs
+
+    results = []
+    jobs = ExtractionJobs(workers=args.workers)
+    for backend, extractor in EXTRACTORS.items():
+        for path in SAMPLE_DOCUMENTS:
+            if os.path.splitext(path)[1].lower() not in extractor.extensions:
+                continue
+
+            start = time.perf_counter()
+            texts = list(extractor.iter_pages(path))
+            inline_s = time.perf_counter() - start
+            pages = len(texts)
+            text = "\n".join(texts)
+
+            done = threading.Event()
+            start = time.perf_counter()
+            jobs.submit(path, backend, on_done=lambda text, offsets: done.set(), on_error=lambda error: done.set())
+            done.wait()
+            pool_s = time.perf_counter() - start
+
+            results.append({
+                "backend": backend,
+                "document": os.path.basename(path),
+                "pages": pages,
+                "chars": len(text),
+                "inline_s": round(inline_s, 3),
+                "pool_s": round(pool_s, 3),
+                "inline_pages_per_s": round(pages / inline_s, 1),
+                "pool_pages_per_s": round(pages / pool_s, 1),
+            })
+    jobs.shutdown()
+
+    print(f"{'backend':<8} {'document':<40} {'pages':>5} {'inline s':>9} {'pool s':>8} {'pool pg/s':>10}")
+    for row in results:
+        print(f"{row['backend']:<8} {row['document'][:40]:<40} {row['pages']:>5} {row['inline_s']:>9} "
+              f"{row['pool_s']:>8} {row['pool_pages_per_s']:>10}")
+    return results
+
+
+def bench_normalize(args):
+    """Bytes and tokens normalization removes per document, and what that
+    does to upstream request size and /chat latency with the whole
+    document in the prompt."""
+    from chatbot.extraction import choose_extractor, join_pages
+    from chatbot.normalize import normalize_pages
+
+    results = []
+    with FakeGemini(latency=args.latency, per_kb_latency=args.per_kb_latency) as fake:
+        chat = load_app(fake)
+        client = chat.app.test_client()
+        chat.RETRIEVAL_ENABLED = False
+        chat.CORPUS_ENABLED = False
+        for path in SAMPLE_DOCUMENTS:
+            document = os.path.basename(path)
+            pages = list(choose_extractor(path, default=chat.EXTRACT_BACKEND).iter_pages(path))
+            start = time.perf_counter()
+            cleaned, report = normalize_pages(pages)
+            normalize_s = time.perf_counter() - start
+            row = {"document": document, "pages": len(pages), "normalize_ms": round(normalize_s * 1000, 1),
+                   **report}
+
+            for mode, texts in (("raw", pages), ("normalized", cleaned)):
+                session_id = f"{mode}-{document}"
+                client.post("/new_chat", json={"session_id": session_id})
+                chat.session_store.set_document(session_id, session_id, join_pages(texts)[0])
+                fake.reset_stats()
+                latencies = []
+                for question in QUESTIONS:
+                    start = time.perf_counter()
+                    client.post("/chat", json={"session_id": session_id, "message": question, "no_cache": True})
+                    latencies.append(time.perf_counter() - start)
+                row[f"{mode}_request_bytes"] = fake.bytes_received // max(fake.requests, 1)
+                row[f"{mode}_mean_latency_ms"] = round(statistics.mean(latencies) * 1000, 1)
+            results.append(row)
+
+    print(f"{'document':<40} {'bytes saved':>12} {'tokens saved':>13} {'ms':>7} "
+          f"{'raw req B':>10} {'norm req B':>10} {'raw ms':>7} {'norm ms':>7}")
+    for row in results:
+        print(f"{row['document'][:40]:<40} {row['bytes_saved']:>12} {row['tokens_saved']:>13} "
+              f"{row['normalize_ms']:>7} {row['raw_request_bytes']:>10} {row['normalized_request_bytes']:>10} "
+              f"{row['raw_mean_latency_ms']:>7} {row['normalized_mean_latency_ms']:>7}")
+    return results
+
+
+class ExcerptGemini(FakeGemini):
+    """Answers NONE to map calls whose document part lacks the question's words."""
+
+    def reply_text(self, prompt):
+        from chatbot.mapreduce import NO_EVIDENCE
+        from chatbot.retrieval import tokenize
+
+        if prompt.startswith("Below is part"):
+            shard, _, question = prompt.rpartition("\n\nQuestion: ")
+            words = set(tokenize(shard))
+            if not any(t in words for t in tokenize(question) if len(t) > 3):
+                return NO_EVIDENCE
+        return super().reply_text(prompt)
+
+
+def bench_map_reduce(args):
+    """Whole-document answers over a document larger than the window:
+    shards asked one at a time, concurrently, and concurrently with early
+    cancellation."""
+    from chatbot.extraction import choose_extractor, join_pages
+    from chatbot.normalize import normalize_pages
+
+    results = []
+    with ExcerptGemini(latency=args.latency, per_kb_latency=args.per_kb_latency) as fake:
+        chat = load_app(fake)
+        client = chat.app.test_client()
+        chat.RETRIEVAL_ENABLED = False
+        chat.CORPUS_ENABLED = False
+        chat.CONTEXT_WINDOW_CHARS = args.window
+        chat.map_reduce.shard_chars = args.window // 2
+
+        path = max(SAMPLE_PDFS, key=os.path.getsize)
+        pages, _ = normalize_pages(list(choose_extractor(path, default=chat.EXTRACT_BACKEND).iter_pages(path)))
+        text = join_pages(pages)[0]
+        client.post("/new_chat", json={"session_id": "map-reduce"})
+        chat.session_store.set_document("map-reduce", "map-reduce", text)
+
+        modes = (("sequential", 1, 0), ("concurrent", args.map_concurrency, 0),
+                 ("early_cancel", args.map_concurrency, args.enough))
+        for mode, concurrency, enough in modes:
+            chat.map_reduce.concurrency = concurrency
+            chat.map_reduce.enough = enough
+            fake.reset_stats()
+            latencies = []
+            runs = []
+            for question in QUESTIONS:
+                start = time.perf_counter()
+                client.post("/chat", json={"session_id": "map-reduce", "message": question, "no_cache": True})
+                latencies.append(time.perf_counter() - start)
+                runs.append(chat.map_reduce.last_run)
+            results.append({
+                "mode": mode,
+                "document_chars": len(text),
+                "shards": runs[0]["shards"],
+                "concurrency": concurrency,
+                "enough": enough,
+                "upstream_calls_per_question": round(fake.requests / len(QUESTIONS), 1),
+                "mean_relevant": round(statistics.mean(r["relevant"] for r in runs), 1),
+                "mean_latency_ms": round(statistics.mean(latencies) * 1000, 1),
+                "total_s": round(sum(latencies), 2),
+            })
+        # Let calls left running by early cancellation finish before the
+        # fake server goes away
+        time.sleep(args.latency + args.per_kb_latency * args.window / 1024)
+
+    sequential = results[0]["total_s"]
+    print(f"{'mode':<14} {'shards':>6} {'calls/q':>8} {'relevant':>9} {'mean ms':>9} {'total s':>8} {'speedup':>8}")
+    for row in results:
+        row["speedup"] = round(sequential / row["total_s"], 2)
+        print(f"{row['mode']:<14} {row['shards']:>6} {row['upstream_calls_per_question']:>8} "
+              f"{row['mean_relevant']:>9} {row['mean_latency_ms']:>9} {row['total_s']:>8} {row['speedup']:>8}")
+    return results
+
+
+def bench_overview(args):
+    """Time to the first answer about a freshly uploaded document, asked
+    cold and once its overview is prepared, and how long preparing takes."""
+    from chatbot.cache import ResponseCache
+
+    results = []
+    with FakeGemini(latency=args.latency, per_kb_latency=args.per_kb_latency) as fake:
+        chat = load_app(fake)
+        client = chat.app.test_client()
+        starter = chat.overviews.questions[0]
+
+        for path in SAMPLE_PDFS:
+            name = os.path.basename(path)
+            row = {"document": name}
+            for mode, enabled in (("cold", False), ("prepared", True)):
+                chat.OVERVIEW_ENABLED = enabled
+                chat.response_cache = ResponseCache()
+                session_id = f"{mode}-{name}"
+                client.post("/new_chat", json={"session_id": session_id})
+                start = time.perf_counter()
+                if upload_document(client, session_id, path).get("state") != "done":
+                    break
+                chat.overviews.join()
+                if enabled:
+                    row["prepare_s"] = round(time.perf_counter() - start, 3)
+                for label, question in (("starter", starter), ("other", QUESTIONS[0])):
+                    fake.reset_stats()
+                    start = time.perf_counter()
+                    client.post("/chat", json={"session_id": session_id, "message": question})
+                    row[f"{mode}_{label}_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                    row[f"{mode}_{label}_bytes"] = fake.bytes_received
+            else:
+                results.append(row)
+
+    print(f"{'document':<36} {'prepare s':>9} {'starter cold':>13} {'prepared':>9} {'other cold':>11} "
+          f"{'prepared':>9} {'other bytes':>12}")
+    for row in results:
+        print(f"{row['document'][:36]:<36} {row['prepare_s']:>9} {row['cold_starter_ms']:>13} "
+              f"{row['prepared_starter_ms']:>9} {row['cold_other_ms']:>11} {row['prepared_other_ms']:>9} "
+              f"{row['cold_other_bytes']:>6}/{row['prepared_other_bytes']:<6}")
+    return results
+
+
+def bench_local_answers(args):
+    """Routing of lookup questions: how often the local answerer takes the
+    right route and answers right, at what latency against the upstream
+    round trip, and how the threshold trades coverage for precision.
+
+    Reported separately for the questions the rules were tuned on and for
+    the held-out ones.  The curriculum's course questions are only answered
+    locally with LOCAL_ANSWER_COURSES=1.
+    """
+    from chatbot.cache import ResponseCache
+
+    rows = []
+    with FakeGemini(latency=args.latency, per_kb_latency=args.per_kb_latency) as fake:
+        chat = load_app(fake)
+        chat.OVERVIEW_ENABLED = False
+        client = chat.app.test_client()
+        for path in SAMPLE_PDFS:
+            name = os.path.basename(path)
+            if name not in LOOKUP_QUESTIONS:
+                continue
+            client.post("/new_chat", json={"session_id": name})
+            if upload_document(client, name, path).get("state") != "done":
+                print(f"skipping {name}: extraction failed", file=sys.stderr)
+                continue
+            session = chat.session_store.get(name)
+            for kind, questions in (("tuned", LOOKUP_QUESTIONS), ("held_out", HELD_OUT_QUESTIONS)):
+                for question, expected in questions.get(name, []):
+                    chat.response_cache = ResponseCache()
+                    fake.reset_stats()
+                    start = time.perf_counter()
+                    reply = client.post("/chat", json={"session_id": name,
+                                                       "message": question}).get_json()["response"]
+                    latency = time.perf_counter() - start
+                    _, confidence, _ = chat.local_answerer.answer(question, session.text, session.fingerprint,
+                                                                   session.index)
+                    rows.append({
+                        "set": kind,
+                        "document": name,
+                        "question": question,
+                        "lookup": expected is not None,
+                        "local": fake.requests == 0,
+                        "correct": expected is not None and fake.requests == 0
+                        and re.search(expected, reply) is not None,
+                        "confidence": round(confidence, 2),
+                        "latency_ms": round(latency * 1000, 2),
+                    })
+
+    def summarize(rows):
+        local = [r for r in rows if r["local"]]
+        remote = [r for r in rows if not r["local"]]
+        return {
+            "questions": len(rows),
+            "routing_accuracy": round(sum(r["local"] == r["lookup"] for r in rows) / len(rows), 3),
+            "local_precision": round(sum(r["correct"] for r in local) / max(len(local), 1), 3),
+            "lookup_recall": round(sum(r["correct"] for r in rows) / max(sum(r["lookup"] for r in rows), 1), 3),
+            "negatives_kept_upstream": round(sum(not r["local"] for r in rows if not r["lookup"])
+                                             / max(sum(not r["lookup"] for r in rows), 1), 3),
+            "local_p50_ms": percentile(sorted(r["latency_ms"] for r in local), 50) if local else None,
+            "upstream_p50_ms": percentile(sorted(r["latency_ms"] for r in remote), 50) if remote else None,
+        }
+
+    summary = {kind: summarize([r for r in rows if r["set"] == kind]) for kind in ("tuned", "held_out")}
+    # The held-out questions at other thresholds, from the recorded confidences
+    held_out = [r for r in rows if r["set"] == "held_out"]
+    sweep = []
+    for threshold in (0.5, 0.6, 0.7, 0.8, 0.9):
+        routed = [r for r in held_out if r["confidence"] >= threshold]
+        sweep.append({
+            "threshold": threshold,
+            "routing_accuracy": round(sum((r["confidence"] >= threshold) == r["lookup"] for r in held_out)
+                                      / len(held_out), 3),
+            "local_share": round(len(routed) / len(held_out), 3),
+        })
+
+    for r in rows:
+        route = "local" if r["local"] else "upstream"
+        mark = "ok" if r["local"] == r["lookup"] and (r["correct"] or not r["lookup"]) else "WRONG"
+        print(f"{r['set']:<9} {route:<9} {r['confidence']:>5} {r['latency_ms']:>9} ms  {mark:<5} {r['question']}")
+    print(json.dumps(summary, indent=2))
+    print(f"{'threshold':>9} {'accuracy':>9} {'local':>6}  (held out)")
+    for s in sweep:
+        print(f"{s['threshold']:>9} {s['routing_accuracy']:>9} {s['local_share']:>6}")
+    return {"summary": summary, "threshold_sweep": sweep, "questions": rows}
+
+
+def bench_load(args):
+    """Simulated users over HTTP: each opens a chat, uploads a sample PDF,
+    asks `turns` questions and reads its history back.
+
+    Reports latency percentiles and throughput per endpoint, resident
+    memory per session, and extraction timing for the sample PDFs.
+    """
+    import requests
+
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+
+    with FakeGemini(latency=args.latency, per_kb_latency=args.per_kb_latency,
+                    reply_chars=args.reply_chars) as fake:
+        chat = load_app(fake)
+        url, server = serve_wsgi(chat.app)
+
+        def timed(http, name, method, path, **kwargs):
+            start = time.perf_counter()
+            resp = http.request(method, url + path, timeout=120, **kwargs)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.setdefault(name, []).append(elapsed)
+                if resp.status_code >= 400:
+                    errors[name] = errors.get(name, 0) + 1
+            return resp
+
+        def user(i):
+            session_id = f"load-{i}"
+            with requests.Session() as http:
+                timed(http, "/new_chat", "POST", "/new_chat", json={"session_id": session_id})
+                path = SAMPLE_PDFS[i % len(SAMPLE_PDFS)]
+                with open(path, "rb") as f:
+                    resp = timed(http, "/upload", "POST", "/upload", data={"session_id": session_id},
+                                 files={"file": (os.path.basename(path), f)})
+                job_id = resp.json().get("job_id") if resp.status_code == 202 else None
+                start = time.perf_counter()
+                while job_id:
+                    status = http.get(f"{url}/upload_status/{job_id}", timeout=30).json()
+                    if status.get("state") != "running":
+                        break
+                    time.sleep(0.05)
+                if job_id:
+                    with lock:
+                        latencies.setdefault("upload until ready", []).append(time.perf_counter() - start)
+                for turn in range(args.turns):
+                    question = QUESTIONS[(i + turn) % len(QUESTIONS)]
+                    timed(http, "/chat", "POST", "/chat", json={"session_id": session_id, "message": question})
+                timed(http, "/get_history", "GET", f"/get_history/{session_id}")
+
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.users) as pool:
+            list(pool.map(user, range(args.users)))
+        wall_s = time.perf_counter() - start
+        rss_after = rss_bytes()
+        sessions = chat.session_store.stats()
+        server.shutdown()
+        chat.extraction_jobs.shutdown()
+
+    endpoints = []
+    for name, values in latencies.items():
+        row = latency_summary(name, args.users, values, wall_s)
+        row["errors"] = errors.get(name, 0)
+        endpoints.append(row)
+    results = {
+        "meta": run_metadata(args),
+        "wall_s": round(wall_s, 3),
+        "rps": round(sum(len(v) for v in latencies.values()) / wall_s, 1),
+        "endpoints": endpoints,
+        "memory": {
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": rss_after,
+            "rss_per_session_bytes": (rss_after - rss_before) // max(args.users, 1),
+            "session_cache_bytes": sessions["bytes_in_memory"],
+            "sessions_in_memory": sessions["sessions_in_memory"],
+        },
+        "upstream_requests": fake.requests,
+    }
+
+    print(f"{'endpoint':<20} {'reqs':>5} {'err':>4} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for row in endpoints:
+        print(f"{row['path']:<20} {row['requests']:>5} {row['errors']:>4} {row['rps']:>7} "
+              f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}")
+    print(f"{args.users} users in {results['wall_s']} s, {results['rps']} req/s, "
+          f"{results['memory']['rss_per_session_bytes'] / 1024:.0f} KiB RSS per session")
+
+    results["extraction"] = bench_extraction(args)
+    return results
+
+
+BENCHMARKS = {
+    "retrieval": bench_retrieval,
+    "async": bench_async,
+    "extraction": bench_extraction,
+    "normalize": bench_normalize,
+    "map_reduce": bench_map_reduce,
+    "overview": bench_overview,
+    "local_answers": bench_local_answers,
+    "load": bench_load,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chatbot benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="fixed fake upstream latency per call, seconds")
+    parser.add_argument("--per-kb-latency", type=float, default=0.002,
+                        help="extra fake upstream latency per KiB of prompt, seconds")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 500],
+                        help="concurrent requests per round (async benchmark)")
+    parser.add_argument("--reply-chars", type=int, default=400,
+                        help="length of each fake upstream reply")
+    parser.add_argument("--users", type=int, default=20,
+                        help="concurrent simulated users (load benchmark)")
+    parser.add_argument("--turns", type=int, default=5,
+                        help="questions per simulated user (load benchmark)")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="worker threads for the synchronous baseline")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="extraction worker processes (default: one per CPU)")
+    parser.add_argument("--window", type=int, default=100000,
+                        help="context window in characters (map_reduce benchmark)")
+    parser.add_argument("--map-concurrency", type=int, default=4,
+                        help="concurrent shard calls per question (map_reduce benchmark)")
+    parser.add_argument("--enough", type=int, default=3,
+                        help="relevant shards before cancelling the rest (map_reduce benchmark)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.json) if args.json else None
+    results = BENCHMARKS[args.benchmark](args)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Cache of model answers keyed on document, question and model.
+
+Students ask the same questions about the same syllabus over and over.  An
+answer is cached under sha256(document fingerprint, normalised question,
+model) in an in-memory LRU with a TTL, optionally backed by a SQLite table
+so entries survive restarts.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SPACE_RE = re.compile(r"\s+")
+
+
+def fingerprint(text):
+    """Stable fingerprint of a document's text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_prompt(prompt):
+    # "What is  the credit count?" and "what is the credit count" are one question
+    return SPACE_RE.sub(" ", prompt).strip().rstrip("?!. ").lower()
+
+
+def cache_key(document_fingerprint, prompt, model):
+    raw = "\0".join([document_fingerprint or "", normalize_prompt(prompt), model])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier LRU + TTL cache with hit/miss counters.
+
+    path is an optional SQLite file for the persistent tier; entries found
+    only on disk are promoted back into memory.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600.0, path=None, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+            ''')
+            self._conn.commit()
+
+    def get(self, key):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, created = entry
+                if now - created < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self._entries[key]
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    'SELECT response, created FROM response_cache WHERE key = ?', (key,)).fetchone()
+                if row is not None and now - row[1] < self.ttl:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+                if row is not None:
+                    self._conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+                    self._conn.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key, response):
+        now = self.clock()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._conn is not None:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO response_cache (key, response, created) VALUES (?, ?, ?)',
+                    (key, response, now))
+                self._conn.commit()
+
+    def _remember(self, key, response, created):
+        self._entries[key] = (response, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+            }
@@ -1,163 +1,747 @@
 import os
-from flask import Flask, request, jsonify
+import functools
+import hmac
+import json
+import time
+import django
+from django.db import close_old_connections
+from flask import Flask, Request, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
-import requests
-import PyPDF2
 from werkzeug.utils import secure_filename
 
+from chatbot import metrics
+from chatbot.cache import ResponseCache, cache_key, fingerprint
+from chatbot.context import ContextBuilder, Summarizer
+from chatbot.corpus import CorpusIndexes
+from chatbot.docstore import BLOB_PATTERN, DocumentStore, HashedUpload, file_digest
+from chatbot.extraction import ExtractionJobs, choose_extractor, new_job_id
+from chatbot.mapreduce import MapReduce, asks_about_whole_document
+
+load_dotenv()
+# Chat history is stored through the Django project's ChatHistory model
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myapp.settings")
+from django.apps import apps
+if not apps.ready:
+    # Already done when imported by the Django site (chatbot/views.py)
+    django.setup()
+
+from chatbot.history import export_filters, history_etag, history_query, iter_jsonl_gz, open_store
+from chatbot.extractive import LocalAnswerer
+from chatbot.overview import Overviews, overview_context
+from chatbot.retrieval import DocumentIndex
+from chatbot.sessions import SessionStore
+from chatbot.singleflight import SingleFlight
+from chatbot.storage import QuotaExceeded, StorageManager
+from chatbot.upstream import CircuitBreaker, CircuitOpenError, GeminiClient
+
+class UploadRequest(Request):
+    # Multipart file parts are written straight to disk, hashed and
+    # size-checked as they arrive instead of being buffered first
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashedUpload(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_MAX_BYTES'])
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 CORS(app)
 
-load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
 
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['UPLOAD_MAX_BYTES'] = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Gemini API client, shared so connections are pooled and reused
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+GEMINI_OPTIONS = {
+    "connect_timeout": float(os.getenv("GEMINI_CONNECT_TIMEOUT", "3.05")),
+    "read_timeout": float(os.getenv("GEMINI_READ_TIMEOUT", "60")),
+    "max_retries": int(os.getenv("GEMINI_MAX_RETRIES", "3")),
+}
+gemini = GeminiClient(
+    GEMINI_BASE_URL, API_KEY, GEMINI_MODEL,
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+    ),
+    **GEMINI_OPTIONS,
+)
+# Identical prompts about the same document in flight at once share one call
+inflight = SingleFlight()
+
+# Only the best matching chunks of a document are sent with each question
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "1") == "1"
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "6"))
+RETRIEVAL_BUDGET_CHARS = int(os.getenv("RETRIEVAL_BUDGET_CHARS", "8000"))
+RETRIEVAL_CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "1200"))
+
+# Chat history is written in batches by a background thread
+# into the project database, the same ChatHistory table the Django site uses
+history_store = open_store(
+    flush_interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.05")),
+    batch_size=int(os.getenv("HISTORY_BATCH_SIZE", "200")),
+)
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "1000"))
+
+# Answers to repeated questions about the same document are served from cache
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "86400")),
+    path=os.getenv("RESPONSE_CACHE_DB") or None,
+)
+
+# Documents are parsed by a pool of worker processes, not in the request
+# thread.  EXTRACT_BACKEND picks between the PDF backends; NORMALIZE_TEXT
+# strips headers, footers and other repeated text before it is stored.
+EXTRACT_BACKEND = os.getenv("EXTRACT_BACKEND", "pymupdf")
+extraction_jobs = ExtractionJobs(
+    workers=int(os.getenv("EXTRACT_WORKERS", "0")) or None,
+    batch_pages=int(os.getenv("EXTRACT_BATCH_PAGES", "16")),
+    normalize=os.getenv("NORMALIZE_TEXT", "1") == "1",
+)
+
+# Disk used by uploads is accounted per user and session, bounded by
+# quotas, and swept of abandoned and long unused files in the background
+storage = StorageManager(
+    os.getenv("STORAGE_DB", "storage.db"),
+    user_quota_bytes=int(os.getenv("STORAGE_USER_QUOTA", str(500 * 1024 * 1024))),
+    global_quota_bytes=int(os.getenv("STORAGE_GLOBAL_QUOTA", str(10 * 1024 ** 3))),
+    ttl=float(os.getenv("STORAGE_TTL_DAYS", "30")) * 86400,
+    batch_size=int(os.getenv("STORAGE_SWEEP_BATCH", "100")),
+)
+STORAGE_SWEEP_INTERVAL = float(os.getenv("STORAGE_SWEEP_INTERVAL", "300"))
+
+# Uploaded files and their extracted text, stored once per SHA-256
+document_store = DocumentStore(os.getenv("DOCSTORE_DB", "documents.db"), UPLOAD_FOLDER, on_delete=storage.forget)
+storage.add_root(UPLOAD_FOLDER, BLOB_PATTERN, referenced=document_store.referenced)
+if STORAGE_SWEEP_INTERVAL > 0:
+    storage.start(STORAGE_SWEEP_INTERVAL)
+
+# Sessions live in SQLite, shared by all workers; each process keeps the
+# recently used ones (and their retrieval index) in memory up to a budget.
+# A session's document text is read from the document store, not copied.
+session_store = SessionStore(
+    os.getenv("SESSION_DB", "sessions.db"),
+    budget_bytes=int(os.getenv("SESSION_MEMORY_BUDGET", str(256 * 1024 * 1024))),
+    make_index=lambda text: DocumentIndex(text, chunk_chars=RETRIEVAL_CHUNK_CHARS),
+    load_text=lambda digest: (document_store.get(digest) or ("",))[0],
+)
+upload_jobs = {}
+
+# Logged-in users' questions also search everything they have uploaded
+# (see chatbot/views.py); one vector index per user under CORPUS_DIR
+CORPUS_ENABLED = os.getenv("CORPUS_ENABLED", "1") == "1"
+CORPUS_TOP_K = int(os.getenv("CORPUS_TOP_K", "4"))
+CORPUS_BUDGET_CHARS = int(os.getenv("CORPUS_BUDGET_CHARS", "4000"))
+corpus_indexes = CorpusIndexes(os.getenv("CORPUS_DIR", "corpus"), chunk_chars=RETRIEVAL_CHUNK_CHARS)
 
-# Gemini API endpoint
-GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={API_KEY}"
+# A document that would not fit the model's window is answered
+# map-reduce when a few passages cannot answer the question: with
+# retrieval off, or for questions about all of it (summaries, "list all
+# ..."), or for every question with MAP_REDUCE_ALWAYS=1.  The question goes
+# to each shard and the partial answers are combined by the answer call.
+# Shards are half a window so the question and instructions always fit
+# next to one.
+CONTEXT_WINDOW_CHARS = int(os.getenv("CONTEXT_WINDOW_CHARS", "400000"))
+MAP_REDUCE_ALWAYS = os.getenv("MAP_REDUCE_ALWAYS", "0") == "1"
+map_reduce = MapReduce(
+    lambda prompt: gemini.generate(prompt),
+    shard_chars=int(os.getenv("MAP_REDUCE_SHARD_CHARS", "0")) or CONTEXT_WINDOW_CHARS // 2,
+    concurrency=int(os.getenv("MAP_REDUCE_CONCURRENCY", "4")),
+    enough=int(os.getenv("MAP_REDUCE_ENOUGH", "3")),
+)
 
-# In-memory session storage
-chat_sessions = {}
-document_texts = {}
-uploaded_files = {} 
+# Once a document is extracted, its summary, outline and key terms and
+# the answers to a few starter questions are prepared in the background,
+# so those questions are answered at once.  OVERVIEW_QUESTIONS replaces
+# the starter questions ("|" between them).
+OVERVIEW_ENABLED = os.getenv("OVERVIEW_ENABLED", "1") == "1"
+overviews = Overviews(
+    document_store,
+    lambda prompt: gemini.generate(prompt),
+    lambda text, questions: starter_prompts(text, questions),
+    questions=[q.strip() for q in os.getenv("OVERVIEW_QUESTIONS", "").split("|") if q.strip()] or None,
+    input_chars=int(os.getenv("OVERVIEW_INPUT_CHARS", "0")) or CONTEXT_WINDOW_CHARS // 2,
+    concurrency=int(os.getenv("OVERVIEW_CONCURRENCY", "4")),
+)
+
+# Lookup questions ("what is the notice period?") that the document
+# answers unambiguously are answered locally, without Gemini;
+# LOCAL_ANSWER_THRESHOLD is the confidence a local answer needs.
+# LOCAL_ANSWER_COURSES=1 also reads course credits and codes from
+# curricula laid out like the bundled B.Tech one.
+LOCAL_ANSWERS_ENABLED = os.getenv("LOCAL_ANSWERS_ENABLED", "1") == "1"
+local_answerer = LocalAnswerer(threshold=float(os.getenv("LOCAL_ANSWER_THRESHOLD", "0.8")),
+                               courses=os.getenv("LOCAL_ANSWER_COURSES", "0") == "1")
+
+# Earlier turns go upstream as a rolling summary plus the latest turns
+context_builder = ContextBuilder(
+    budget_tokens=int(os.getenv("CONTEXT_BUDGET_TOKENS", "1500")),
+    summary_tokens=int(os.getenv("CONTEXT_SUMMARY_TOKENS", "300")),
+)
+summarizer = Summarizer(session_store, context_builder, lambda prompt: gemini.generate(prompt))
+
+# Stage timings and counters are served at /metrics.  PROFILE_SLOWEST=N
+# also samples request stacks and keeps the N slowest at /debug/profiles;
+# sampling costs a little CPU on every request, so it is off by default.
+# Those two and /cache_stats and /session_stats are for operators only:
+# they answer requests from METRICS_ALLOWED_IPS (loopback by default) or
+# carrying METRICS_TOKEN in an X-Metrics-Token header.  Behind a proxy on
+# the same host every request comes from loopback, so set
+# METRICS_ALLOWED_IPS="" there and use the token.
+METRICS_ALLOWED_IPS = {ip.strip() for ip in os.getenv("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+                       if ip.strip()}
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+PROFILE_SLOWEST = int(os.getenv("PROFILE_SLOWEST", "0"))
+profiler = metrics.SamplingProfiler(
+    keep=PROFILE_SLOWEST,
+    interval=float(os.getenv("PROFILE_INTERVAL", "0.005")),
+) if PROFILE_SLOWEST else None
+
+metrics.registry.collect("chatbot_response_cache_lookups_total", "Answer cache lookups, by result.",
+                         lambda: {"hit": response_cache.hits, "miss": response_cache.misses},
+                         kind="counter", label="result")
+metrics.registry.collect("chatbot_response_cache_entries", "Answers held in the in-memory cache.",
+                         lambda: response_cache.stats()["entries"])
+metrics.registry.collect("chatbot_upstream_calls_total", "Gemini calls made and calls coalesced into them.",
+                         lambda: {"made": inflight.calls, "coalesced": inflight.coalesced},
+                         kind="counter", label="result")
+metrics.registry.collect("chatbot_circuit_open", "1 while the Gemini circuit breaker is open.",
+                         lambda: int(gemini.breaker.state == "open"))
+metrics.registry.collect("chatbot_sessions", "Chat sessions stored.",
+                         lambda: session_store.stats()["sessions"])
+metrics.registry.collect("chatbot_sessions_in_memory", "Chat sessions cached in this process.",
+                         lambda: session_store.stats()["sessions_in_memory"])
+metrics.registry.collect("chatbot_session_memory_bytes", "Estimated size of the cached sessions.",
+                         lambda: session_store.stats()["bytes_in_memory"])
+metrics.registry.collect("chatbot_storage_bytes", "Bytes of uploaded files on disk.",
+                         lambda: storage.usage()["bytes"])
+metrics.registry.collect("chatbot_storage_files", "Uploaded files on disk.",
+                         lambda: storage.usage()["files"])
+metrics.registry.collect("chatbot_overviews_pending", "Documents waiting for their overview.",
+                         lambda: overviews.stats()["pending"])
+
+@app.before_request
+def start_timing():
+    g.started = time.perf_counter()
+    metrics.begin_request(request.endpoint or "unknown")
+    if profiler:
+        profiler.begin()
+
+@app.after_request
+def record_timing(response):
+    g.status = response.status_code
+    return response
+
+@app.teardown_request
+def close_db_connection(exc):
+    elapsed = time.perf_counter() - g.pop("started", time.perf_counter())
+    route = request.endpoint or "unknown"
+    metrics.REQUEST_SECONDS.observe(elapsed, route=route, status=g.pop("status", 500))
+    if profiler:
+        profiler.end(route, elapsed)
+    metrics.end_request()
+    # What Django does at the end of each of its own requests
+    close_old_connections()
 
 @app.route("/new_chat", methods=["POST"])
 def new_chat():
     data = request.get_json()
     session_id = data.get("session_id")
-    chat_sessions[session_id] = []
-    document_texts[session_id] = ""  # Initialize empty doc text
+    clear_document(session_id)
+    session_store.create(session_id)
     return jsonify({"success": True})
 
 @app.route("/chat", methods=["POST"])
 def chat():
+    with metrics.span("parse_request"):
+        data = request.get_json()
+    session_id = data.get("session_id")
+    user_message = data.get("message")
+
+    with metrics.span("append_message"):
+        if not session_store.append_message(session_id, "user", user_message):
+            return jsonify({"success": False, "error": "Invalid session ID"}), 400
+    with metrics.span("save_to_db"):
+        save_to_db(session_id, "user", user_message)
+    touch_document(session_id)
+
+    # "no_cache": true in the request forces a fresh answer
+    with metrics.span("cache_lookup"):
+        key = answer_cache_key(session_id, user_message)
+        model_text = None if data.get("no_cache") else ready_answer(session_id, user_message, key)
+
+    if model_text is None:
+        with metrics.span("build_prompt"):
+            full_prompt = build_prompt(session_id, user_message)
+        try:
+            with metrics.span("gemini"):
+                model_text = inflight.do(answer_cache_key(session_id, full_prompt),
+                                         lambda: gemini.generate(full_prompt))
+        except CircuitOpenError:
+            metrics.UPSTREAM_ERRORS.inc(kind="circuit_open")
+            return jsonify({"success": False, "error": "Gemini API is temporarily unavailable."}), 503
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(kind="error")
+            print("Error connecting to Gemini API:", str(e))
+            return jsonify({"success": False, "error": "Error connecting to Gemini API."})
+        response_cache.set(key, model_text)
+
+    with metrics.span("record_reply"):
+        record_reply(session_id, model_text)
+    with metrics.span("respond"):
+        return jsonify({"success": True, "response": model_text})
+
+@app.route("/chat_stream", methods=["POST"])
+def chat_stream():
     data = request.get_json()
     session_id = data.get("session_id")
     user_message = data.get("message")
 
-    if session_id not in chat_sessions:
+    if not session_store.append_message(session_id, "user", user_message):
         return jsonify({"success": False, "error": "Invalid session ID"}), 400
-
-    chat_sessions[session_id].append({"role": "user", "text": user_message})
     save_to_db(session_id, "user", user_message)
-    
-    # Combine uploaded document text with user query
-    full_prompt = user_message
-    if document_texts.get(session_id):
-        full_prompt = f"{document_texts[session_id]}\n\nUser question: {user_message}"
-
-    headers = {"Content-Type": "application/json"}
-    payload = {
-        "contents": [
-            {"parts": [{"text": full_prompt}]}
-        ]
-    }
+    touch_document(session_id)
 
-    try:
-        response = requests.post(GEMINI_URL, headers=headers, json=payload)
-        response.raise_for_status()
-        response_data = response.json()
-        model_text = response_data['candidates'][0]['content']['parts'][0]['text']
+    key = answer_cache_key(session_id, user_message)
+    cached = None if data.get("no_cache") else ready_answer(session_id, user_message, key)
 
-        chat_sessions[session_id].append({"role": "model", "text": model_text})
-        save_to_db(session_id, "model", model_text)
-        return jsonify({"success": True, "response": model_text})
+    if cached is not None:
+        pieces = iter([cached])
+    else:
+        full_prompt = build_prompt(session_id, user_message)
+        try:
+            pieces = gemini.stream(full_prompt)
+        except CircuitOpenError:
+            metrics.UPSTREAM_ERRORS.inc(kind="circuit_open")
+            return jsonify({"success": False, "error": "Gemini API is temporarily unavailable."}), 503
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(kind="error")
+            print("Error connecting to Gemini API:", str(e))
+            return jsonify({"success": False, "error": "Error connecting to Gemini API."})
 
-    except Exception as e:
-        print("Error connecting to Gemini API:", str(e))
-        return jsonify({"success": False, "error": "Error connecting to Gemini API."})
+    def generate():
+        parts = []
+        try:
+            for text in pieces:
+                parts.append(text)
+                yield sse_event({"text": text})
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(kind="stream")
+            print("Error streaming from Gemini API:", str(e))
+            yield sse_event({"error": "Error connecting to Gemini API."}, event="error")
+            return
+
+        # Persist the assembled reply the same way /chat does
+        model_text = "".join(parts)
+        if cached is None:
+            response_cache.set(key, model_text)
+        record_reply(session_id, model_text)
+        yield sse_event({"done": True}, event="done")
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
-    session_id = request.form.get("session_id")
-    if 'file' not in request.files or not session_id:
-        return jsonify({"success": False, "error": "Missing file or session_id"}), 400
+    try:
+        return _upload()
+    finally:
+        # Closing an upload that was turned away deletes its .part file
+        # now; one that was stored has been kept and is only closed
+        request.close()
+
+def _upload():
+    # Reading the form receives the whole multipart body onto disk
+    with metrics.span("receive"):
+        session_id = request.form.get("session_id")
+        if 'file' not in request.files or not session_id:
+            return jsonify({"success": False, "error": "Missing file or session_id"}), 400
 
     file = request.files['file']
     if file.filename == '':
         return jsonify({"success": False, "error": "No file selected"}), 400
 
     filename = secure_filename(file.filename)
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
+    try:
+        extractor = choose_extractor(filename, file.mimetype, request.form.get("backend"), EXTRACT_BACKEND)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-    # Extract text if it's a PDF
-    if filename.lower().endswith('.pdf'):
+    if session_id not in session_store:
+        return jsonify({"success": False, "error": "Invalid session ID"}), 400
+
+    # The body was hashed while it streamed to disk; identical bytes are
+    # stored and extracted only once
+    with metrics.span("store"):
         try:
-            with open(filepath, 'rb') as f:
-                reader = PyPDF2.PdfReader(f)
-                text = "\n".join([page.extract_text() or '' for page in reader.pages])
-                document_texts[session_id] = text.strip()
-        except Exception as e:
-            return jsonify({"success": False, "error": f"Error reading PDF: {str(e)}"}), 500
-    else:
-        return jsonify({"success": False, "error": "Only PDF files are supported"}), 400
+            digest, filepath = store_upload(file.stream, filename, session_id)
+        except QuotaExceeded as e:
+            return jsonify({"success": False, "error": str(e)}), 507
+    with metrics.span("set_document"):
+        clear_document(session_id)
+        stored = document_store.get(digest)
+        session_store.set_document(session_id, digest, stored[0] if stored else "")
+
+    if stored is not None:
+        prepare_overview(digest, stored[0])
+        return jsonify({"success": True, "message": "File uploaded and processed"})
+
+    # Extract text in the background
+    job_id = new_job_id()
+    upload_jobs[session_id] = job_id
+    started = time.perf_counter()
+
+    def extracted(text, page_offsets):
+        metrics.EXTRACTION_SECONDS.observe(time.perf_counter() - started, backend=extractor.name)
+        document_ready(session_id, job_id, digest, text, page_offsets)
+
+    try:
+        with metrics.span("submit"):
+            extraction_jobs.submit(filepath, extractor.name, job_id=job_id, on_done=extracted,
+                                   on_text=lambda piece: document_store.append_text(digest, job_id, piece),
+                                   on_error=lambda error: extraction_failed(session_id, job_id, digest, error))
+    except Exception as e:
+        clear_document(session_id)
+        return jsonify({"success": False, "error": f"Error reading document: {str(e)}"}), 500
+
+    return jsonify({"success": True, "job_id": job_id, "message": "File uploaded, processing started"}), 202
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit_mb = app.config['UPLOAD_MAX_BYTES'] / (1024 * 1024)
+    return jsonify({"success": False, "error": f"File is too large (limit {limit_mb:g} MB)"}), 413
 
-    return jsonify({"success": True, "message": "File uploaded and processed"})
+@app.route("/upload_status/<job_id>", methods=["GET"])
+def upload_status(job_id):
+    status = extraction_jobs.status(job_id)
+    if status is None:
+        return jsonify({"success": False, "error": "Unknown job ID"}), 404
+    return jsonify({"success": True, **status})
 
 @app.route("/get_history/<session_id>", methods=["GET"])
 def get_history(session_id):
-    import sqlite3
-    conn = sqlite3.connect('chat_session.db')
-    c = conn.cursor()
-    c.execute('SELECT role, message FROM chat_history WHERE session_id = ?', (session_id,))
-    rows = c.fetchall()
-    conn.close()
-    history = [{"role": role, "text": msg} for role, msg in rows]
-    return jsonify(history)
+    # ?since=<id> for newer messages, ?before=<id>&limit=<n> for older ones;
+    # no limit streams the whole history
+    try:
+        query = history_query(request.args, HISTORY_PAGE_MAX)
+    except ValueError:
+        return jsonify({"success": False, "error": "since, before and limit must be integers"}), 400
+
+    etag = history_etag(history_store.version(session_id), *query)
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    return Response(history_store.json_chunks(session_id, *query), mimetype="application/json",
+                    headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
+
+
+@app.route("/export_history/<session_id>", methods=["GET"])
+def export_history(session_id):
+    # A session's whole history as gzipped JSON Lines, optionally limited
+    # to ?since= / ?until= (ISO dates); see manage.py import_history
+    try:
+        filters = export_filters(request.args)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return Response(iter_jsonl_gz(history_store.export(user_id=None, session_id=session_id, **filters)),
+                    mimetype="application/gzip",
+                    headers={"Content-Disposition": f'attachment; filename="{session_id}.jsonl.gz"'})
 
 
 @app.route("/delete_chat", methods=["POST"])
 def delete_chat():
     data = request.get_json()
     session_id = data.get("session_id")
-    if session_id in chat_sessions:
-        del chat_sessions[session_id]
-    if session_id in document_texts:
-        del document_texts[session_id]
+    upload_jobs.pop(session_id, None)
+    digest = session_store.delete(session_id)
+    if digest:
+        document_store.release(digest)
     return jsonify({"success": True})
 
-import os
-
 @app.route("/remove_document", methods=["POST"])
 def remove_document():
     data = request.get_json()
     session_id = data.get("session_id")
 
-    if session_id in document_texts:
-        document_texts[session_id] = ""
-
-        # Also remove file if stored
-        if session_id in uploaded_files:
-            filepath = uploaded_files[session_id]
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            del uploaded_files[session_id]
+    if session_id in session_store:
+        # Also drop the session's reference to the stored file
+        clear_document(session_id)
 
         return jsonify({"success": True, "message": "Document removed for session"})
     else:
         return jsonify({"success": False, "error": "Session not found"}), 400
 
 
+@app.route("/document_overview/<session_id>", methods=["GET"])
+def document_overview(session_id):
+    status = overview_status(session_id)
+    if status is None:
+        return jsonify({"success": False, "error": "No document in this session"}), 404
+    return jsonify({"success": True, **status})
+
+
+def operators_only(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get("X-Metrics-Token", "")
+        if not (request.remote_addr in METRICS_ALLOWED_IPS
+                or METRICS_TOKEN and hmac.compare_digest(token, METRICS_TOKEN)):
+            return jsonify({"success": False, "error": "Forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@app.route("/cache_stats", methods=["GET"])
+@operators_only
+def cache_stats():
+    return jsonify({**response_cache.stats(), "inflight": inflight.stats(), "local_answers": local_answerer.stats()})
+
+
+@app.route("/session_stats", methods=["GET"])
+@operators_only
+def session_stats():
+    return jsonify(session_store.stats())
+
+
+@app.route("/metrics", methods=["GET"])
+@operators_only
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/debug/profiles", methods=["GET"])
+@operators_only
+def debug_profiles():
+    # Feed "folded" to flamegraph.pl or speedscope to see where time went
+    if profiler is None:
+        return jsonify({"success": False, "error": "Profiling is off; set PROFILE_SLOWEST"}), 404
+    return jsonify({"success": True, "profiles": profiler.profiles()})
+
+
+def store_upload(upload, filename, session_id, user_id=None):
+    """Keep a received upload in the document store; returns (digest, path).
+
+    Raises QuotaExceeded, and deletes the upload, if its bytes are new and
+    would take the user or the node over quota.
+    """
+    digest = upload.hexdigest()
+    if not document_store.contains(digest):
+        try:
+            storage.check_quota(user_id, upload.size)
+        except QuotaExceeded:
+            upload.close()
+            raise
+    filepath = document_store.acquire(digest, upload.keep(), os.path.splitext(filename)[1].lower())
+    storage.track(filepath, user_id, session_id)
+    return digest, filepath
+
+
+def document_ready(session_id, job_id, digest, text, page_offsets):
+    """Store and prepare an extracted document; returns its text.
+
+    text is None when the extraction streamed it into the document store.
+    """
+    if text is None:
+        text = document_store.finish_text(digest, job_id, page_offsets)
+    else:
+        document_store.put(digest, text, page_offsets)
+    prepare_overview(digest, text)
+    if LOCAL_ANSWERS_ENABLED:
+        # Find the facts now rather than on the first question
+        local_answerer.facts(text, fingerprint(text))
+    # A newer upload, or deleting the chat, supersedes this extraction
+    if upload_jobs.get(session_id) == job_id:
+        del upload_jobs[session_id]
+        session_store.set_document(session_id, digest, text)
+    return text
+
+
+def index_upload(user_id, path, name):
+    """Add a file saved outside a chat (the Django site's document list) to
+    its owner's corpus; the text is extracted in the background.
+
+    Returns the extraction job id, or None if there is nothing to do.
+    Raises ValueError for a format no extractor reads.
+    """
+    if not CORPUS_ENABLED:
+        return None
+    corpus = corpus_indexes.get(user_id)
+    digest = file_digest(path)
+    if digest in corpus:
+        return None
+    extractor = choose_extractor(name, default=EXTRACT_BACKEND)
+    return extraction_jobs.submit(path, extractor.name,
+                                  on_done=lambda text, page_offsets: corpus.add(digest, name, text),
+                                  on_error=lambda error: print("Error indexing upload:", error))
+
+
+def extraction_failed(session_id, job_id, digest, error):
+    # The job's status already says why; the session drops the document it
+    # was waiting for, unless a newer upload has replaced it meanwhile
+    print("Error extracting document:", error)
+    document_store.discard_text(digest, job_id)
+    if upload_jobs.get(session_id) == job_id:
+        clear_document(session_id)
+
+
+def prepare_overview(digest, text):
+    if OVERVIEW_ENABLED:
+        overviews.request(digest, text)
+
+
+def overview_status(session_id):
+    """The overview of the session's document for display, or None.
+
+    state is "ready", "pending" while the document is being extracted or
+    summarized, or "unavailable".
+    """
+    session = session_store.get(session_id)
+    if session is None or not session.document:
+        return None
+    touch_document(session_id)
+    overview = overviews.get(session.document) if OVERVIEW_ENABLED else None
+    if overview is not None:
+        state = "ready"
+    elif OVERVIEW_ENABLED and (session_id in upload_jobs or overviews.pending(session.document)):
+        state = "pending"
+    else:
+        state = "unavailable"
+    overview = overview or {}
+    return {
+        "state": state,
+        "summary": overview.get("summary", ""),
+        "outline": overview.get("outline", []),
+        "key_terms": overview.get("key_terms", []),
+        "questions": list(overviews.questions) if OVERVIEW_ENABLED else [],
+    }
+
+
+def ready_answer(session_id, user_message, key):
+    """An answer that needs no upstream call, or None.
+
+    Cached answers first, then those prepared with the document's
+    overview, then lookups the document answers on its own.
+    """
+    answer = response_cache.get(key)
+    if answer is not None:
+        return answer
+    session = session_store.get(session_id)
+    if session is None or not session.text:
+        return None
+    if OVERVIEW_ENABLED:
+        answer = overviews.answer(session.document, user_message)
+        if answer is not None:
+            metrics.PREPARED_ANSWERS.inc()
+            return answer
+    if LOCAL_ANSWERS_ENABLED:
+        with metrics.span("local_answer"):
+            answer = local_answerer.route(user_message, session.text, session.fingerprint, session.index)
+        metrics.QUESTION_ROUTES.inc(route="upstream" if answer is None else "local")
+    return answer
+
+
+def touch_document(session_id):
+    # A document still being asked about must not expire (see chatbot.storage)
+    session = session_store.get(session_id)
+    path = document_store.path(session.document) if session is not None and session.document else None
+    if path:
+        storage.touch(path)
+
+
+def clear_document(session_id):
+    upload_jobs.pop(session_id, None)
+    digest = session_store.set_document(session_id, None)
+    if digest:
+        document_store.release(digest)
+
+
+def answer_cache_key(session_id, user_message, corpus=None):
+    session = session_store.get(session_id)
+    scope = session.fingerprint if session else ""
+    conversation = conversation_context(session) if session else ""
+    if conversation:
+        # A follow-up means something else after another conversation, so
+        # only sessions that got to the question the same way share answers
+        scope += f":{fingerprint(conversation)}"
+    if corpus is not None:
+        # Answers drawing on the corpus go stale when it changes
+        scope += f":{corpus.directory}:{corpus.version}"
+    return cache_key(scope, user_message, GEMINI_MODEL)
+
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def build_prompt(session_id, user_message, corpus=None):
+    # Combine the relevant parts of the uploaded document (and of the
+    # user's other documents) and the conversation so far with user query
+    session = session_store.get(session_id)
+    if session is None:
+        return user_message
+    conversation = conversation_context(session)
+    blocks = [block for block in (document_context(session, user_message) if session.text else "",
+                                  corpus_context(corpus, session, user_message),
+                                  conversation) if block]
+    if not blocks:
+        return user_message
+    return "\n\n".join(blocks) + f"\n\nUser question: {user_message}"
+
+
+def conversation_context(session):
+    # The question itself was already stored as the last message
+    return context_builder.build(session.summary, session.messages[session.summarized:-1])
+
+
+def document_context(session, question):
+    return text_context(session.text, question, session.index, session.document)
+
+
+def text_context(text, question, index=None, document=None):
+    # The whole text if it fits; otherwise the passages matching the
+    # question, or map-reduce answers, after the document's overview.
+    # Questions about the whole document get the whole text, however far
+    # it is over the retrieval budget, as long as it fits the window.
+    retrieval = RETRIEVAL_ENABLED and index is not None
+    whole = asks_about_whole_document(question)
+    if len(text) > CONTEXT_WINDOW_CHARS and (MAP_REDUCE_ALWAYS or whole or not retrieval):
+        context = map_reduce.context(question, text)
+    elif retrieval and len(text) > RETRIEVAL_BUDGET_CHARS and not whole:
+        context = index.context_for(question, RETRIEVAL_TOP_K, RETRIEVAL_BUDGET_CHARS)
+    else:
+        return text
+    overview = overview_context(overviews.get(document)) if OVERVIEW_ENABLED and document else ""
+    return f"{overview}\n\n{context}" if overview else context
+
+
+def starter_prompts(text, questions):
+    # What build_prompt sends for each question as the first of a chat
+    index = DocumentIndex(text, chunk_chars=RETRIEVAL_CHUNK_CHARS) if RETRIEVAL_ENABLED else None
+    return [f"{text_context(text, question, index)}\n\nUser question: {question}" for question in questions]
+
+
+def corpus_context(corpus, session, question):
+    if corpus is None:
+        return ""
+    passages = corpus.passages(question, CORPUS_TOP_K, CORPUS_BUDGET_CHARS, exclude=session.document)
+    if not passages:
+        return ""
+    return "From your other documents:\n\n" + "\n\n".join(f"[{name}]\n{text}" for name, text in passages)
+
+
+def record_reply(session_id, model_text):
+    session_store.append_message(session_id, "model", model_text)
+    save_to_db(session_id, "model", model_text)
+    summarizer.request(session_id)
+
+
 def save_to_db(session_id, role, message):
-    import sqlite3
-    conn = sqlite3.connect('chat_session.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS chat_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            role TEXT NOT NULL,
-            message TEXT NOT NULL
-        )
-    ''')
-    c.execute('INSERT INTO chat_history (session_id, role, message) VALUES (?, ?, ?)',
-              (session_id, role, message))
-    conn.commit()
-    conn.close()
+    history_store.add(session_id, role, message)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+"""Conversation context for follow-up questions, kept under a token budget.
+
+The prompt carries a rolling summary of older turns plus as many of the
+most recent turns as fit in the budget.  A background summarizer folds the
+oldest turns into the summary once the unsummarized part outgrows the
+budget, so the prompt stays the same size however long a chat runs.
+
+Token counts are estimated from words and punctuation, which tracks the
+model tokenizer closely enough for budgeting, and are cached per stored
+message (see chatbot.sessions).
+"""
+import queue
+import re
+import threading
+
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+ROLE_NAMES = {"user": "User", "model": "Assistant"}
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+TURNS_HEADER = "Recent conversation:"
+# The "User:" / "Assistant:" label in front of each rendered turn
+TURN_LABEL_TOKENS = 2
+
+SUMMARY_PROMPT = (
+    "Update the summary of a conversation between a user and an assistant.\n"
+    "Keep names, numbers, decisions and open questions; drop small talk.\n"
+    "Reply with the new summary only, in at most {max_words} words.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New turns:\n{turns}"
+)
+
+
+def count_tokens(text):
+    return len(TOKEN_RE.findall(text or ""))
+
+
+def truncate_tokens(text, max_tokens):
+    """Cut text after its first max_tokens tokens."""
+    for i, match in enumerate(TOKEN_RE.finditer(text)):
+        if i == max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+
+def render_turns(messages):
+    return "\n".join(f"{ROLE_NAMES.get(m['role'], m['role'])}: {m['text']}" for m in messages)
+
+
+def recent_turns(messages, budget_tokens):
+    """The longest run of latest messages that renders within budget_tokens."""
+    used = 0
+    start = len(messages)
+    while start > 0 and used + messages[start - 1]["tokens"] + TURN_LABEL_TOKENS <= budget_tokens:
+        start -= 1
+        used += messages[start]["tokens"] + TURN_LABEL_TOKENS
+    return messages[start:]
+
+
+class ContextBuilder:
+    """Renders summary + recent turns within budget_tokens.
+
+    The summary is capped at summary_tokens and counts against the budget;
+    turns that do not fit are left out until the summarizer folds them in.
+    Once more than budget_tokens of turns are unsummarized, the oldest are
+    folded until keep_tokens remain, so summaries are made every few turns
+    rather than on every one.
+    """
+
+    def __init__(self, budget_tokens=1500, summary_tokens=300, keep_tokens=None):
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.keep_tokens = keep_tokens if keep_tokens is not None else (budget_tokens - summary_tokens) // 2
+
+    def build(self, summary, messages):
+        """Return the conversation block for a prompt ("" for a new chat).
+
+        messages are the unsummarized turns before the current question.
+        """
+        blocks = []
+        budget = self.budget_tokens - count_tokens(TURNS_HEADER)
+        if summary:
+            summary = truncate_tokens(summary, self.summary_tokens)
+            blocks.append(f"{SUMMARY_HEADER}\n{summary}")
+            budget -= count_tokens(blocks[0])
+        turns = recent_turns(messages, budget)
+        if turns:
+            blocks.append(f"{TURNS_HEADER}\n{render_turns(turns)}")
+        return "\n\n".join(blocks)
+
+    def turns_to_fold(self, messages):
+        """How many of the oldest unsummarized messages to summarize now."""
+        total = sum(m["tokens"] + TURN_LABEL_TOKENS for m in messages)
+        if total <= self.budget_tokens - self.summary_tokens:
+            return 0
+        return len(messages) - len(recent_turns(messages, self.keep_tokens))
+
+
+class Summarizer:
+    """Background thread folding old turns of a session into its summary.
+
+    summarize(prompt) returns the model's text; it is the same blocking
+    generate() used for answers.  request(session_id) is cheap and can be
+    called after every turn; a session is queued at most once at a time.
+    """
+
+    def __init__(self, store, builder, summarize):
+        self.store = store
+        self.builder = builder
+        self.summarize = summarize
+        self.summaries = 0
+        self.failures = 0
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def request(self, session_id):
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="summarizer", daemon=True)
+                self._worker.start()
+        self._queue.put(session_id)
+
+    def join(self):
+        """Wait until every requested session has been handled."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            session_id = self._queue.get()
+            with self._lock:
+                self._pending.discard(session_id)
+            try:
+                self.fold(session_id)
+            except Exception as e:
+                self.failures += 1
+                print("Error summarizing conversation:", str(e))
+            finally:
+                self._queue.task_done()
+
+    def fold(self, session_id):
+        """Summarize the session's oldest turns if it has outgrown the budget."""
+        session = self.store.get(session_id)
+        if session is None:
+            return False
+        unsummarized = session.messages[session.summarized:]
+        count = self.builder.turns_to_fold(unsummarized)
+        if count == 0:
+            return False
+        prompt = SUMMARY_PROMPT.format(
+            max_words=self.builder.summary_tokens * 3 // 4,
+            summary=session.summary or "(none yet)",
+            turns=render_turns(unsummarized[:count]),
+        )
+        summary = truncate_tokens(self.summarize(prompt).strip(), self.builder.summary_tokens)
+        if self.store.set_summary(session_id, summary, session.summarized + count, session.summarized):
+            self.summaries += 1
+            return True
+        return False
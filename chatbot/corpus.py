@@ -0,0 +1,335 @@
+"""Vector index over every document a user has uploaded.
+
+Each user's documents are split into chunks (as in chatbot.retrieval) and
+embedded offline with a hashing vectorizer: word unigrams and bigrams are
+hashed into DIM signed buckets, weighted 1 + log(tf) and L2-normalised.
+There is no model to load and no vocabulary to keep, so a chunk can be
+embedded the moment its document is extracted and vectors from different
+uploads are always comparable.
+
+Vectors are appended to a flat float32 file that searches read through a
+read-only memory map, in blocks, so a question is scored against all of a
+user's chunks without their documents (or even their vectors) being held
+in the Python heap.  Chunk text and bookkeeping live in a SQLite file next
+to it.  Removing a document only marks its chunks deleted (a tombstone);
+compact() rewrites the vectors without them once enough have piled up,
+copying them outside the index's lock so searches are not held up.
+
+The SQLite row count is the source of truth for how many vectors are
+valid: a vector is written before the transaction that records it
+commits, so a crash in between only leaves bytes that the next append
+overwrites.
+"""
+import math
+import os
+import sqlite3
+import threading
+import zlib
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+from chatbot.retrieval import split_chunks, tokenize
+from chatbot.sessions import transaction
+
+DIM = 1024
+# Rows scored per matrix product during a search
+BLOCK_ROWS = 16384
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS chunks (
+        row INTEGER PRIMARY KEY,
+        document TEXT NOT NULL,
+        text TEXT NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_chunks_document ON chunks (document)',
+    '''
+    CREATE TABLE IF NOT EXISTS documents (
+        document TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        chunks INTEGER NOT NULL
+    )
+    ''',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+    "INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)",
+]
+
+
+@lru_cache(maxsize=65536)
+def feature(token, dim):
+    """(bucket, sign) of a hashed feature; crc32 is stable across processes."""
+    h = zlib.crc32(token.encode("utf-8"))
+    return h % dim, 1.0 if h & 0x80000000 else -1.0
+
+
+def embed(texts, dim=DIM):
+    """Hashing-vectorizer embeddings of texts, as unit float32 rows."""
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        tokens = tokenize(text)
+        counts = Counter(tokens)
+        counts.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+        for token, tf in counts.items():
+            bucket, sign = feature(token, dim)
+            vectors[i, bucket] += sign * (1.0 + math.log(tf))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+class CorpusIndex:
+    """One user's chunks: vectors.f32 plus index.db in directory."""
+
+    def __init__(self, directory, dim=DIM, chunk_chars=1200, overlap_chars=200):
+        self.directory = directory
+        self.dim = dim
+        self.chunk_chars = chunk_chars
+        self.overlap_chars = overlap_chars
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._generation = None
+        self._vectors = None
+        self._dead = None
+
+    def _connection(self):
+        # One connection per process, reopened after a fork
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.directory, "index.db"), check_same_thread=False,
+                                   isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._conn = conn
+            self._generation = None
+            self._pid = os.getpid()
+        return self._conn
+
+    def _bump(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    @property
+    def version(self):
+        """Changes whenever documents are added or removed."""
+        with self._lock:
+            return self._connection().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def __contains__(self, document):
+        with self._lock:
+            return self._connection().execute(
+                'SELECT 1 FROM documents WHERE document = ?', (document,)).fetchone() is not None
+
+    def add(self, document, name, text):
+        """Index a document's text; returns the number of chunks added.
+
+        document is the file's SHA-256, so uploading the same bytes again
+        adds nothing.
+        """
+        if document in self:
+            return 0
+        chunks = split_chunks(text, self.chunk_chars, self.overlap_chars)
+        if not chunks:
+            return 0
+        # Embedding is the slow part, done before taking any lock
+        vectors = embed(chunks, self.dim)
+        with self._lock:
+            conn = self._connection()
+            with transaction(conn):
+                if conn.execute('SELECT 1 FROM documents WHERE document = ?', (document,)).fetchone():
+                    return 0
+                start = conn.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM chunks').fetchone()[0]
+                fd = os.open(self.vectors_path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    os.pwrite(fd, vectors.tobytes(), start * self.dim * 4)
+                finally:
+                    os.close(fd)
+                conn.executemany(
+                    'INSERT INTO chunks (row, document, text) VALUES (?, ?, ?)',
+                    [(start + i, document, chunk) for i, chunk in enumerate(chunks)])
+                conn.execute('INSERT INTO documents (document, name, chunks) VALUES (?, ?, ?)',
+                             (document, name, len(chunks)))
+                self._bump(conn)
+        return len(chunks)
+
+    def remove(self, document):
+        """Tombstone a document's chunks; returns True if it was indexed."""
+        with self._lock:
+            conn = self._connection()
+            with transaction(conn):
+                removed = conn.execute('DELETE FROM documents WHERE document = ?', (document,)).rowcount
+                conn.execute('UPDATE chunks SET deleted = 1 WHERE document = ?', (document,))
+                if removed:
+                    self._bump(conn)
+        return bool(removed)
+
+    def documents(self):
+        """[(document, name, chunks), ...] in upload order."""
+        with self._lock:
+            return self._connection().execute(
+                'SELECT document, name, chunks FROM documents ORDER BY rowid').fetchall()
+
+    def stats(self):
+        with self._lock:
+            conn = self._connection()
+            rows, dead = conn.execute('SELECT COUNT(*), COALESCE(SUM(deleted), 0) FROM chunks').fetchone()
+            documents = conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+        return {
+            "documents": documents,
+            "chunks": rows - dead,
+            "tombstones": dead,
+            "vector_bytes": os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0,
+        }
+
+    def _snapshot(self):
+        """The vector map and tombstone mask for the current generation."""
+        with self._lock:
+            conn = self._connection()
+            generation = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+            if generation != self._generation:
+                rows = conn.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM chunks').fetchone()[0]
+                dead = np.zeros(rows, dtype=bool)
+                dead_rows = [row for row, in conn.execute('SELECT row FROM chunks WHERE deleted = 1')]
+                dead[dead_rows] = True
+                self._vectors = (np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+                                 if rows else np.zeros((0, self.dim), dtype=np.float32))
+                self._dead = dead
+                self._generation = generation
+            return self._vectors, self._dead
+
+    def search(self, queries, k=5, min_score=0.05):
+        """Best k (row, score) pairs for each query, scored in one pass.
+
+        All queries are scored together, a block of vectors at a time, so
+        asking several questions costs little more than asking one.
+        """
+        vectors, dead = self._snapshot()
+        q = embed(queries, self.dim)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(vectors), BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + BLOCK_ROWS])
+            scores = q @ block.T
+            scores[:, dead[start:start + len(block)]] = -np.inf
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(
+                np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+            if scores.shape[1] > k:
+                keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores, best_rows = scores, rows
+
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            order = np.argsort(-scores, kind="stable")
+            results.append([(int(rows[i]), float(scores[i])) for i in order if scores[i] >= min_score])
+        return results
+
+    def passages(self, question, k=4, budget_chars=4000, exclude=None):
+        """[(document name, chunk text), ...] most relevant to question.
+
+        Chunks of the document `exclude` (already in the prompt) are skipped.
+        """
+        hits = self.search([question], k * 2)[0]
+        if not hits:
+            return []
+        with self._lock:
+            rows = {row: (document, name, text) for row, document, name, text in self._connection().execute(
+                'SELECT c.row, c.document, d.name, c.text FROM chunks c JOIN documents d USING (document) '
+                f'WHERE c.row IN ({",".join("?" * len(hits))}) AND c.deleted = 0',
+                [row for row, _ in hits])}
+        selected = []
+        used = 0
+        for row, _ in hits:
+            if row not in rows or rows[row][0] == exclude or len(selected) >= k:
+                continue
+            _, name, text = rows[row]
+            if used + len(text) > budget_chars:
+                continue
+            selected.append((name, text))
+            used += len(text)
+        return selected
+
+    def compact(self):
+        """Rewrite the vectors without tombstoned chunks; returns the rows kept.
+
+        The live vectors are copied to a new file without holding the lock,
+        so searches and uploads go on meanwhile.  Then, under the lock,
+        rows added since are copied too, rows are renumbered in order and
+        the new file replaces the old.  Searches already running keep using
+        the old map.
+        """
+        with self._compact_lock:
+            with self._lock:
+                if not os.path.exists(self.vectors_path):
+                    return 0
+                conn = self._connection()
+                end = conn.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM chunks').fetchone()[0]
+                copied, dead = [], []
+                for row, deleted in conn.execute('SELECT row, deleted FROM chunks ORDER BY row'):
+                    (dead if deleted else copied).append(row)
+
+            tmp_path = self.vectors_path + ".compact"
+            with open(self.vectors_path, "rb") as src, open(tmp_path, "wb") as dst:
+                self._copy_rows(src, dst, copied)
+
+            with self._lock:
+                conn = self._connection()
+                with transaction(conn):
+                    # Chunks removed while copying stay, tombstoned, until the
+                    # next compaction; chunks added meanwhile are copied now
+                    added = [row for row, in conn.execute(
+                        'SELECT row FROM chunks WHERE row >= ? AND deleted = 0 ORDER BY row', (end,))]
+                    with open(self.vectors_path, "rb") as src, open(tmp_path, "ab") as dst:
+                        self._copy_rows(src, dst, added)
+                    keep = copied + added
+                    conn.executemany('DELETE FROM chunks WHERE row = ?', [(row,) for row in dead])
+                    conn.execute('DELETE FROM chunks WHERE row >= ? AND deleted = 1', (end,))
+                    # Every row moves down, so ascending order never collides
+                    conn.executemany('UPDATE chunks SET row = ? WHERE row = ?',
+                                     [(new, old) for new, old in enumerate(keep) if new != old])
+                    os.replace(tmp_path, self.vectors_path)
+                    self._bump(conn)
+            return len(keep)
+
+    def _copy_rows(self, src, dst, rows):
+        size = self.dim * 4
+        for row in rows:
+            src.seek(row * size)
+            dst.write(src.read(size))
+
+
+class CorpusIndexes:
+    """The CorpusIndex of each user, under root/<user id>/."""
+
+    def __init__(self, root, dim=DIM, chunk_chars=1200, compact_ratio=0.5):
+        self.root = root
+        self.dim = dim
+        self.chunk_chars = chunk_chars
+        self.compact_ratio = compact_ratio
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                index = self._indexes[user_id] = CorpusIndex(
+                    os.path.join(self.root, str(user_id)), self.dim, self.chunk_chars)
+            return index
+
+    def remove(self, user_id, document):
+        """Tombstone a document, compacting once tombstones dominate."""
+        index = self.get(user_id)
+        removed = index.remove(document)
+        stats = index.stats()
+        if stats["tombstones"] > self.compact_ratio * (stats["chunks"] + stats["tombstones"]):
+            index.compact()
+        return removed
@@ -0,0 +1,272 @@
+"""Content-addressed store for uploaded files and their extracted text.
+
+Uploads are streamed to disk in fixed-size chunks and hashed (SHA-256) and
+size-checked in that same pass, so memory per upload stays constant no
+matter how big the file is.  The file itself is kept once per hash, and
+the extracted text plus page offsets are stored under the same hash, so
+re-uploading identical bytes shares storage and skips extraction
+entirely.  Each session holding a document owns one reference; when the
+last reference is released the entry, its overview (chatbot.overview)
+and its file are deleted.
+
+Text still being extracted is appended a piece at a time (append_text)
+and joined inside SQLite when the extraction is done, so the app never
+holds all of it just to store it.
+
+The file of a document still referenced may be swept away to save disk
+(chatbot.storage); its text stays, and uploading the same bytes again
+brings the file back.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Names of the files DocumentStore creates in blob_dir: stored documents
+# and uploads still being received
+BLOB_PATTERN = r"[0-9a-f]{64}\.\w+|\.upload-.*\.part"
+
+
+def file_digest(path, block_size=1024 * 1024):
+    """SHA-256 of a file already on disk, the key HashedUpload would give it."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class HashedUpload:
+    """Writable file that hashes and size-checks data as it is written.
+
+    Used as the multipart parser's file container, so the request body goes
+    straight to a uniquely named file under directory in a single pass.
+    Like a NamedTemporaryFile, closing it deletes the file unless keep()
+    was called first.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self.kept = False
+        self._digest = hashlib.sha256()
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix=".upload-", suffix=".part", delete=False)
+        self.path = self._file.name
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.close()
+            raise RequestEntityTooLarge()
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def keep(self):
+        """Flush and close the file but leave it on disk, return its path."""
+        self._file.close()
+        self.kept = True
+        return self.path
+
+    def close(self):
+        self._file.close()
+        if not self.kept and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DocumentStore:
+    """on_delete(path) is called after a stored file is deleted."""
+
+    def __init__(self, db_path, blob_dir, on_delete=None):
+        self.blob_dir = blob_dir
+        self.on_delete = on_delete
+        os.makedirs(blob_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                sha256 TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                text TEXT,
+                page_offsets TEXT
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS document_parts (
+                sha256 TEXT NOT NULL,
+                job TEXT NOT NULL,
+                text TEXT NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_document_parts ON document_parts (sha256, job)')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS overviews (
+                sha256 TEXT PRIMARY KEY,
+                overview TEXT NOT NULL
+            )
+        ''')
+
+    def blob_path(self, digest, ext):
+        return os.path.join(self.blob_dir, digest + ext)
+
+    def acquire(self, digest, temp_path, ext):
+        """Take a reference to digest, adopting temp_path as its file.
+
+        If the bytes are already stored, temp_path is deleted and the
+        existing file is shared.  Returns the stored file's path.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT path FROM documents WHERE sha256 = ?', (digest,)).fetchone()
+                if row is not None and os.path.exists(row[0]):
+                    os.remove(temp_path)
+                    path = row[0]
+                    self._conn.execute(
+                        'UPDATE documents SET refcount = refcount + 1 WHERE sha256 = ?', (digest,))
+                else:
+                    path = self.blob_path(digest, ext)
+                    os.replace(temp_path, path)
+                    # A document whose file was swept keeps its text and references
+                    self._conn.execute(
+                        'INSERT INTO documents (sha256, path, size, refcount) VALUES (?, ?, ?, 1) '
+                        'ON CONFLICT(sha256) DO UPDATE SET path = excluded.path, size = excluded.size, '
+                        'refcount = refcount + 1',
+                        (digest, path, os.path.getsize(path)))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return path
+
+    def contains(self, digest):
+        """True if the file for digest is stored, so storing it again costs no space."""
+        with self._lock:
+            row = self._conn.execute('SELECT path FROM documents WHERE sha256 = ?', (digest,)).fetchone()
+        return row is not None and os.path.exists(row[0])
+
+    def path(self, digest):
+        """Where the file for digest is stored, or None."""
+        with self._lock:
+            row = self._conn.execute('SELECT path FROM documents WHERE sha256 = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def referenced(self, path):
+        """True if a session still holds the document stored at path."""
+        name = os.path.basename(path)
+        if not re.fullmatch(r"[0-9a-f]{64}\.\w+", name):
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT refcount FROM documents WHERE sha256 = ?', (name.split(".", 1)[0],)).fetchone()
+        return row is not None and row[0] > 0
+
+    def get(self, digest):
+        """Return (text, page_offsets) if the text was extracted before."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT text, page_offsets FROM documents WHERE sha256 = ?', (digest,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return row[0], json.loads(row[1] or "[]")
+
+    def put(self, digest, text, page_offsets):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE documents SET text = ?, page_offsets = ? WHERE sha256 = ?',
+                (text, json.dumps(page_offsets), digest))
+
+    def append_text(self, digest, job_id, piece):
+        """Store the next piece of the text job_id is extracting."""
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO document_parts (sha256, job, text) VALUES (?, ?, ?)', (digest, job_id, piece))
+
+    def finish_text(self, digest, job_id, page_offsets):
+        """Make the pieces of job_id the document's text; returns the text."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Pieces are joined in the order they were stored
+                self._conn.execute(
+                    'UPDATE documents SET page_offsets = ?, text = (SELECT COALESCE(group_concat(text, \'\'), \'\') '
+                    'FROM (SELECT text FROM document_parts WHERE sha256 = ? AND job = ? ORDER BY rowid)) '
+                    'WHERE sha256 = ?',
+                    (json.dumps(page_offsets), digest, job_id, digest))
+                self._conn.execute('DELETE FROM document_parts WHERE sha256 = ? AND job = ?', (digest, job_id))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        stored = self.get(digest)
+        return stored[0] if stored else ""
+
+    def discard_text(self, digest, job_id):
+        """Drop the pieces of an extraction that failed."""
+        with self._lock:
+            self._conn.execute('DELETE FROM document_parts WHERE sha256 = ? AND job = ?', (digest, job_id))
+
+    def get_overview(self, digest):
+        with self._lock:
+            row = self._conn.execute('SELECT overview FROM overviews WHERE sha256 = ?', (digest,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_overview(self, digest, overview):
+        # Nothing is stored for a document released in the meantime
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO overviews (sha256, overview) '
+                'SELECT ?, ? WHERE EXISTS (SELECT 1 FROM documents WHERE sha256 = ?)',
+                (digest, json.dumps(overview), digest))
+
+    def release(self, digest):
+        """Drop one reference; the last one deletes the text and the file."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(
+                    'UPDATE documents SET refcount = refcount - 1 WHERE sha256 = ? AND refcount > 0',
+                    (digest,))
+                row = self._conn.execute(
+                    'SELECT path FROM documents WHERE sha256 = ? AND refcount = 0', (digest,)).fetchone()
+                if row is not None:
+                    self._conn.execute('DELETE FROM documents WHERE sha256 = ?', (digest,))
+                    self._conn.execute('DELETE FROM document_parts WHERE sha256 = ?', (digest,))
+                    self._conn.execute('DELETE FROM overviews WHERE sha256 = ?', (digest,))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        if row is not None and os.path.exists(row[0]):
+            os.remove(row[0])
+        if row is not None and self.on_delete is not None:
+            self.on_delete(row[0])
+
+    def stats(self):
+        with self._lock:
+            count, size, refs = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0) FROM documents').fetchone()
+        return {"documents": count, "bytes": size, "references": refs}
@@ -0,0 +1,476 @@
+"""Background text extraction for uploaded documents.
+
+Uploads are not parsed in the request thread.  Each format has an
+extractor in EXTRACTORS, chosen by file extension or MIME type:
+
+    pymupdf, pypdf2   PDF; PyMuPDF is much faster than pure-Python PyPDF2
+    docx              Word documents
+    text              plain text and Markdown
+
+Every extractor yields the text one page (or section) at a time.  PDFs
+allow random access to pages, so their page range is split into batches
+that worker processes extract in parallel, each holding only its batch;
+other formats are read front to back by one worker, whose one batch is
+the whole document.  The caller polls a job id for pages done / total.
+
+Extraction is streamed to the consumer: batches are taken in page order
+as they come in, normalized (chatbot.normalize.PageNormalizer, which
+holds only the first pages, to find running headers) and handed to
+on_text(), so the app process holds a few batches at a time, not the
+document.  Only a few batches per job are in flight at once, so pages
+that arrive early wait for the ones before them in a bounded buffer.
+The chat app appends each piece to the document store and reads the
+text back once, to index it, when the job is done.  The job's status
+reports how much normalization saved.
+"""
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from xml.etree import ElementTree
+
+from chatbot import metrics
+from chatbot.normalize import WINDOW_PAGES, PageNormalizer
+
+# Sections of formats without real pages are cut at about this size
+SECTION_CHARS = 4000
+
+
+class Extractor:
+    """Base for format backends.
+
+    seekable extractors can count their pages up front and start at any
+    page; others are only read from the start, in one pass.
+    """
+    name = None
+    extensions = ()
+    mime_types = ()
+    seekable = False
+
+    def page_count(self, path):
+        raise NotImplementedError
+
+    def iter_pages(self, path, start=0, stop=None):
+        """Yield the text of pages [start, stop)."""
+        raise NotImplementedError
+
+
+class PyMuPDFExtractor(Extractor):
+    name = "pymupdf"
+    extensions = (".pdf",)
+    mime_types = ("application/pdf",)
+    seekable = True
+
+    def page_count(self, path):
+        import pymupdf
+        with pymupdf.open(path) as doc:
+            return doc.page_count
+
+    def iter_pages(self, path, start=0, stop=None):
+        # MuPDF reads the file on demand itself
+        import pymupdf
+        with pymupdf.open(path) as doc:
+            for i in range(start, doc.page_count if stop is None else stop):
+                yield doc[i].get_text()
+
+
+class PyPDF2Extractor(Extractor):
+    name = "pypdf2"
+    extensions = (".pdf",)
+    mime_types = ("application/pdf",)
+    seekable = True
+
+    def page_count(self, path):
+        import PyPDF2
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return len(PyPDF2.PdfReader(data).pages)
+
+    def iter_pages(self, path, start=0, stop=None):
+        # A read-only memory map serves pages from the page cache instead of
+        # a second buffered copy in every worker
+        import PyPDF2
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            reader = PyPDF2.PdfReader(data)
+            for i in range(start, len(reader.pages) if stop is None else stop):
+                yield reader.pages[i].extract_text() or ''
+
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+class DocxExtractor(Extractor):
+    """Word documents, one section per heading, page break or SECTION_CHARS.
+
+    word/document.xml is parsed incrementally and each paragraph is
+    discarded once read, rather than loading the whole tree as python-docx
+    does.
+    """
+    name = "docx"
+    extensions = (".docx",)
+    mime_types = ("application/vnd.openxmlformats-officedocument.wordprocessingml.document",)
+
+    def iter_pages(self, path, start=0, stop=None):
+        return islice(self._sections(path), start, stop)
+
+    def _sections(self, path):
+        lines = []
+        size = 0
+        with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+            for _, elem in ElementTree.iterparse(xml, events=("end",)):
+                if elem.tag != W + "p":
+                    continue
+                text = "".join(node.text or "" if node.tag == W + "t" else "\t"
+                               for node in elem.iter() if node.tag in (W + "t", W + "tab"))
+                style = elem.find(f"{W}pPr/{W}pStyle")
+                heading = style is not None and style.get(W + "val", "").startswith(("Heading", "Title"))
+                new_page = elem.find(f".//{W}lastRenderedPageBreak") is not None
+                page_break = any(br.get(W + "type") == "page" for br in elem.iter(W + "br"))
+                elem.clear()
+
+                if lines and (heading or new_page or size >= SECTION_CHARS):
+                    yield "\n".join(lines)
+                    lines, size = [], 0
+                lines.append(text)
+                size += len(text) + 1
+                if page_break:
+                    yield "\n".join(lines)
+                    lines, size = [], 0
+        if lines:
+            yield "\n".join(lines)
+
+
+MARKDOWN_HEADING_RE = re.compile(r"#{1,6}\s")
+
+
+class TextExtractor(Extractor):
+    """Plain text and Markdown, one section per heading, form feed or SECTION_CHARS."""
+    name = "text"
+    extensions = (".txt", ".text", ".md", ".markdown")
+    mime_types = ("text/plain", "text/markdown", "text/x-markdown")
+
+    def iter_pages(self, path, start=0, stop=None):
+        return islice(self._sections(path), start, stop)
+
+    def _sections(self, path):
+        lines = []
+        size = 0
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                for i, part in enumerate(line.split("\f")):
+                    if lines and (i > 0 or MARKDOWN_HEADING_RE.match(part) or size >= SECTION_CHARS):
+                        yield "".join(lines).strip("\n")
+                        lines, size = [], 0
+                    lines.append(part)
+                    size += len(part)
+        if lines:
+            yield "".join(lines).strip("\n")
+
+
+EXTRACTORS = {}
+
+
+def register(extractor):
+    """Add an extractor; earlier ones win when several read a format."""
+    EXTRACTORS[extractor.name] = extractor
+    return extractor
+
+
+for extractor_class in (PyMuPDFExtractor, PyPDF2Extractor, DocxExtractor, TextExtractor):
+    register(extractor_class())
+
+
+def choose_extractor(filename, mime_type=None, name=None, default=None):
+    """Pick the extractor for an upload.
+
+    The extension decides, falling back to the MIME type (browsers often
+    send application/octet-stream).  name is an explicit choice, default a
+    preferred backend among several for the same format.  Raises ValueError
+    with a message for the user when nothing fits.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    candidates = [e for e in EXTRACTORS.values() if ext in e.extensions]
+    if not candidates:
+        candidates = [e for e in EXTRACTORS.values() if mime_type in e.mime_types]
+    if name:
+        if name not in EXTRACTORS:
+            raise ValueError(f"Unknown backend: {name}")
+        if EXTRACTORS[name] not in candidates:
+            raise ValueError(f"Backend {name} cannot read {ext or mime_type} files")
+        return EXTRACTORS[name]
+    if not candidates:
+        supported = ", ".join(sorted({ext for e in EXTRACTORS.values() for ext in e.extensions}))
+        raise ValueError(f"Unsupported file type. Supported: {supported}")
+    if default in EXTRACTORS and EXTRACTORS[default] in candidates:
+        return EXTRACTORS[default]
+    return candidates[0]
+
+
+def extract_pages(path, backend, start, stop):
+    """Return the text of pages [start, stop) of a file, as a list.  Runs in a worker."""
+    return list(EXTRACTORS[backend].iter_pages(path, start, stop))
+
+
+def join_pages(pages):
+    """Join page texts, return (text, character offset where each page starts)."""
+    page_offsets = []
+    offset = 0
+    for page in pages:
+        page_offsets.append(offset)
+        offset += len(page or '') + 1
+    text = "\n".join(page or '' for page in pages)
+    lead = len(text) - len(text.lstrip())
+    return text.strip(), [max(o - lead, 0) for o in page_offsets]
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+class ExtractionJob:
+    def __init__(self, job_id, path, backend, total):
+        self.id = job_id
+        self.path = path
+        self.backend = backend
+        self.pages_total = total
+        self.pages_done = 0
+        self.state = "running"
+        self.error = None
+        self.batches = []
+        self.submitted = 0
+        # Batches extracted ahead of an earlier one, {start page: pages}
+        self.waiting = {}
+        self.next_page = 0
+        self.normalizer = None
+        self.normalization = None
+        # The joined text so far: its length, whitespace not yet known to
+        # be trailing, leading whitespace dropped, and each page's offset
+        self.length = 0
+        self.held = ""
+        self.lead = 0
+        self.started = False
+        self.page_offsets = []
+        self.pieces = []
+        self.deliver_lock = threading.Lock()
+
+    def status(self):
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "backend": self.backend,
+            "pages_done": self.pages_done,
+            "pages_total": self.pages_total,
+            "error": self.error,
+            "normalization": self.normalization,
+        }
+
+    def join(self, pages):
+        """The next piece of join_pages(all pages)[0] that pages add."""
+        pieces = []
+        for page in pages:
+            separator = "\n" if self.page_offsets else ""
+            self.page_offsets.append(self.length + len(separator))
+            part = separator + page
+            self.length += len(part)
+            if not self.started:
+                stripped = part.lstrip()
+                self.lead += len(part) - len(stripped)
+                part = stripped
+                self.started = bool(part)
+            body = part.rstrip()
+            if body:
+                pieces.append(self.held + body)
+                self.held = part[len(body):]
+            else:
+                self.held += part
+        return "".join(pieces)
+
+    def offsets(self):
+        return [max(o - self.lead, 0) for o in self.page_offsets]
+
+
+class ExtractionJobs:
+    """Runs extraction jobs on a process pool and keeps their status.
+
+    With on_text, the document's text is passed to on_text(piece) as it
+    is extracted, a piece per batch, in order; once every page is in,
+    on_done(None, page_offsets) is called.  Without it, on_done(text,
+    page_offsets) gets the whole text.  Either runs on one of
+    finish_workers threads; on_error(message) is called if any batch
+    fails or a callback raises.  With normalize, the text is normalized
+    (chatbot.normalize) over a window of normalize_window pages when
+    streamed, over the whole document otherwise.
+    """
+
+    def __init__(self, workers=None, batch_pages=16, max_finished=1000, normalize=True, finish_workers=2,
+                 normalize_window=WINDOW_PAGES):
+        self.workers = workers or os.cpu_count() or 1
+        self.finish_workers = finish_workers
+        self.batch_pages = batch_pages
+        self.normalize = normalize
+        self.normalize_window = normalize_window
+        self.max_finished = max_finished
+        self.jobs = {}
+        self._finished = []
+        self._lock = threading.Lock()
+        self._pool_lock = threading.Lock()
+        self._pool = None
+        self._finisher = None
+        self._pid = None
+
+    def _executors(self):
+        # spawn rather than fork: the app process has writer threads running
+        with self._pool_lock:
+            if self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                self._finisher = ThreadPoolExecutor(self.finish_workers, thread_name_prefix="extraction-finish")
+                self._pid = os.getpid()
+            return self._pool, self._finisher
+
+    @property
+    def pool(self):
+        return self._executors()[0]
+
+    @property
+    def finisher(self):
+        # Normalizing, storing and indexing a document takes a while.  The
+        # pool's own result thread would hold up every other job's batches
+        # meanwhile, so that work runs here instead.
+        return self._executors()[1]
+
+    def submit(self, path, backend, on_done, on_error=None, job_id=None, on_text=None):
+        """Start extracting path, return the job id.
+
+        Pass job_id to know the id before on_done can possibly run.
+        """
+        if backend not in EXTRACTORS:
+            raise ValueError(f"Unknown extraction backend: {backend}")
+        # Formats without random access are read by a single worker and
+        # their page total is only known once it is done
+        total = EXTRACTORS[backend].page_count(path) if EXTRACTORS[backend].seekable else None
+        job = ExtractionJob(job_id or new_job_id(), path, backend, total)
+        if self.normalize:
+            job.normalizer = PageNormalizer(window=self.normalize_window if on_text else None)
+        with self._lock:
+            self.jobs[job.id] = job
+
+        if total == 0:
+            self.finisher.submit(self._deliver, job, on_done, on_error, on_text)
+            return job.id
+
+        if total is None:
+            job.batches = [(0, None)]
+        else:
+            job.batches = [(start, min(start + self.batch_pages, total))
+                           for start in range(0, total, self.batch_pages)]
+        # A few batches per worker are in flight; the rest are submitted as
+        # those come in, so batches waiting on an earlier one stay few
+        with self._lock:
+            batches = self._next_batches(job)
+        self._submit_batches(job, batches, on_done, on_error, on_text)
+        return job.id
+
+    def status(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return job.status() if job else None
+
+    def _next_batches(self, job):
+        # Batches taken but not yet delivered, waiting ones included
+        in_flight = job.submitted - job.next_page // self.batch_pages
+        count = max(0, min(2 * self.workers - in_flight, len(job.batches) - job.submitted))
+        job.submitted += count
+        return job.batches[job.submitted - count:job.submitted]
+
+    def _submit_batches(self, job, batches, on_done, on_error, on_text):
+        for start, stop in batches:
+            future = self.pool.submit(extract_pages, job.path, job.backend, start, stop)
+            future.add_done_callback(
+                lambda f, start=start: self._batch_done(job, start, f, on_done, on_error, on_text))
+
+    def _batch_done(self, job, start, future, on_done, on_error, on_text):
+        with self._lock:
+            if job.state != "running":
+                return
+            try:
+                texts = future.result()
+            except Exception as e:
+                job.state = "failed"
+                job.error = f"Error reading document: {str(e)}"
+                self._retire(job)
+                failed = True
+            else:
+                job.waiting[start] = texts
+                job.pages_done += len(texts)
+                if job.pages_total is None:
+                    job.pages_total = len(texts)
+                failed = False
+        if failed:
+            if on_error:
+                on_error(job.error)
+            return
+        self.finisher.submit(self._deliver, job, on_done, on_error, on_text)
+
+    def _deliver(self, job, on_done, on_error, on_text):
+        # Deliveries of a job run one at a time, each taking every batch
+        # that is next in page order, so pieces go out in order
+        with job.deliver_lock:
+            try:
+                while True:
+                    with self._lock:
+                        if job.state != "running":
+                            return
+                        pages = job.waiting.pop(job.next_page, None)
+                        if pages is None:
+                            done = job.next_page >= (job.pages_total or 0) and not job.waiting
+                            break
+                        job.next_page += len(pages)
+                        batches = self._next_batches(job)
+                    self._submit_batches(job, batches, on_done, on_error, on_text)
+                    self._send(job, job.normalizer.add(pages) if job.normalizer else pages, on_text)
+                if not done or job.state != "running":
+                    return
+                if job.normalizer:
+                    self._send(job, job.normalizer.finish(), on_text)
+                    job.normalization = job.normalizer.report
+                    metrics.NORMALIZATION_SAVED.inc(job.normalization["bytes_saved"], unit="bytes")
+                    metrics.NORMALIZATION_SAVED.inc(job.normalization["tokens_saved"], unit="tokens")
+                text = None if on_text else "".join(job.pieces)
+                job.pieces = []
+                on_done(text, job.offsets())
+            except Exception as e:
+                with self._lock:
+                    job.state = "failed"
+                    job.error = f"Error processing document: {str(e)}"
+                    self._retire(job)
+                if on_error:
+                    on_error(job.error)
+                return
+            with self._lock:
+                job.state = "done"
+                job.normalizer = None
+                self._retire(job)
+
+    def _send(self, job, pages, on_text):
+        piece = job.join(pages)
+        if not piece:
+            return
+        if on_text:
+            on_text(piece)
+        else:
+            job.pieces.append(piece)
+
+    def _retire(self, job):
+        # Keep the status of finished jobs around for polling, but not forever
+        self._finished.append(job.id)
+        while len(self._finished) > self.max_finished:
+            self.jobs.pop(self._finished.pop(0), None)
+
+    def shutdown(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(cancel_futures=True)
+            self._finisher.shutdown()
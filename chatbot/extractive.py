@@ -0,0 +1,349 @@
+"""Local answers to lookup questions, without an upstream call.
+
+Many questions about a syllabus or a resume look something up: the credits
+of a course, the email address on a resume.  The document holds the
+answer in a recognisable shape, and finding it locally takes milliseconds
+instead of a Gemini round trip.
+
+Each document is scanned once for facts: email addresses, phone numbers,
+links and "Label: value" lines.  A question none of those answers is
+matched against the document's passages with its retrieval index
+(chatbot.retrieval): the answer is the one sentence of the best scoring
+chunks that holds every word the question is about, weighted by how rare
+each word is in the document, and says something more.  Nothing in either
+depends on what kind of document it is.
+
+Course facts (code, title, credits) are opt-in (courses=True): they are
+read from curricula laid out like the bundled B.Tech one, codes of two
+digits, three letters and three digits ("23EEE201") in its table rows and
+"L-T-P-C: 3-1-0-4" headings, and no other.
+
+Only questions asking for a value ("what is ...", "give me ...",
+"credits of ...") are answered, and every answer comes with a confidence;
+only a fact or sentence found unambiguously (the one email address, the
+one sentence naming everything asked about) that covers everything the
+question is about is confident.  route() answers at or above the
+threshold and leaves everything else, including any question asking for
+an explanation, to the model.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+from chatbot.retrieval import tokenize
+
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+PHONE_RE = re.compile(r"(?<![\w/.-])\+?\d[\d ()-]{8,16}\d(?![\w/.-])")
+URL_RE = re.compile(r"(?:https?://|www\.)[^\s<>\"]+|\b(?:linkedin|github)\.com/[^\s<>\"]+", re.IGNORECASE)
+FIELD_RE = re.compile(r"([A-Za-z][A-Za-z /&().'-]{1,40}?)\s*:\s*(\S.{0,150})")
+CODE_RE = re.compile(r"\b\d{2}[A-Z]{3}\d{3}\b")
+CODE_LINE_RE = re.compile(r"((?:\d{2}[A-Z]{3}\d{3}/?)+)\s*(.*)")
+LTP_RE = re.compile(r"(\d{1,2})\s+(\d{1,2})\s+(\d{1,2})")
+LTPC_RE = re.compile(r"L\s*-\s*T\s*-\s*P\s*-\s*C\s*:\s*(\d+)\s*-\s*(\d+)\s*-\s*(\d+)\s*-\s*(\d+)")
+
+# Questions the model should answer even when a fact matches
+EXPLAIN_RE = re.compile(
+    r"\b(why|explain|describe|summari[sz]e|summary|compare|comparison|difference|discuss|elaborate|"
+    r"suggest|improve|rewrite|write|draft|opinion|evaluate|assess|should|could|would|if|"
+    r"how (?:do|does|did|can|is|are|was|to))\b", re.IGNORECASE)
+EMAIL_Q = re.compile(r"\be-?mails?\b|\bmail id\b", re.IGNORECASE)
+PHONE_Q = re.compile(r"\b(?:phone|mobile|contact number|cell number|telephone)\b", re.IGNORECASE)
+LINK_Q = re.compile(r"\b(linkedin|github|website|portfolio|url)\b", re.IGNORECASE)
+CREDITS_Q = re.compile(r"\bcredits?\b", re.IGNORECASE)
+CODE_Q = re.compile(r"\bcourse code\b|\bcode (?:of|for)\b", re.IGNORECASE)
+FIELD_Q = re.compile(r"(?:what|which)(?:'s| is| was) (?:the|his|her|their|my|your) (.+?)[\s?.!]*", re.IGNORECASE)
+# A question asking for a value, not whether or how something is mentioned
+LOOKUP_RE = re.compile(
+    r"\s*(?:what|which|give|show|tell me|list|find|get|how (?:many|much)|"
+    r"(?:the |his |her |their |your |my )?(?:e-?mail|mail id|phone|mobile|contact|telephone|cell|"
+    r"linkedin|github|website|portfolio|url|credits?|course code|code)\b)", re.IGNORECASE)
+MAX_QUESTION_WORDS = 25
+# Passage answers: chunks searched, the longest sentence that is an answer
+PASSAGE_CHUNKS = 3
+MAX_PASSAGE_CHARS = 300
+SENTENCE_RE = re.compile(r"(?<=[.!?;])\s+")
+
+# Words that say what is asked rather than what it is about
+QUESTION_WORDS = set("""
+a an and any are as at be by can carry carries code count course courses credit credits do does for from get give
+has have his her how in is it its listed many me mentioned much my number of offered on or paper please show
+subject tell that the their there this to total what which with worth your
+""".split())
+
+
+# What an answer of each kind covers; other words in the question ("email
+# etiquette") mean it asks about something else
+FACT_WORDS = {
+    "email": {"email", "emails", "e", "mail", "id", "address", "addresses"},
+    "phone": {"phone", "mobile", "contact", "cell", "telephone", "numbers"},
+    "link": {"linkedin", "github", "website", "portfolio", "url", "link", "links", "profile", "page"},
+}
+# Words naming the document or its subject, which every fact is about
+DOCUMENT_WORDS = {"document", "resume", "cv", "file", "pdf", "he", "she", "they", "him", "them", "person",
+                  "candidate", "listed", "mentioned", "given", "here"}
+# Words that say nothing about what a question asks for, whatever the document
+STOP_WORDS = set("""
+a an and any are as at be by can did do does for from get give had has have how i in is it its many me much my
+of on or please show tell that the their there this to was were what when where which who with you your
+""".split())
+
+
+def content_words(text):
+    return {token for token in tokenize(text) if token not in QUESTION_WORDS}
+
+
+class DocumentFacts:
+    """Everything a document says that a lookup question can be answered from."""
+
+    def __init__(self, text, courses=False):
+        lines = [line.strip() for line in text.splitlines()]
+        # The address patterns are slow to try at every position of a long
+        # document, so only lines that can hold one are searched
+        self.emails = unique(email for line in lines if "@" in line for email in EMAIL_RE.findall(line))
+        self.phones = unique(" ".join(match.split()) for match in PHONE_RE.findall(text)
+                             if 10 <= sum(c.isdigit() for c in match) <= 13)
+        self.links = unique(url.rstrip(".,;)") for line in lines
+                            if "www." in line or "://" in line or ".com/" in line for url in URL_RE.findall(line))
+        # {label words: [values]} of "Label: value" lines
+        self.fields = {}
+        for line in lines:
+            match = FIELD_RE.fullmatch(line)
+            if match:
+                label = frozenset(content_words(match.group(1)))
+                if label:
+                    self.fields.setdefault(label, []).append(match.group(2).strip())
+        # {code: {"titles": set, "credits": {credits: "L-T-P"}}}
+        self.courses = {}
+        if courses:
+            self._read_table(lines)
+            self._read_headings(lines)
+
+    def _course(self, code, title, credits, ltp):
+        course = self.courses.setdefault(code, {"titles": set(), "credits": {}})
+        # Footnote marks: "Machine Learning ##", "SMART GRID+"
+        title = " ".join(title.split()).strip(" -:#+*")
+        if title:
+            course["titles"].add(title)
+        course["credits"].setdefault(credits, ltp)
+
+    def _read_table(self, lines):
+        # Curriculum rows: code, title over a few lines, "L T P", credits
+        for i, line in enumerate(lines):
+            match = CODE_LINE_RE.fullmatch(line)
+            if not match:
+                continue
+            title = [match.group(2)]
+            for j in range(i + 1, min(i + 6, len(lines) - 1)):
+                ltp = LTP_RE.fullmatch(lines[j])
+                if ltp and lines[j + 1].isdigit():
+                    for code in CODE_RE.findall(match.group(1)):
+                        self._course(code, " ".join(title), int(lines[j + 1]), "-".join(ltp.groups()))
+                    break
+                if not lines[j] or CODE_RE.search(lines[j]) or lines[j].isdigit():
+                    break
+                title.append(lines[j])
+
+    def _read_headings(self, lines):
+        # Syllabus headings: "23ENG101" / "TECHNICAL COMMUNICATION L-T-P-C: 2-0-3-3"
+        for i, line in enumerate(lines):
+            match = LTPC_RE.search(line)
+            if not match:
+                continue
+            title = [line[:match.start()]]
+            for j in range(i - 1, max(i - 5, -1), -1):
+                code = CODE_LINE_RE.fullmatch(lines[j])
+                if code:
+                    title.insert(0, code.group(2))
+                    *ltp, credits = match.groups()
+                    for found in CODE_RE.findall(code.group(1)):
+                        self._course(found, " ".join(title), int(credits), "-".join(ltp))
+                    break
+                if LTPC_RE.search(lines[j]):
+                    break
+                title.insert(0, lines[j])
+
+    def find_course(self, question):
+        """(code, confidence) of the course the question names, or (None, 0)."""
+        codes = [code for code in CODE_RE.findall(question.upper()) if code in self.courses]
+        if len(set(codes)) == 1:
+            return codes[0], 1.0
+        asked = content_words(question)
+        if not asked:
+            return None, 0.0
+        scored = []
+        for code, course in self.courses.items():
+            best = 0.0
+            for title in course["titles"]:
+                words = content_words(title)
+                overlap = len(asked & words)
+                if words and overlap:
+                    # The question names the whole title and nothing else
+                    best = max(best, overlap / len(words) * overlap / len(asked))
+            if best:
+                scored.append((best, code))
+        if not scored:
+            return None, 0.0
+        scored.sort(reverse=True)
+        score, code = scored[0]
+        if len(scored) > 1 and scored[1][0] == score:
+            # Two courses fit the question equally well
+            return code, score / 2
+        return code, score
+
+
+def unique(values):
+    seen = []
+    for value in values:
+        if value not in seen:
+            seen.append(value)
+    return seen
+
+
+def listed(values, confident=3):
+    """Confidence in answering with all of values: one is sure, a few less so."""
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return 0.95
+    return 0.85 if len(values) <= confident else 0.3
+
+
+class LocalAnswerer:
+    """Answers lookup questions from a document's facts and passages.
+
+    Facts are found once per document and kept for the max_documents most
+    recently asked about, keyed by the document's fingerprint.  courses
+    turns on course facts for curricula laid out like the bundled one.
+    """
+
+    def __init__(self, threshold=0.8, max_documents=64, courses=False):
+        self.threshold = threshold
+        self.max_documents = max_documents
+        self.courses = courses
+        self.local = 0
+        self.upstream = 0
+        self._facts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def facts(self, text, key=None):
+        if key is None:
+            return DocumentFacts(text, self.courses)
+        with self._lock:
+            facts = self._facts.get(key)
+            if facts is not None:
+                self._facts.move_to_end(key)
+                return facts
+        facts = DocumentFacts(text, self.courses)
+        with self._lock:
+            self._facts[key] = facts
+            while len(self._facts) > self.max_documents:
+                self._facts.popitem(last=False)
+        return facts
+
+    def answer(self, question, text, key=None, index=None):
+        """Return (answer or None, confidence, kinds of fact used).
+
+        index is the document's DocumentIndex; without it only facts are
+        looked up.
+        """
+        question = question or ""
+        if (not text or not LOOKUP_RE.match(question) or EXPLAIN_RE.search(question)
+                or len(question.split()) > MAX_QUESTION_WORDS):
+            return None, 0.0, []
+        facts = self.facts(text, key)
+        parts = []
+        if EMAIL_Q.search(question):
+            parts.append(("email", f"Email: {', '.join(facts.emails)}", listed(facts.emails)))
+        if PHONE_Q.search(question):
+            parts.append(("phone", f"Phone: {', '.join(facts.phones)}", listed(facts.phones, confident=2)))
+        link = LINK_Q.search(question)
+        if link:
+            site = link.group(1).lower()
+            links = [url for url in facts.links if site not in ("linkedin", "github") or site in url.lower()]
+            parts.append(("link", f"Link: {', '.join(links)}", listed(links, confident=2)))
+        if self.courses and (CREDITS_Q.search(question) or CODE_Q.search(question)):
+            parts.append(self._course_answer(facts, question))
+        if not parts:
+            field = FIELD_Q.fullmatch(question.strip())
+            if field:
+                parts.append(self._field_answer(facts, field.group(1)))
+            if index is not None and not (parts and parts[0][2]):
+                parts = [self._passage_answer(index, question)]
+        if not parts:
+            return None, 0.0, []
+        kinds = [part[0] for part in parts]
+        confidence = min(part[2] for part in parts)
+        if all(kind in FACT_WORDS for kind in kinds):
+            # Course, field and passage answers already score how much of
+            # the question they cover
+            asked = content_words(question) - DOCUMENT_WORDS
+            if asked:
+                covered = set().union(*(FACT_WORDS[kind] for kind in kinds))
+                confidence *= len(asked & covered) / len(asked)
+        return "\n".join(part[1] for part in parts), confidence, kinds
+
+    def _course_answer(self, facts, question):
+        code, confidence = facts.find_course(question)
+        if code is None:
+            return "course", "", 0.0
+        course = facts.courses[code]
+        # The curriculum table's "Signals & Systems" reads better than a heading's capitals
+        title = max(course["titles"], key=lambda t: (not t.isupper(), len(t))) if course["titles"] else ""
+        name = f"{code} {title}".strip()
+        if CODE_Q.search(question) and not CREDITS_Q.search(question):
+            return "course", f"The course code of {title or 'that course'} is {code}.", confidence
+        credits = sorted(course["credits"])
+        if len(credits) > 1:
+            # The document disagrees with itself
+            confidence /= 2
+        ltp = course["credits"][credits[0]]
+        return "course", f"{name}: {credits[0]} credits (L-T-P {ltp}).", confidence
+
+    def _field_answer(self, facts, label):
+        values = unique(facts.fields.get(frozenset(content_words(label)), []))
+        if len(values) != 1:
+            return "field", "", 0.0
+        return "field", values[0], 0.9
+
+    def _passage_answer(self, index, question):
+        asked = set(tokenize(question)) - STOP_WORDS - DOCUMENT_WORDS
+        scores = index.scores(question)
+        if not asked or not len(scores) or scores.max() <= 0:
+            return "passage", "", 0.0
+        # A word the document never uses weighs the most: the question is
+        # about something it does not say
+        weights = {term: index.idf(term) for term in asked}
+        total = sum(weights.values())
+        coverage = {}
+        for chunk_id in sorted(range(len(scores)), key=lambda i: -scores[i])[:PASSAGE_CHUNKS]:
+            if scores[chunk_id] <= 0:
+                break
+            for line in index.chunks[chunk_id].splitlines():
+                for sentence in SENTENCE_RE.split(line):
+                    words = set(tokenize(sentence))
+                    # A heading only repeats the question
+                    if words - asked - STOP_WORDS and len(sentence) <= MAX_PASSAGE_CHARS:
+                        coverage[sentence.strip()] = sum(weights[term] for term in asked & words) / total
+        ranked = sorted(coverage.items(), key=lambda item: -item[1])
+        if not ranked:
+            return "passage", "", 0.0
+        sentence, score = ranked[0]
+        if len(ranked) > 1 and ranked[1][1] == score:
+            # Two sentences fit the question equally well
+            score /= 2
+        return "passage", sentence, score * 0.95
+
+    def route(self, question, text, key=None, index=None):
+        """The local answer if it is confident enough, else None for upstream."""
+        answer, confidence, _ = self.answer(question, text, key, index)
+        with self._lock:
+            if answer is not None and confidence >= self.threshold:
+                self.local += 1
+                return answer
+            self.upstream += 1
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {"local": self.local, "upstream": self.upstream, "documents": len(self._facts),
+                    "threshold": self.threshold, "courses": self.courses}
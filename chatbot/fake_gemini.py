@@ -0,0 +1,178 @@
+"""A local stand-in for the Gemini generateContent API.
+
+Used by the benchmarks so they never spend quota or depend on the network.
+It can also be run on its own and pointed at with GEMINI_BASE_URL:
+
+    python -m chatbot.fake_gemini --port 8090 --latency 0.3
+"""
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open hundreds of connections at once
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clients that time out on purpose hang up mid-reply; not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeGemini:
+    """Threaded HTTP server answering every generateContent call.
+
+    latency is a fixed delay per call and per_kb_latency an extra delay per
+    KiB of request body, roughly modelling the upstream cost of big prompts.
+    """
+
+    def __init__(self, latency=0.05, per_kb_latency=0.0, reply_chars=400, host="127.0.0.1", port=0,
+                 stream_chunks=8, stream_delay=0.01):
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.stream_delay = stream_delay
+        self.per_kb_latency = per_kb_latency
+        self.reply_chars = reply_chars
+        self.requests = 0
+        self.bytes_received = 0
+        self.connections = 0
+        self._statuses = []
+        self._lock = threading.Lock()
+        self._server = Server((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_received = 0
+            self.connections = 0
+
+    def fail_next(self, *statuses):
+        """Answer the next len(statuses) calls with these error statuses."""
+        with self._lock:
+            self._statuses.extend(statuses)
+
+    def _next_status(self):
+        with self._lock:
+            return self._statuses.pop(0) if self._statuses else 200
+
+    def reply_text(self, prompt):
+        words = ("This is a canned answer from the fake Gemini server. " * (self.reply_chars // 50 + 1))
+        return words[:self.reply_chars]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body are written separately; don't let Nagle
+                # and delayed ACKs add 40ms to every kept-alive response
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with fake._lock:
+                    fake.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                with fake._lock:
+                    fake.requests += 1
+                    fake.bytes_received += length
+                time.sleep(fake.latency + fake.per_kb_latency * length / 1024)
+
+                status = fake._next_status()
+                if status != 200:
+                    self._send(status, {"error": {"code": status, "message": "Injected failure"}})
+                    return
+
+                try:
+                    payload = json.loads(body or b"{}")
+                    prompt = payload["contents"][-1]["parts"][0]["text"]
+                except (ValueError, KeyError, IndexError):
+                    self._send(400, {"error": {"message": "Invalid JSON payload"}})
+                    return
+
+                if ":streamGenerateContent" in self.path:
+                    self._stream(fake.reply_text(prompt))
+                    return
+                self._send(200, candidate(fake.reply_text(prompt)))
+
+            def _stream(self, text):
+                # Server-sent events over a chunked response, like ?alt=sse
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                size = max(len(text) // fake.stream_chunks, 1)
+                for i in range(0, len(text), size):
+                    event = f"data: {json.dumps(candidate(text[i:i + size]))}\r\n\r\n".encode()
+                    self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                    self.wfile.flush()
+                    time.sleep(fake.stream_delay)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _send(self, status, data):
+                out = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+        return Handler
+
+
+def candidate(text):
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Gemini API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--per-kb-latency", type=float, default=0.0)
+    parser.add_argument("--reply-chars", type=int, default=400)
+    args = parser.parse_args()
+
+    fake = FakeGemini(args.latency, args.per_kb_latency, args.reply_chars, args.host, args.port)
+    print(f"Fake Gemini listening on {fake.url}")
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
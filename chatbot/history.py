@@ -0,0 +1,411 @@
+"""Chat history store on top of the Django ChatHistory model.
+
+The Flask service and the Django site share one table
+(techjays.models.ChatHistory) in the project database.  Writes are queued
+and a background writer thread inserts them with bulk_create in batches,
+so a /chat request never pays for a round trip and commit of its own.
+Reads flush the queue first, so they always see earlier writes.  A batch
+that fails is retried with backoff, then written a row at a time, so one
+bad row costs only itself; rows that still fail are logged and counted
+in chatbot_history_write_errors_total.
+
+Rows are scoped by user (None for the Flask service, which has no logins)
+and session.  Reads page through a session by row id, on the (user,
+session_id, id) index, and version() gives a cheap fingerprint of a
+session's history for conditional requests.
+
+For moving history between nodes, export() streams any slice of the table
+(a user, a session, a date range) that iter_jsonl_gz() turns into gzipped
+JSON Lines, and import_rows() loads such an archive back in batched
+transactions.
+
+Outside a Django process, django.setup() must run before this is imported.
+"""
+import atexit
+import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+from django.contrib.auth.models import User
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from chatbot import metrics
+from techjays.models import ChatHistory
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per query when streaming a whole history
+STREAM_BATCH = 500
+# Rows inserted per transaction by import_rows()
+IMPORT_BATCH = 2000
+
+
+class HistoryStore:
+    """Queued, batched writer plus indexed reads for ChatHistory.
+
+    flush_interval is the longest a queued message waits before it is
+    committed and batch_size the most rows written per bulk_create; together
+    they trade durability on a crash for fewer commits under load.  A failed
+    bulk_create is tried retries more times, retry_backoff seconds apart and
+    doubling, before the batch is written row by row.
+    """
+
+    def __init__(self, flush_interval=0.05, batch_size=200, retries=3, retry_backoff=0.1):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._pid = None
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writer = None
+
+    def _ensure_open(self):
+        # One writer per process, restarted after a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def add(self, session_id, role, message, user_id=None):
+        self._ensure_open()
+        self._queue.put(ChatHistory(user_id=user_id, session_id=session_id, role=role, message=message))
+
+    def flush(self):
+        """Block until everything queued so far has been written.
+
+        Returns False if some of it could not be (see _write()).
+        """
+        self._ensure_open()
+        done = FlushRequest()
+        self._queue.put(done)
+        done.wait()
+        return done.ok
+
+    def history(self, session_id, user_id=None):
+        """Return [(role, message), ...] for a session, oldest first."""
+        return [(role, message) for _, role, message in self.iter_rows(session_id, user_id=user_id)]
+
+    def page(self, session_id, since=None, before=None, limit=None, user_id=None):
+        """Return [(id, role, message), ...], oldest first.
+
+        since and before are exclusive row id cursors.  Without since the
+        page is the newest `limit` rows (before `before`, if given), so a
+        client can show the latest messages and walk backwards from there.
+        """
+        self.flush()
+        return self._page(session_id, user_id, since, before, limit)
+
+    def iter_rows(self, session_id, since=None, before=None, limit=None, batch=STREAM_BATCH, user_id=None):
+        """Yield (id, role, message) rows in id order, a batch per query.
+
+        No cursor is held open between batches, so a long export does not
+        pin a database connection or a transaction.
+        """
+        self.flush()
+        while limit is None or limit > 0:
+            size = batch if limit is None else min(batch, limit)
+            rows = self._page(session_id, user_id, since, before, size, newest=False)
+            yield from rows
+            if len(rows) < size:
+                return
+            since = rows[-1][0]
+            if limit is not None:
+                limit -= len(rows)
+
+    def json_chunks(self, session_id, since=None, before=None, limit=None, user_id=None):
+        """The JSON response body for a history request, in chunks.
+
+        Without a limit the whole history is streamed; with one, it is a
+        single page.
+        """
+        if limit is None:
+            return iter_json(self.iter_rows(session_id, since, before, user_id=user_id))
+        return iter_json(self.page(session_id, since, before, limit, user_id=user_id))
+
+    def version(self, session_id, user_id=None):
+        """Fingerprint that changes whenever the session's history does."""
+        self.flush()
+        stats = ChatHistory.objects.filter(user_id=user_id, session_id=session_id).aggregate(
+            last_id=Max("id"), count=Count("id"))
+        return f"{stats['last_id'] or 0}-{stats['count']}"
+
+    def sessions(self, user_id):
+        """Return [(session_id, last message time), ...], most recent first."""
+        self.flush()
+        rows = (ChatHistory.objects.filter(user_id=user_id).values("session_id")
+                .annotate(last=Max("timestamp")).order_by("-last"))
+        return [(row["session_id"], row["last"]) for row in rows]
+
+    def export(self, batch=STREAM_BATCH, **filters):
+        """Yield every row matching the ChatHistory filters, as export dicts.
+
+        Rows come in id order, a batch per query keyed on the last id, so
+        memory stays flat and no cursor is held between batches.
+        """
+        self.flush()
+        rows = ChatHistory.objects.filter(**filters).order_by("id").values_list(
+            "id", "user__username", "session_id", "role", "message", "timestamp")
+        last = 0
+        while True:
+            page = list(rows.filter(id__gt=last)[:batch])
+            for row_id, user, session_id, role, message, stamp in page:
+                yield {"id": row_id, "user": user, "session_id": session_id, "role": role,
+                       "message": message, "timestamp": stamp.isoformat() if stamp else None}
+            if len(page) < batch:
+                return
+            last = page[-1][0]
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._pid = None
+
+    def _page(self, session_id, user_id, since, before, limit, newest=None):
+        rows = ChatHistory.objects.filter(user_id=user_id, session_id=session_id)
+        if since is not None:
+            rows = rows.filter(id__gt=since)
+        if before is not None:
+            rows = rows.filter(id__lt=before)
+        # Paging backwards takes the rows nearest the cursor, then flips them
+        if newest is None:
+            newest = since is None
+        rows = rows.order_by("-id" if newest else "id").values_list("id", "role", "message")
+        if limit is not None:
+            rows = rows[:limit]
+        rows = list(rows)
+        return rows[::-1] if newest else rows
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            batch = []
+            waiters = []
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, FlushRequest):
+                    # A flush() call: commit what we have right away
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+            ok = self._write(batch) if batch else True
+            for waiter in waiters:
+                waiter.ok = ok
+                waiter.set()
+            if stop:
+                close_old_connections()
+                return
+
+    def _write(self, batch):
+        """Insert a batch; returns False if any row could not be written."""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                metrics.HISTORY_WRITE_ERRORS.inc(kind="retry")
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            # The writer thread keeps its own connection; drop it once it is
+            # older than CONN_MAX_AGE or broken, as Django does per request
+            close_old_connections()
+            try:
+                ChatHistory.objects.bulk_create(batch, batch_size=self.batch_size)
+                return True
+            except Exception as e:
+                logger.warning("Error writing %d chat history rows (attempt %d): %s", len(batch), attempt + 1, e)
+
+        # Still failing: keep every row that can be written
+        ok = True
+        for row in batch:
+            try:
+                row.save()
+            except Exception:
+                logger.exception("Dropped a chat history row for session %s", row.session_id)
+                metrics.HISTORY_WRITE_ERRORS.inc(kind="dropped")
+                ok = False
+        return ok
+
+
+class FlushRequest(threading.Event):
+    """Queued by flush(); ok tells the caller whether the write succeeded."""
+    ok = True
+
+
+def history_query(args, page_max=1000):
+    """Parse (since, before, limit) from query arguments.
+
+    Raises ValueError for values that are not integers.
+    """
+    since, before, limit = (int(args[name]) if args.get(name) else None for name in ("since", "before", "limit"))
+    if limit is not None:
+        limit = max(1, min(limit, page_max))
+    return since, before, limit
+
+
+def history_etag(version, *params):
+    """Strong ETag for one view (version + query parameters) of a history."""
+    raw = ":".join(str(p) for p in (version,) + params)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def iter_json(rows, batch=STREAM_BATCH):
+    """Encode (id, role, message) rows as a JSON array, a chunk per batch.
+
+    The whole array is never built in memory, so exports of any length are
+    sent with flat memory use.
+    """
+    yield "["
+    first = True
+    chunk = []
+    for row_id, role, message in rows:
+        item = json.dumps({"id": row_id, "role": role, "text": message})
+        chunk.append(item if first else "," + item)
+        first = False
+        if len(chunk) >= batch:
+            yield "".join(chunk)
+            chunk = []
+    yield "".join(chunk) + "]"
+
+
+def parse_when(value):
+    """An aware datetime from "2025-05-01" or "2025-05-01T12:00:00[+05:30]".
+
+    Dates mean midnight UTC; raises ValueError for anything else.
+    """
+    when = parse_datetime(value)
+    if when is None and parse_date(value) is not None:
+        when = parse_datetime(value + "T00:00:00")
+    if when is None:
+        raise ValueError(f"Not a date: {value}")
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when, datetime.timezone.utc)
+    return when
+
+
+def export_filters(args):
+    """ChatHistory filters for the ?since= / ?until= of an export request."""
+    filters = {}
+    if args.get("since"):
+        filters["timestamp__gte"] = parse_when(args["since"])
+    if args.get("until"):
+        filters["timestamp__lt"] = parse_when(args["until"])
+    return filters
+
+
+def iter_jsonl_gz(rows, level=6, chunk_bytes=256 * 1024):
+    """Encode export rows as gzip-compressed JSON Lines, a chunk at a time."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip framing
+    lines = []
+    size = 0
+    for row in rows:
+        line = (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            data = compressor.compress(b"".join(lines))
+            lines, size = [], 0
+            if data:
+                yield data
+    yield compressor.compress(b"".join(lines)) + compressor.flush()
+
+
+def read_jsonl(lines):
+    """Export rows from JSON Lines (str or bytes), skipping blank lines."""
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def legacy_rows(path):
+    """Rows of the old chat_session.db chat_history table, as export dicts.
+
+    That table has no users or times; rows keep their insertion order.
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        for session_id, role, message in conn.execute(
+                'SELECT session_id, role, message FROM chat_history ORDER BY rowid'):
+            yield {"user": None, "session_id": session_id, "role": role, "message": message, "timestamp": None}
+    finally:
+        conn.close()
+
+
+def import_rows(rows, batch_size=IMPORT_BATCH):
+    """Insert export rows into ChatHistory; returns (imported, skipped).
+
+    Each batch is one transaction and one executemany, without building
+    model instances.  Row ids are not kept (they would collide with the
+    target's own), and users are matched by username; rows of users the
+    target does not have are skipped.  Rows without a timestamp get the
+    current time.
+    """
+    meta = ChatHistory._meta
+    fields = [meta.get_field(name) for name in ("user", "session_id", "role", "message", "timestamp")]
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        connection.ops.quote_name(meta.db_table),
+        ", ".join(connection.ops.quote_name(field.column) for field in fields),
+        ", ".join(["%s"] * len(fields)))
+    timestamp = fields[-1]
+    users = {None: None}
+    imported = skipped = 0
+    batch = []
+
+    def write():
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, batch)
+
+    for row in rows:
+        username = row.get("user")
+        if username not in users:
+            users[username] = User.objects.filter(username=username).values_list("id", flat=True).first()
+        user_id = users[username]
+        if username is not None and user_id is None:
+            skipped += 1
+            continue
+        stamp = parse_when(row["timestamp"]) if row.get("timestamp") else timezone.now()
+        batch.append((user_id, row["session_id"], row["role"], row["message"],
+                      timestamp.get_db_prep_save(stamp, connection)))
+        if len(batch) >= batch_size:
+            write()
+            imported += len(batch)
+            batch = []
+    if batch:
+        write()
+        imported += len(batch)
+    return imported, skipped
+
+
+def open_store(flush_interval=0.05, batch_size=200):
+    store = HistoryStore(flush_interval, batch_size)
+    # Start the writer at startup rather than on the first request
+    store._ensure_open()
+    atexit.register(store.close)
+    return store
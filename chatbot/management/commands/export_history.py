@@ -0,0 +1,58 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.history import parse_when
+
+
+class Command(BaseCommand):
+    help = "Write chat history as gzipped JSON Lines, for import_history on another node."
+
+    def add_arguments(self, parser):
+        parser.add_argument("-o", "--output", default="-", help="file to write (default: stdout)")
+        parser.add_argument("--user", help="only this user (username)")
+        parser.add_argument("--anonymous", action="store_true", help="only history of the Flask service")
+        parser.add_argument("--session", help="only this session id")
+        parser.add_argument("--since", help="messages at or after this date/time")
+        parser.add_argument("--until", help="messages before this date/time")
+        parser.add_argument("--level", type=int, default=6, help="gzip level, 1 (fast) to 9 (small)")
+
+    def handle(self, *args, **options):
+        from chatbot import chat
+        from chatbot.history import iter_jsonl_gz
+
+        filters = {}
+        if options["user"]:
+            user = User.objects.filter(username=options["user"]).first()
+            if user is None:
+                raise CommandError(f"No such user: {options['user']}")
+            filters["user"] = user
+        elif options["anonymous"]:
+            filters["user__isnull"] = True
+        if options["session"]:
+            filters["session_id"] = options["session"]
+        try:
+            if options["since"]:
+                filters["timestamp__gte"] = parse_when(options["since"])
+            if options["until"]:
+                filters["timestamp__lt"] = parse_when(options["until"])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        rows = 0
+
+        def counted(export):
+            nonlocal rows
+            for row in export:
+                rows += 1
+                yield row
+
+        output = sys.stdout.buffer if options["output"] == "-" else open(options["output"], "wb")
+        try:
+            for data in iter_jsonl_gz(counted(chat.history_store.export(**filters)), options["level"]):
+                output.write(data)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        self.stderr.write(f"Exported {rows} messages")
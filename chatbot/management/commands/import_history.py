@@ -0,0 +1,35 @@
+import gzip
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot.history import IMPORT_BATCH, import_rows, legacy_rows, read_jsonl
+
+
+class Command(BaseCommand):
+    help = "Load chat history written by export_history (or the old chat_session.db) into ChatHistory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="gzipped JSON Lines archives (.jsonl.gz) or .jsonl files")
+        parser.add_argument("--legacy", action="store_true",
+                            help="the paths are SQLite files with the old chat_history table")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH, help="rows per transaction")
+
+    def handle(self, *args, **options):
+        total = skipped = 0
+        started = time.perf_counter()
+        for path in options["paths"]:
+            if options["legacy"]:
+                imported, missing = import_rows(legacy_rows(path), options["batch_size"])
+            else:
+                opener = gzip.open if path.endswith(".gz") else open
+                with opener(path, "rt", encoding="utf-8") as lines:
+                    imported, missing = import_rows(read_jsonl(lines), options["batch_size"])
+            self.stdout.write(f"{path}: {imported} messages" + (f", {missing} skipped" if missing else ""))
+            total += imported
+            skipped += missing
+        elapsed = time.perf_counter() - started
+        if skipped:
+            self.stderr.write(f"Skipped {skipped} messages of users that do not exist here")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {total} messages in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s)"))
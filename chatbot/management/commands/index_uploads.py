@@ -0,0 +1,43 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from chatbot.docstore import file_digest
+from chatbot.extraction import choose_extractor, join_pages
+from chatbot.normalize import normalize_pages
+from techjays.models import UploadedFile
+
+
+class Command(BaseCommand):
+    help = "Add every UploadedFile to its owner's corpus index (files already indexed are skipped)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="only this user id")
+
+    def handle(self, *args, **options):
+        from chatbot import chat
+
+        uploads = UploadedFile.objects.select_related("user").order_by("id")
+        if options["user"]:
+            uploads = uploads.filter(user_id=options["user"])
+        added = 0
+        for upload in uploads.iterator():
+            path = upload.file.path
+            if not os.path.exists(path):
+                self.stderr.write(f"missing: {upload.file.name}")
+                continue
+            try:
+                extractor = choose_extractor(os.path.basename(path))
+            except ValueError as e:
+                self.stderr.write(f"skipped {upload.file.name}: {e}")
+                continue
+            digest = file_digest(path)
+            corpus = chat.corpus_indexes.get(upload.user_id)
+            if digest in corpus:
+                continue
+            pages, _ = normalize_pages(list(extractor.iter_pages(path)))
+            text, _ = join_pages(pages)
+            chunks = corpus.add(digest, os.path.basename(path), text)
+            added += 1
+            self.stdout.write(f"{upload.user.username}: {upload.file.name} ({chunks} chunks)")
+        self.stdout.write(self.style.SUCCESS(f"Indexed {added} documents"))
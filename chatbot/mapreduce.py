@@ -0,0 +1,166 @@
+"""Map-reduce answering for documents that do not fit in one prompt.
+
+The document is cut into shards that each fit the model's window, and the
+question is put to every shard at once, a few calls at a time (map).
+Shards that hold nothing relevant answer NONE; the others' partial answers,
+in document order, become the context of the ordinary answer call, which
+combines them (reduce) and can be streamed like any other answer.
+
+Shards are asked in order of how many of the question's words they
+contain, and once `enough` of them have answered the rest are never
+asked: most questions are about a few places in a document, and the rest
+of the shards would only cost time and quota.  A call cannot be taken
+back once it is made, so no more calls are in flight than answers are
+still needed; none is paid for and then thrown away.
+
+Retrieval (chatbot.retrieval) answers most questions about a long
+document from a few passages, but not those about all of it: summaries,
+"list all ...".  asks_about_whole_document() tells those apart.
+"""
+import math
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from chatbot import metrics
+from chatbot.retrieval import split_chunks, tokenize
+from chatbot.upstream import CircuitOpenError
+
+NO_EVIDENCE = "NONE"
+
+MAP_PROMPT = (
+    "Below is part {part} of {parts} of a long document.\n"
+    "Answer the question using only this part. Quote names, numbers and\n"
+    "headings exactly. If this part has nothing that helps answer it,\n"
+    f"reply with exactly {NO_EVIDENCE}.\n\n"
+    "Part {part}:\n{shard}\n\n"
+    "Question: {question}"
+)
+REDUCE_HEADER = (
+    "The document is too long to include. Answers to the question were\n"
+    "found in these parts of it; combine them into one answer."
+)
+NOTHING_FOUND = "The document was searched part by part and none of it answers the question."
+
+
+WHOLE_DOCUMENT_RE = re.compile(
+    r"\b(summar(y|ise|ize|ies)|overview|outline|main (points|topics|ideas)|key (points|takeaways)"
+    r"|(list|name|enumerate) (all|every|each)|all (the|of the)|every|each of"
+    r"|(whole|entire|full) (document|file|text|syllabus|pdf)|throughout|overall)\b", re.IGNORECASE)
+
+
+def asks_about_whole_document(question):
+    """True for questions no handful of passages can answer."""
+    return WHOLE_DOCUMENT_RE.search(question or "") is not None
+
+
+def rank_shards(question, shards):
+    """Shard indexes, most promising first, scored by rare question words."""
+    terms = set(tokenize(question))
+    counts = [Counter(t for t in tokenize(shard) if t in terms) for shard in shards]
+    containing = Counter(t for c in counts for t in c)
+    weights = {t: math.log(1 + len(shards) / containing[t]) for t in containing}
+    scores = [sum(weights[t] * (1 + math.log(n)) for t, n in c.items()) for c in counts]
+    return sorted(range(len(shards)), key=lambda i: -scores[i])
+
+
+def is_relevant(answer):
+    return bool(answer) and answer.strip().rstrip(".").upper() != NO_EVIDENCE
+
+
+class MapReduce:
+    """Fans a question out over the shards of a text.
+
+    generate(prompt) is the blocking upstream call.  At most concurrency
+    calls run at once for one question; enough=0 waits for every shard.
+    """
+
+    def __init__(self, generate, shard_chars, concurrency=4, enough=3, overlap_chars=1000):
+        self.generate = generate
+        self.shard_chars = shard_chars
+        self.concurrency = concurrency
+        self.enough = enough
+        self.overlap_chars = overlap_chars
+        self.last_run = None
+        self._lock = threading.Lock()
+
+    def shards(self, text):
+        return split_chunks(text, self.shard_chars, self.overlap_chars)
+
+    def map(self, question, text):
+        """Return ([(shard index, partial answer), ...] in document order, stats)."""
+        shards = self.shards(text)
+        started = time.perf_counter()
+        order = iter(rank_shards(question, shards))
+        pool = ThreadPoolExecutor(max_workers=max(1, self.concurrency), thread_name_prefix="map")
+        pending = {}
+        partials = []
+        answered = 0
+        failed = 0
+        error = None
+
+        def ask_more():
+            # With enough set, each call in flight could be the one that
+            # completes the answer; more would be paid for and not read
+            limit = max(1, self.concurrency)
+            if self.enough:
+                limit = min(limit, self.enough - len(partials))
+            while len(pending) < limit:
+                i = next(order, None)
+                if i is None:
+                    return
+                pending[pool.submit(self.generate, MAP_PROMPT.format(
+                    part=i + 1, parts=len(shards), shard=shards[i], question=question))] = i
+
+        try:
+            ask_more()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    try:
+                        answer = future.result()
+                    except CircuitOpenError:
+                        raise
+                    except Exception as e:
+                        # One unreadable shard should not sink the answer
+                        failed += 1
+                        error = e
+                        print("Error answering from document part:", str(e))
+                        continue
+                    answered += 1
+                    if is_relevant(answer):
+                        partials.append((i, answer.strip()))
+                if self.enough and len(partials) >= self.enough:
+                    break
+                ask_more()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if shards and failed == len(shards):
+            raise error
+
+        stats = {
+            "shards": len(shards),
+            "answered": answered,
+            "relevant": len(partials),
+            "failed": failed,
+            "cancelled": len(shards) - answered - failed,
+            "map_s": round(time.perf_counter() - started, 3),
+        }
+        for outcome in ("relevant", "failed", "cancelled"):
+            metrics.MAP_REDUCE_SHARDS.inc(stats[outcome], outcome=outcome)
+        metrics.MAP_REDUCE_SHARDS.inc(stats["answered"] - stats["relevant"], outcome="empty")
+        with self._lock:
+            self.last_run = stats
+        return sorted(partials), stats
+
+    def context(self, question, text):
+        """The partial answers as a prompt block for the reduce call."""
+        with metrics.span("map_reduce"):
+            partials, stats = self.map(question, text)
+        if not partials:
+            return NOTHING_FOUND
+        return REDUCE_HEADER + "\n\n" + "\n\n".join(
+            f"[Part {i + 1} of {stats['shards']}]\n{answer}" for i, answer in partials)
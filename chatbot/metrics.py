@@ -0,0 +1,287 @@
+"""Request timing and counters, exposed in Prometheus text format.
+
+Stages of a request are timed with span():
+
+    with metrics.span("build_prompt"):
+        prompt = build_prompt(session_id, message)
+
+and land in the chatbot_stage_seconds histogram, labelled with the route
+set by begin_request() for the current thread.  Work done outside a
+request (the summarizer, extraction callbacks) is labelled "background".
+
+SamplingProfiler is the opt-in companion: while a request runs it samples
+the request thread's stack, and it keeps the samples of the slowest few
+requests as folded stacks that flamegraph tools read directly.
+"""
+import bisect
+import heapq
+import itertools
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts, made cumulative only when rendered
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self, key):
+        """(count, sum) of one label set, for tests and summaries."""
+        with self._lock:
+            series = self._series.get(tuple(key))
+            return (series[2], series[1]) if series else (0, 0.0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total, count) for key, (counts, total, count) in self._series.items())
+        for key, counts, total, count in series:
+            for bound, cumulative in zip(self.buckets + (float("inf"),), itertools.accumulate(counts)):
+                labels = format_labels(self.labelnames, key, [("le", format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+                     for key, value in values)
+        return lines
+
+
+class Collected:
+    """A value read from elsewhere (a store's stats()) when rendered.
+
+    fn returns a number, or {label value: number} when label is given.
+    """
+
+    def __init__(self, name, help, fn, kind="gauge", label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+        self.label = label
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Error collecting {self.name}:", str(e))
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.label is None:
+            lines.append(f"{self.name} {format_value(value)}")
+        else:
+            lines.extend(f"{self.name}{format_labels((self.label,), (key,))} {format_value(v)}"
+                         for key, v in sorted(value.items()))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            # Re-registering (a module imported twice in tests) replaces
+            self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def collect(self, name, help, fn, kind="gauge", label=None):
+        return self._add(Collected(name, help, fn, kind, label))
+
+    def render(self):
+        """The whole registry in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "chatbot_stage_seconds", "Time spent in each stage of handling a request.", ("route", "stage"))
+REQUEST_SECONDS = registry.histogram(
+    "chatbot_request_seconds", "Time to handle a request, by route and status.", ("route", "status"))
+EXTRACTION_SECONDS = registry.histogram(
+    "chatbot_extraction_seconds", "Time from upload to extracted text, by backend.", ("backend",))
+UPSTREAM_ERRORS = registry.counter(
+    "chatbot_upstream_errors_total", "Failed Gemini calls, by kind.", ("kind",))
+UPSTREAM_RETRIES = registry.counter(
+    "chatbot_upstream_retries_total", "Gemini calls retried after a transient failure.")
+HISTORY_WRITE_ERRORS = registry.counter(
+    "chatbot_history_write_errors_total",
+    "Chat history batch writes retried, and rows dropped after every retry failed.", ("kind",))
+MAP_REDUCE_SHARDS = registry.counter(
+    "chatbot_map_reduce_shards_total", "Document shards asked in map-reduce answers, by outcome.", ("outcome",))
+STORAGE_SWEPT = registry.counter(
+    "chatbot_storage_swept_total", "Stored files deleted by the sweeper, by reason.", ("reason",))
+NORMALIZATION_SAVED = registry.counter(
+    "chatbot_normalization_saved_total", "Bytes and tokens removed from extracted text.", ("unit",))
+OVERVIEW_SECONDS = registry.histogram(
+    "chatbot_overview_seconds", "Time to prepare a document overview after extraction.")
+PREPARED_ANSWERS = registry.counter(
+    "chatbot_prepared_answers_total", "Questions answered from a document overview without an upstream call.")
+QUESTION_ROUTES = registry.counter(
+    "chatbot_question_routes_total", "Questions answered locally from the document or sent upstream.", ("route",))
+
+_current = threading.local()
+
+
+def begin_request(route):
+    _current.route = route
+
+
+def end_request():
+    _current.route = None
+
+
+def current_route():
+    return getattr(_current, "route", None) or "background"
+
+
+@contextmanager
+def span(stage, route=None):
+    """Time the block into chatbot_stage_seconds{route, stage}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, route=route or current_route(), stage=stage)
+
+
+def fold_stack(frame):
+    """A frame's stack as "outer;...;inner", the folded flamegraph format."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Samples the stacks of running requests; keeps the `keep` slowest.
+
+    begin() and end() are called on the request's thread.  A single sampler
+    thread wakes every `interval` seconds and records the stack of every
+    request in progress, so the cost is proportional to the sampling rate,
+    not to the amount of work the requests do.
+    """
+
+    def __init__(self, keep=10, interval=0.005):
+        self.keep = keep
+        self.interval = interval
+        self._active = {}
+        self._slowest = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def begin(self):
+        with self._lock:
+            self._active[threading.get_ident()] = StackCounter()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._sampler.start()
+
+    def end(self, route, seconds):
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+            if stacks is None:
+                return
+            entry = (seconds, next(self._order), route, stacks)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            elif seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def profiles(self):
+        """The kept requests, slowest first, with their folded stacks."""
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        return [{
+            "route": route,
+            "duration_ms": round(seconds * 1000, 1),
+            "samples": sum(stacks.values()),
+            "folded": "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()),
+        } for seconds, _, route, stacks in slowest]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[fold_stack(frame)] += 1
@@ -0,0 +1,223 @@
+"""Clean-up of extracted text before it is stored and sent upstream.
+
+Text pulled out of PDFs carries a lot that costs tokens on every turn and
+tells the model nothing: the running header and footer of every page,
+page numbers, words hyphenated across line ends, runs of blank lines and
+spaces, and whole paragraphs repeated from earlier pages.
+normalize_pages() removes them once, when a document is extracted, and
+reports what it saved; PageNormalizer does the same for pages that arrive
+a batch at a time, without holding the whole document.
+
+Only lines at the top or bottom of a page are ever treated as headers,
+footers or page numbers, and a bare number only counts as a page number
+when the numbers at that edge follow the page order, so table cells that
+happen to end a page are kept.  A header must repeat at the same edge and
+have a word in it: a lone bullet or rule that happens to start many pages
+is part of a list, not a header.
+"""
+import hashlib
+import math
+import re
+from collections import Counter
+
+from chatbot.context import count_tokens
+
+# Lines at each end of a page that may be a running header or footer
+EDGE_LINES = 3
+# A header or footer repeats on at least this share of pages...
+BOILERPLATE_SHARE = 0.3
+# ...and on at least this many
+BOILERPLATE_MIN_PAGES = 3
+# Shorter repeated paragraphs (table cells, labels) are kept
+DUPLICATE_MIN_CHARS = 200
+# Pages PageNormalizer holds to find the headers and footers in
+WINDOW_PAGES = 64
+
+SPACE_RE = re.compile(r"[ \t\u00a0\u2000-\u200b\u3000]+")
+PAGE_NUMBER_RE = re.compile(r"(?:page\s*)?[-–—]?\s*(\d{1,4})\s*[-–—]?(?:\s*(?:of|/)\s*\d{1,4})?",
+                            re.IGNORECASE)
+# Matching starts at the start of a word only; trying from every letter
+# made this the slowest step
+HYPHENATED_RE = re.compile(r"(?<![^\W\d_])([^\W\d_]+)-\n([a-z]+)")
+WORD_RE = re.compile(r"[^\W\d_]+")
+BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def clean_lines(page):
+    """The page's lines with runs of whitespace collapsed."""
+    return [line.strip() for line in SPACE_RE.sub(" ", page or "").splitlines()]
+
+
+def edge_lines(lines):
+    """{(edge, index)} of the first ("top") and last ("bottom") EDGE_LINES
+    non-blank lines; a short page's lines can be at both."""
+    filled = [i for i, line in enumerate(lines) if line]
+    return {("top", i) for i in filled[:EDGE_LINES]} | {("bottom", i) for i in filled[-EDGE_LINES:]}
+
+
+def edge_indexes(lines):
+    """Indexes of the first and last EDGE_LINES non-blank lines."""
+    return sorted({i for _, i in edge_lines(lines)})
+
+
+def boilerplate_lines(pages):
+    """{(edge, line)} repeated at that edge on enough pages to be headers
+    or footers.
+
+    Lines must repeat exactly: numbers in them (course credits, dates) are
+    often the content, and page numbers are found by page_number_lines().
+    Lines without a word (bullets, rules) are never boilerplate.
+    """
+    seen = Counter()
+    for lines in pages:
+        seen.update({(edge, lines[i]) for edge, i in edge_lines(lines) if WORD_RE.search(lines[i])})
+    threshold = max(BOILERPLATE_MIN_PAGES, math.ceil(BOILERPLATE_SHARE * len(pages)))
+    return {key for key, count in seen.items() if count >= threshold}
+
+
+def page_number_lines(pages):
+    """{(page, line index)} of edge lines that number the pages.
+
+    A page numbered n at index i has offset n - i; the offset shared by
+    the most pages is taken as the document's numbering.
+    """
+    candidates = []
+    for p, lines in enumerate(pages):
+        for i in edge_indexes(lines):
+            match = PAGE_NUMBER_RE.fullmatch(lines[i])
+            if match:
+                candidates.append((int(match.group(1)) - p, p, i))
+    if not candidates:
+        return set()
+    pages_per_offset = Counter(offset for offset, _ in {(o, p) for o, p, _ in candidates})
+    offset, count = pages_per_offset.most_common(1)[0]
+    if count < max(BOILERPLATE_MIN_PAGES, math.ceil(0.5 * len(pages))):
+        return set()
+    return {(p, i) for o, p, i in candidates if o == offset}
+
+
+def rejoin_hyphenated(text, words):
+    """Join words split across lines; returns (text, number joined).
+
+    The hyphen is dropped only when the joined word occurs elsewhere in
+    the document, so compounds such as "real-\ntime" keep theirs.
+    """
+    if "-\n" not in text:
+        return text, 0
+
+    def join(match):
+        head, tail = match.groups()
+        if (head + tail).lower() in words:
+            return head + tail
+        return f"{head}-{tail}"
+    return HYPHENATED_RE.subn(join, text)
+
+
+def normalize_pages(pages):
+    """Return (cleaned pages, report).
+
+    Pages stay in place (an emptied page is ""), so page offsets computed
+    from the result still line up with the original page numbers.
+    """
+    normalizer = PageNormalizer(window=None)
+    cleaned = normalizer.add(pages) + normalizer.finish()
+    return cleaned, normalizer.report
+
+
+class PageNormalizer:
+    """normalize_pages() for a document whose pages arrive in order, a
+    batch at a time.
+
+    Headers, footers and the page numbering are found in the first
+    `window` pages (all of them if None), which are held until the window
+    is full; every later page is cleaned as soon as it is added.  Past the
+    window only the words seen so far and a digest of each long paragraph
+    are kept, so memory does not grow with the document.  A document no
+    longer than the window comes out exactly as from normalize_pages(); in
+    a longer one a word split across lines is only rejoined if the joined
+    word occurs by the end of its page.
+    """
+
+    def __init__(self, window=WINDOW_PAGES):
+        self.window = window
+        self.report = {"boilerplate_lines": 0, "page_numbers": 0, "hyphenations": 0, "duplicate_paragraphs": 0}
+        self._held = []
+        self._pages = 0
+        self._boilerplate = None
+        self._numbering = None
+        self._words = set()
+        self._seen = set()
+        self._size = {"bytes_before": -1, "bytes_after": -1, "tokens_before": 0, "tokens_after": 0}
+
+    def add(self, pages):
+        """Add the next pages; returns the pages cleaned so far, in order."""
+        cleaned = []
+        for page in pages:
+            page = page or ""
+            self._size["bytes_before"] += len(page.encode("utf-8")) + 1
+            self._size["tokens_before"] += count_tokens(page)
+            self._words.update(WORD_RE.findall(page.lower()))
+            if self._boilerplate is None:
+                self._held.append(clean_lines(page))
+                if self.window is not None and len(self._held) >= self.window:
+                    cleaned.extend(self._decide())
+            else:
+                cleaned.append(self._clean(self._pages, clean_lines(page)))
+            self._pages += 1
+        return cleaned
+
+    def finish(self):
+        """Clean the pages still held and complete the report; returns them."""
+        cleaned = self._decide() if self._boilerplate is None else []
+        report = self.report
+        report.update({key: max(value, 0) for key, value in self._size.items()})
+        report["bytes_saved"] = report["bytes_before"] - report["bytes_after"]
+        report["tokens_saved"] = report["tokens_before"] - report["tokens_after"]
+        return cleaned
+
+    def _decide(self):
+        held, self._held = self._held, []
+        self._boilerplate = set()
+        if len(held) >= BOILERPLATE_MIN_PAGES:
+            self._boilerplate = boilerplate_lines(held)
+            numbers = page_number_lines(held)
+            if numbers:
+                p, i = min(numbers)
+                self._numbering = int(PAGE_NUMBER_RE.fullmatch(held[p][i]).group(1)) - p
+        return [self._clean(p, lines) for p, lines in enumerate(held)]
+
+    def _numbers_page(self, p, line):
+        match = PAGE_NUMBER_RE.fullmatch(line)
+        return match is not None and int(match.group(1)) - p == self._numbering
+
+    def _clean(self, p, lines):
+        report = self.report
+        if self._boilerplate or self._numbering is not None:
+            for edge, i in sorted(edge_lines(lines)):
+                if lines[i] is None:
+                    continue
+                if self._numbering is not None and self._numbers_page(p, lines[i]):
+                    report["page_numbers"] += 1
+                elif (edge, lines[i]) in self._boilerplate:
+                    report["boilerplate_lines"] += 1
+                else:
+                    continue
+                lines[i] = None
+
+        text = "\n".join(line for line in lines if line is not None)
+        text, joined = rejoin_hyphenated(text, self._words)
+        report["hyphenations"] += joined
+        paragraphs = []
+        for paragraph in BLANK_LINES_RE.sub("\n\n", text).strip().split("\n\n"):
+            key = " ".join(paragraph.lower().split())
+            if len(key) >= DUPLICATE_MIN_CHARS:
+                digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+                if digest in self._seen:
+                    report["duplicate_paragraphs"] += 1
+                    continue
+                self._seen.add(digest)
+            paragraphs.append(paragraph)
+        page = "\n\n".join(paragraphs)
+        self._size["bytes_after"] += len(page.encode("utf-8")) + 1
+        self._size["tokens_after"] += count_tokens(page)
+        return page
@@ -0,0 +1,162 @@
+"""Overviews of uploaded documents, prepared before the first question.
+
+The first question about a new document is the slowest one: the document
+goes upstream cold.  Once a document's text is extracted, a background
+worker asks the model for a short summary, an outline and the key terms,
+and answers a few starter questions ("What is this document about?")
+the way a live chat would.  The result is stored with the document under
+its SHA-256 (chatbot.docstore), so uploading the same bytes again reuses
+it.
+
+Starter questions are then answered without an upstream call, and the
+summary and outline give other questions a view of the whole document
+next to the retrieved passages.  Only the first input_chars of a document
+are read for the summary.
+"""
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chatbot import metrics
+from chatbot.cache import normalize_prompt
+
+STARTER_QUESTIONS = [
+    "What is this document about?",
+    "Summarize this document.",
+    "What are the main topics?",
+]
+
+OVERVIEW_PROMPT = (
+    "Read the document below and reply in exactly this format:\n\n"
+    "SUMMARY:\n<what the document is and its main points, in at most {max_words} words>\n"
+    "OUTLINE:\n- <section or topic>\n- <section or topic>\n"
+    "KEY TERMS:\n<the most important names, terms and figures, comma separated>\n\n"
+    "Document:\n{text}"
+)
+OVERVIEW_HEADER = "Overview of the whole document:"
+# "SUMMARY:", also as a Markdown heading or in bold
+SECTION_RE = re.compile(r"^[#*\s]*(SUMMARY|OUTLINE|KEY TERMS)[*\s]*:[*\s]*", re.IGNORECASE | re.MULTILINE)
+
+
+def parse_overview(reply):
+    """{"summary", "outline", "key_terms"} from the model's reply.
+
+    A reply that ignored the format is kept whole as the summary.
+    """
+    sections = {}
+    parts = SECTION_RE.split(reply)
+    for name, body in zip(parts[1::2], parts[2::2]):
+        sections[name.upper()] = body.strip()
+    if "SUMMARY" not in sections:
+        return {"summary": reply.strip(), "outline": [], "key_terms": []}
+    outline = [line.strip().lstrip("-*• ").strip() for line in sections.get("OUTLINE", "").splitlines()]
+    terms = re.split(r"[,;\n]", sections.get("KEY TERMS", ""))
+    return {
+        "summary": sections["SUMMARY"],
+        "outline": [line for line in outline if line],
+        "key_terms": [term.strip().lstrip("-*• ").strip() for term in terms if term.strip()],
+    }
+
+
+def overview_context(overview):
+    """The summary and outline as a prompt block ("" without a summary)."""
+    if not overview or not overview.get("summary"):
+        return ""
+    block = f"{OVERVIEW_HEADER}\n{overview['summary']}"
+    if overview.get("outline"):
+        block += "\nOutline: " + "; ".join(overview["outline"])
+    return block
+
+
+class Overviews:
+    """Background worker preparing document overviews.
+
+    generate(prompt) is the blocking upstream call and starter_prompts(text,
+    questions) the prompts a live chat would send for each question.  The
+    overview call and the starter answers of one document run at once, up
+    to concurrency calls.  request(digest, text) is cheap; a document is
+    queued at most once at a time and skipped if it already has one.
+    """
+
+    def __init__(self, store, generate, starter_prompts, questions=None, input_chars=200000,
+                 summary_words=150, concurrency=4):
+        self.store = store
+        self.generate = generate
+        self.starter_prompts = starter_prompts
+        self.questions = STARTER_QUESTIONS if questions is None else questions
+        self._keys = {normalize_prompt(q) for q in self.questions}
+        self.input_chars = input_chars
+        self.summary_words = summary_words
+        self.concurrency = concurrency
+        self.built = 0
+        self.failures = 0
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def request(self, digest, text):
+        if not text:
+            return
+        with self._lock:
+            if digest in self._pending:
+                return
+            self._pending.add(digest)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="overviews", daemon=True)
+                self._worker.start()
+        self._queue.put((digest, text))
+
+    def pending(self, digest):
+        with self._lock:
+            return digest in self._pending
+
+    def join(self):
+        """Wait until every requested document has been handled."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            digest, text = self._queue.get()
+            try:
+                if self.store.get_overview(digest) is None:
+                    self.store.put_overview(digest, self.build(text))
+                    self.built += 1
+            except Exception as e:
+                self.failures += 1
+                print("Error preparing document overview:", str(e))
+            finally:
+                with self._lock:
+                    self._pending.discard(digest)
+                self._queue.task_done()
+
+    def build(self, text):
+        started = time.perf_counter()
+        prompts = [OVERVIEW_PROMPT.format(max_words=self.summary_words, text=text[:self.input_chars])]
+        prompts += self.starter_prompts(text, self.questions)
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency), thread_name_prefix="overview") as pool:
+            replies = list(pool.map(self.generate, prompts))
+        overview = parse_overview(replies[0])
+        overview["answers"] = {normalize_prompt(q): answer for q, answer in zip(self.questions, replies[1:])}
+        seconds = time.perf_counter() - started
+        metrics.OVERVIEW_SECONDS.observe(seconds)
+        overview["seconds"] = round(seconds, 3)
+        return overview
+
+    def get(self, digest):
+        return self.store.get_overview(digest)
+
+    def answer(self, digest, question):
+        """The prepared answer to question about digest, or None."""
+        key = normalize_prompt(question or "")
+        if key not in self._keys:
+            return None
+        overview = self.store.get_overview(digest)
+        return overview["answers"].get(key) if overview else None
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"built": self.built, "failures": self.failures, "pending": pending}
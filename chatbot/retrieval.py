@@ -0,0 +1,145 @@
+"""BM25 retrieval over the chunks of an uploaded document.
+
+Instead of prepending a whole document to every prompt, the text is split
+into chunks once at upload time and indexed with an inverted index.  At chat
+time only the best scoring chunks that fit a character budget are sent.
+"""
+import re
+from collections import Counter
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def split_chunks(text, chunk_chars=1200, overlap_chars=200):
+    """Split text into chunks of roughly chunk_chars, breaking on lines.
+
+    The last lines of a chunk (up to overlap_chars) are repeated at the start
+    of the next one so an answer straddling a boundary is still retrievable.
+    """
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        # Hard-split lines that are longer than a chunk on their own
+        while len(line) > chunk_chars:
+            cut = line.rfind(" ", 0, chunk_chars)
+            if cut <= 0:
+                cut = chunk_chars
+            lines.append(line[:cut])
+            line = line[cut:].strip()
+        if line:
+            lines.append(line)
+
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        if current and size + len(line) + 1 > chunk_chars:
+            chunks.append("\n".join(current))
+            carried = []
+            carried_size = 0
+            for prev in reversed(current):
+                if carried_size + len(prev) + 1 > overlap_chars:
+                    break
+                carried.insert(0, prev)
+                carried_size += len(prev) + 1
+            current = carried
+            size = carried_size
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class DocumentIndex:
+    """Inverted index with Okapi BM25 scoring over one document's chunks."""
+
+    def __init__(self, text, chunk_chars=1200, overlap_chars=200, k1=1.5, b=0.75):
+        self.chunks = split_chunks(text, chunk_chars, overlap_chars)
+        self.k1 = k1
+
+        postings = {}
+        lengths = []
+        for chunk_id, chunk in enumerate(self.chunks):
+            counts = Counter(tokenize(chunk))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(chunk_id)
+                postings[term][1].append(tf)
+
+        n = len(self.chunks)
+        doc_len = np.asarray(lengths, dtype=np.float32)
+        avgdl = float(doc_len.mean()) if n and doc_len.sum() else 1.0
+        # Length normalisation is per chunk, so it is computed once here
+        self._norm = k1 * (1.0 - b + b * doc_len / avgdl)
+
+        self._postings = {}
+        for term, (ids, tfs) in postings.items():
+            ids = np.asarray(ids, dtype=np.int32)
+            tfs = np.asarray(tfs, dtype=np.float32)
+            df = len(ids)
+            idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            self._postings[term] = (ids, tfs, idf)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    @property
+    def nbytes(self):
+        """Rough memory footprint: chunk text plus posting arrays."""
+        size = sum(len(chunk) for chunk in self.chunks) + self._norm.nbytes
+        for term, (ids, tfs, idf) in self._postings.items():
+            size += len(term) + ids.nbytes + tfs.nbytes + 64
+        return size
+
+    def idf(self, term):
+        """The BM25 weight of term; highest for a term in no chunk."""
+        entry = self._postings.get(term)
+        if entry is not None:
+            return float(entry[2])
+        return float(np.log(1.0 + (len(self.chunks) + 0.5) / 0.5))
+
+    def scores(self, query):
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize(query)):
+            entry = self._postings.get(term)
+            if entry is None:
+                continue
+            ids, tfs, idf = entry
+            scores[ids] += idf * tfs * (self.k1 + 1.0) / (tfs + self._norm[ids])
+        return scores
+
+    def top_chunks(self, query, k=6, budget_chars=8000):
+        """Return up to k chunk ids that fit in budget_chars, best first."""
+        scores = self.scores(query)
+        order = np.argsort(-scores, kind="stable")
+        if not len(order) or scores[order[0]] <= 0:
+            # Nothing matched (e.g. "summarise this"), fall back to the start
+            order = range(len(self.chunks))
+
+        selected = []
+        used = 0
+        for chunk_id in order:
+            chunk_id = int(chunk_id)
+            if len(selected) >= k:
+                break
+            if selected and scores[chunk_id] <= 0 and scores[selected[0]] > 0:
+                break
+            size = len(self.chunks[chunk_id]) + 2
+            if used + size > budget_chars:
+                continue
+            selected.append(chunk_id)
+            used += size
+        return selected
+
+    def context_for(self, query, k=6, budget_chars=8000):
+        """Join the selected chunks back together in document order."""
+        selected = sorted(self.top_chunks(query, k, budget_chars))
+        return "\n\n".join(self.chunks[i] for i in selected)
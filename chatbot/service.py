@@ -0,0 +1,50 @@
+"""The chat service's shared objects for the Django site, created on first use.
+
+Importing chatbot.chat opens its databases, creates uploads/ and starts
+the sweeper and history threads.  A request needs all of that, but
+manage.py commands (migrate, makemigrations, check) also load the views,
+so the Django views reach chatbot.chat through `chat` here instead: the
+module is imported on the first attribute read, which only a request
+makes.
+
+    from chatbot.service import chat, on_load
+
+on_load(fn) runs fn(module) once it is imported, for set-up that needs
+the shared objects (see techjays/views.py).
+"""
+import importlib
+import threading
+
+_lock = threading.RLock()
+_module = None
+_callbacks = []
+
+
+def load():
+    """Import chatbot.chat (once) and return it."""
+    global _module
+    if _module is not None:
+        return _module
+    with _lock:
+        if _module is None:
+            module = importlib.import_module("chatbot.chat")
+            for callback in _callbacks:
+                callback(module)
+            _module = module
+    return _module
+
+
+def on_load(callback):
+    with _lock:
+        if _module is None:
+            _callbacks.append(callback)
+            return
+    callback(_module)
+
+
+class LazyModule:
+    def __getattr__(self, name):
+        return getattr(load(), name)
+
+
+chat = LazyModule()
@@ -0,0 +1,336 @@
+"""Chat sessions kept in a memory-budgeted LRU in front of SQLite.
+
+Every change to a session (new chat, message, document) is written through
+to a SQLite file, so any worker process on the machine sees the same
+sessions.  Each process keeps the sessions it used recently in memory,
+together with the retrieval index built from their document, up to a byte
+budget; the least recently used ones are dropped when the budget is
+exceeded and reloaded from disk the next time they are asked for.
+
+Every write stamps the session with a new revision.  A cached session is
+only used while its revision matches the one on disk, so a change made by
+another worker is picked up on the next access.
+
+A session's document is stored as its SHA-256 only; its text lives once
+in chatbot.docstore however many sessions hold it, and is read back from
+there (load_text) when a session is loaded.
+
+Messages carry their token count, computed once when they are stored, and
+sessions a rolling summary of their first `summarized` messages (see
+chatbot.context).
+"""
+import os
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from chatbot.cache import fingerprint
+from chatbot.context import count_tokens
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        revision TEXT NOT NULL,
+        document TEXT,
+        summary TEXT NOT NULL DEFAULT '',
+        summarized INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS session_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT NOT NULL,
+        tokens INTEGER
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_session_messages_session ON session_messages (session_id, id)',
+]
+
+# Columns added after the tables were first created
+MIGRATIONS = [
+    ("sessions", "summary", "ALTER TABLE sessions ADD COLUMN summary TEXT NOT NULL DEFAULT ''"),
+    ("sessions", "summarized", "ALTER TABLE sessions ADD COLUMN summarized INTEGER NOT NULL DEFAULT 0"),
+    ("session_messages", "tokens", "ALTER TABLE session_messages ADD COLUMN tokens INTEGER"),
+]
+
+# Columns dropped since, when an older file still has them
+RETIRED = [
+    ("sessions", "text", "ALTER TABLE sessions DROP COLUMN text"),
+]
+
+# Bookkeeping per cached session and per message, on top of the text itself
+SESSION_OVERHEAD = 512
+MESSAGE_OVERHEAD = 128
+
+
+class Session:
+    """One chat: its messages and the text of its current document.
+
+    document is the SHA-256 of the uploaded file (see chatbot.docstore) or
+    None; index is the retrieval index over text, built when loaded.
+    summary covers messages[:summarized].
+    """
+
+    def __init__(self, session_id, revision, document=None, text="", messages=None, index=None,
+                 summary="", summarized=0):
+        self.session_id = session_id
+        self.revision = revision
+        self.document = document
+        self.text = text
+        self.messages = messages if messages is not None else []
+        self.index = index
+        self.summary = summary
+        self.summarized = summarized
+        self.fingerprint = fingerprint(text) if text else ""
+
+    @property
+    def nbytes(self):
+        size = SESSION_OVERHEAD + len(self.text) + len(self.summary)
+        size += sum(len(m["text"] or "") + MESSAGE_OVERHEAD for m in self.messages)
+        if self.index is not None:
+            size += self.index.nbytes
+        return size
+
+
+def new_revision():
+    return uuid.uuid4().hex
+
+
+@contextmanager
+def transaction(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+class SessionStore:
+    """Write-through session store with an in-memory LRU of budget_bytes.
+
+    load_text(document) returns the extracted text of a document, or ""
+    if there is none yet; without it a session loaded from disk has no
+    text.  make_index(text) builds the retrieval index for a session's
+    document; it is not persisted, only rebuilt when a session is loaded.
+    """
+
+    def __init__(self, path, budget_bytes=256 * 1024 * 1024, make_index=None, load_text=None):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.make_index = make_index
+        self.load_text = load_text
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._pid = None
+        self._conn = None
+
+    def _connection(self):
+        # One connection per process, reopened after a fork
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            for table, column, statement in MIGRATIONS:
+                if column not in [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]:
+                    conn.execute(statement)
+            for table, column, statement in RETIRED:
+                if column in [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]:
+                    conn.execute(statement)
+            self._conn = conn
+            self._sessions.clear()
+            self._bytes = 0
+            self._pid = os.getpid()
+        return self._conn
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def get(self, session_id):
+        """Return the Session, from memory if it is current, else from disk."""
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute('SELECT revision FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                self._forget(session_id)
+                return None
+            cached = self._sessions.get(session_id)
+            if cached is not None and cached.revision == row[0]:
+                self._sessions.move_to_end(session_id)
+                self.hits += 1
+                return cached
+            row = conn.execute(
+                'SELECT revision, document, summary, summarized FROM sessions WHERE session_id = ?',
+                (session_id,)).fetchone()
+            messages = [
+                {"role": role, "text": text, "tokens": tokens if tokens is not None else count_tokens(text)}
+                for role, text, tokens in conn.execute(
+                    'SELECT role, text, tokens FROM session_messages WHERE session_id = ? ORDER BY id',
+                    (session_id,))]
+
+        # Reading the text and building the index can take a while for a
+        # big document; do it without holding up other sessions
+        revision, document, summary, summarized = row
+        text = self.load_text(document) if document and self.load_text else ""
+        index = self.make_index(text) if text and self.make_index else None
+        session = Session(session_id, revision, document, text, messages, index, summary, summarized)
+        with self._lock:
+            self.loads += 1
+            self._remember(session)
+        return session
+
+    def create(self, session_id):
+        """Start session_id afresh, dropping its messages and document."""
+        revision = new_revision()
+        with self._lock:
+            conn = self._connection()
+            with transaction(conn):
+                conn.execute('DELETE FROM session_messages WHERE session_id = ?', (session_id,))
+                conn.execute(
+                    'INSERT OR REPLACE INTO sessions (session_id, revision) VALUES (?, ?)',
+                    (session_id, revision))
+            self._remember(Session(session_id, revision))
+
+    def append_message(self, session_id, role, text):
+        """Add a message; returns False if the session does not exist."""
+        revision = new_revision()
+        tokens = count_tokens(text)
+        with self._lock:
+            conn = self._connection()
+            with transaction(conn):
+                row = conn.execute(
+                    'SELECT revision FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+                if row is None:
+                    self._forget(session_id)
+                    return False
+                conn.execute(
+                    'INSERT INTO session_messages (session_id, role, text, tokens) VALUES (?, ?, ?, ?)',
+                    (session_id, role, text, tokens))
+                conn.execute('UPDATE sessions SET revision = ? WHERE session_id = ?', (revision, session_id))
+
+            cached = self._sessions.get(session_id)
+            if cached is not None and cached.revision == row[0]:
+                cached.messages.append({"role": role, "text": text, "tokens": tokens})
+                cached.revision = revision
+                self._bytes += len(text or "") + MESSAGE_OVERHEAD
+                self._sessions.move_to_end(session_id)
+                self._evict()
+            else:
+                # Changed elsewhere in the meantime; reload on next access
+                self._forget(session_id)
+            return True
+
+    def set_document(self, session_id, document, text=""):
+        """Replace the session's document; returns the previous document.
+
+        text is the document's text, if extracted yet.  It is only kept in
+        memory; a session loaded later gets it from load_text.
+        """
+        revision = new_revision()
+        index = self.make_index(text) if text and self.make_index else None
+        with self._lock:
+            conn = self._connection()
+            with transaction(conn):
+                row = conn.execute(
+                    'SELECT revision, document FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    'UPDATE sessions SET revision = ?, document = ? WHERE session_id = ?',
+                    (revision, document, session_id))
+
+            cached = self._sessions.get(session_id)
+            if cached is not None and cached.revision == row[0]:
+                session = Session(session_id, revision, document, text, cached.messages, index,
+                                  cached.summary, cached.summarized)
+                self._remember(session)
+            else:
+                self._forget(session_id)
+            return row[1]
+
+    def set_summary(self, session_id, summary, summarized, expected):
+        """Store a summary of messages[:summarized].
+
+        Only applies if the session still has `expected` messages
+        summarized, so two summarizers cannot fold the same turns twice.
+        """
+        revision = new_revision()
+        with self._lock:
+            conn = self._connection()
+            with transaction(conn):
+                row = conn.execute(
+                    'SELECT revision FROM sessions WHERE session_id = ? AND summarized = ?',
+                    (session_id, expected)).fetchone()
+                if row is None:
+                    return False
+                conn.execute(
+                    'UPDATE sessions SET revision = ?, summary = ?, summarized = ? WHERE session_id = ?',
+                    (revision, summary, summarized, session_id))
+
+            cached = self._sessions.get(session_id)
+            if cached is not None and cached.revision == row[0]:
+                self._bytes += len(summary) - len(cached.summary)
+                cached.summary = summary
+                cached.summarized = summarized
+                cached.revision = revision
+                self._evict()
+            else:
+                self._forget(session_id)
+            return True
+
+    def delete(self, session_id):
+        """Remove the session; returns its document, if it had one."""
+        with self._lock:
+            conn = self._connection()
+            with transaction(conn):
+                row = conn.execute(
+                    'SELECT document FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+                conn.execute('DELETE FROM session_messages WHERE session_id = ?', (session_id,))
+                conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            self._forget(session_id)
+        return row[0] if row else None
+
+    def stats(self):
+        with self._lock:
+            stored = self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+            return {
+                "sessions": stored,
+                "sessions_in_memory": len(self._sessions),
+                "bytes_in_memory": self._bytes,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def _remember(self, session):
+        self._forget(session.session_id)
+        self._sessions[session.session_id] = session
+        self._bytes += session.nbytes
+        self._evict()
+
+    def _forget(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._bytes -= session.nbytes
+
+    def _evict(self):
+        # Everything is already on disk, so evicting only frees memory.  The
+        # most recent session stays even if it alone is over budget.
+        while self._bytes > self.budget_bytes and len(self._sessions) > 1:
+            _, session = self._sessions.popitem(last=False)
+            self._bytes -= session.nbytes
+            self.evictions += 1
+
@@ -0,0 +1,87 @@
+"""Coalescing of identical upstream calls that are in flight at once.
+
+When a class opens the same syllabus and asks the same starter question,
+the first request makes the Gemini call and every identical request that
+arrives before it finishes waits for that call and gets its result (or
+its error).  Only the upstream call is shared; each request still records
+its own turn in its own session.
+"""
+import asyncio
+import threading
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Per-key coalescing for worker threads (do) and coroutines (ado).
+
+    calls counts upstream calls actually made, coalesced the requests that
+    rode along on one of them.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return fn(), sharing one call among concurrent callers of key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def ado(self, key, factory):
+        """Await factory() once for all concurrent callers of key.
+
+        The call runs as its own task, so a caller that goes away (a
+        client disconnecting) does not cancel it for the others.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._tasks.pop(key, None))
+            with self._lock:
+                self.calls += 1
+        else:
+            with self._lock:
+                self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        with self._lock:
+            requests = self.calls + self.coalesced
+            return {
+                "upstream_calls": self.calls,
+                "coalesced": self.coalesced,
+                "coalesced_rate": round(self.coalesced / requests, 3) if requests else 0.0,
+            }
@@ -0,0 +1,315 @@
+"""Disk accounting, quotas and cleanup for uploaded files.
+
+Every file the service stores is recorded with the user and session that
+stored it, its size and when it was last used, so usage per user and in
+total is one query away and uploads over quota are refused up front.
+
+Nothing else ever deletes an upload whose chat is simply abandoned, so a
+background sweeper does, a batch at a time:
+
+    orphans    files nothing refers to any more (a root's referenced()
+               says so), and stray files such as interrupted uploads
+    expired    files not used for ttl seconds (touch() marks a use)
+    evicted    least recently used files while total usage is over the
+               global quota
+
+Files in a root made with expires=False are kept while they are still
+referenced, however long they go unused; only orphan sweeping removes
+them.
+
+Files younger than grace are never swept, so a file is not deleted while
+its upload or extraction is still running.  Each pass does at most
+batch_size deletions of each kind and holds no lock while deleting, so
+requests are never held up behind a large clean-up.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from chatbot import metrics
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        user_id TEXT,
+        session_id TEXT,
+        created REAL NOT NULL,
+        last_access REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_files_user ON files (user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_files_last_access ON files (last_access)',
+]
+
+# Sweeping deletes down to this share of the global quota, so that one
+# upload over the line does not start a sweep after every request
+LOW_WATER = 0.9
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class Root:
+    """A directory of managed files.
+
+    Only names matching pattern are ever swept.  referenced(path) tells
+    whether the file is still in use; on_delete(path) runs after the
+    sweeper removed one, to drop whatever pointed at it.  With expires
+    False, files are never expired or evicted, only swept as orphans.
+    """
+
+    def __init__(self, directory, pattern=None, referenced=None, on_delete=None, expires=True):
+        self.directory = os.path.abspath(directory)
+        self.pattern = re.compile(pattern) if pattern else None
+        self.referenced = referenced
+        self.on_delete = on_delete
+        self.expires = expires
+
+    def span(self):
+        """Bounds of the paths under the directory, for SQL range queries."""
+        return self.directory + os.sep, self.directory + chr(ord(os.sep) + 1)
+
+    def manages(self, name):
+        return self.pattern is None or self.pattern.fullmatch(name) is not None
+
+
+class StorageManager:
+    """touch() is called on every use of a file, so last_access is only
+    written once per touch_interval seconds per file."""
+
+    def __init__(self, db_path, user_quota_bytes=0, global_quota_bytes=0, ttl=0, grace=3600, batch_size=100,
+                 touch_interval=60):
+        self.db_path = db_path
+        self.user_quota_bytes = user_quota_bytes
+        self.global_quota_bytes = global_quota_bytes
+        self.ttl = ttl
+        self.grace = grace
+        self.batch_size = batch_size
+        self.touch_interval = touch_interval
+        self.roots = []
+        self._touched = {}
+        self.sweeps = 0
+        self._cursor = ""
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def _connection(self):
+        # One connection per process, reopened after a fork
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def add_root(self, directory, pattern=None, referenced=None, on_delete=None, expires=True):
+        root = Root(directory, pattern, referenced, on_delete, expires)
+        with self._lock:
+            self.roots.append(root)
+        return root
+
+    def root_for(self, path):
+        path = os.path.abspath(path)
+        for root in self.roots:
+            if os.path.dirname(path) == root.directory:
+                return root
+        return None
+
+    def track(self, path, user_id=None, session_id=None, accessed=None):
+        """Record a stored file, or mark an existing one as just used.
+
+        A file stored again by someone else stays charged to the user who
+        stored it first.
+        """
+        path = os.path.abspath(path)
+        size = os.path.getsize(path)
+        now = time.time() if accessed is None else accessed
+        with self._lock:
+            self._connection().execute(
+                'INSERT INTO files (path, size, user_id, session_id, created, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access',
+                (path, size, None if user_id is None else str(user_id), session_id, now, now))
+
+    def touch(self, path, now=None):
+        """Mark a stored file as just used, so it does not expire."""
+        path = os.path.abspath(path)
+        now = time.time() if now is None else now
+        with self._lock:
+            if now - self._touched.get(path, float("-inf")) < self.touch_interval:
+                return
+            self._touched[path] = now
+            self._connection().execute('UPDATE files SET last_access = ? WHERE path = ?', (now, path))
+
+    def forget(self, path):
+        """Drop the record of a file its owner deleted."""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._touched.pop(path, None)
+            self._connection().execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def usage(self, user_id=None):
+        """{"files", "bytes"} of one user, or of everyone for None."""
+        with self._lock:
+            conn = self._connection()
+            if user_id is None:
+                row = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone()
+            else:
+                row = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE user_id = ?',
+                                   (str(user_id),)).fetchone()
+        return {"files": row[0], "bytes": row[1]}
+
+    def check_quota(self, user_id, size):
+        """Raise QuotaExceeded if storing size more bytes would go over a quota."""
+        if user_id is not None and self.user_quota_bytes:
+            used = self.usage(user_id)["bytes"]
+            if used + size > self.user_quota_bytes:
+                raise QuotaExceeded(
+                    f"Storage quota exceeded ({used / 1024 ** 2:.1f} of "
+                    f"{self.user_quota_bytes / 1024 ** 2:g} MB used). Delete a chat to free space.")
+        if self.global_quota_bytes and self.usage()["bytes"] + size > self.global_quota_bytes:
+            raise QuotaExceeded("Storage is full, please try again later.")
+
+    def stats(self):
+        stats = self.usage()
+        stats["sweeps"] = self.sweeps
+        return stats
+
+    def _delete(self, path, reason, report):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print("Error deleting stored file:", str(e))
+            return
+        self.forget(path)
+        root = self.root_for(path)
+        if root is not None and root.on_delete is not None:
+            try:
+                root.on_delete(path)
+            except Exception as e:
+                print("Error cleaning up after deleted file:", str(e))
+        report[reason] += 1
+        metrics.STORAGE_SWEPT.inc(reason=reason)
+
+    def _expiring(self):
+        # SQL condition leaving out the files of roots that do not expire
+        condition, params = "", []
+        for root in self.roots:
+            if not root.expires:
+                condition += ' AND NOT (path >= ? AND path < ?)'
+                params += root.span()
+        return condition, params
+
+    def _referenced(self, root, path):
+        if root is None or root.referenced is None:
+            return True
+        try:
+            return root.referenced(path)
+        except Exception as e:
+            # When in doubt, keep the file
+            print("Error checking stored file:", str(e))
+            return True
+
+    def sweep(self, now=None):
+        """One pass of the sweeper; returns how many files went, by reason."""
+        now = time.time() if now is None else now
+        settled = now - self.grace
+        report = {"missing": 0, "orphans": 0, "expired": 0, "evicted": 0, "untracked": 0}
+
+        # Orphans among the tracked files, a batch per pass, resuming where
+        # the previous pass stopped
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT path, created FROM files WHERE path > ? ORDER BY path LIMIT ?',
+                (self._cursor, self.batch_size)).fetchall()
+            self._cursor = rows[-1][0] if len(rows) == self.batch_size else ""
+        for path, created in rows:
+            if not os.path.exists(path):
+                self.forget(path)
+                report["missing"] += 1
+            elif created < settled and not self._referenced(self.root_for(path), path):
+                self._delete(path, "orphans", report)
+
+        with self._lock:
+            expiring, params = self._expiring()
+        if self.ttl:
+            with self._lock:
+                expired = [path for path, in self._connection().execute(
+                    f'SELECT path FROM files WHERE last_access < ?{expiring} ORDER BY last_access LIMIT ?',
+                    (min(now - self.ttl, settled), *params, self.batch_size))]
+            for path in expired:
+                self._delete(path, "expired", report)
+
+        if self.global_quota_bytes:
+            excess = self.usage()["bytes"] - LOW_WATER * self.global_quota_bytes
+            if excess > 0:
+                with self._lock:
+                    oldest = self._connection().execute(
+                        f'SELECT path, size FROM files WHERE created < ?{expiring} ORDER BY last_access LIMIT ?',
+                        (settled, *params, self.batch_size)).fetchall()
+                for path, size in oldest:
+                    if excess <= 0:
+                        break
+                    self._delete(path, "evicted", report)
+                    excess -= size
+
+        self._sweep_untracked(settled, report)
+        self.sweeps += 1
+        return report
+
+    def _sweep_untracked(self, settled, report):
+        # Files on disk that were never recorded: left by a crash between
+        # writing and recording, or stored before tracking existed
+        budget = self.batch_size
+        for root in list(self.roots):
+            try:
+                entries = list(os.scandir(root.directory))
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                tracked = {path for path, in self._connection().execute(
+                    'SELECT path FROM files WHERE path >= ? AND path < ?', root.span())}
+            for entry in entries:
+                if budget <= 0:
+                    return
+                path = os.path.abspath(entry.path)
+                if (path in tracked or not entry.is_file() or not root.manages(entry.name)
+                        or entry.stat().st_mtime >= settled):
+                    continue
+                budget -= 1
+                if self._referenced(root, path):
+                    # Still in use: start accounting for it
+                    self.track(path, accessed=entry.stat().st_mtime)
+                else:
+                    self._delete(path, "untracked", report)
+
+    def start(self, interval):
+        """Sweep every interval seconds on a daemon thread."""
+        with self._lock:
+            if self._sweeper is None or not self._sweeper.is_alive():
+                self._stop.clear()
+                self._sweeper = threading.Thread(target=self._run, args=(interval,), name="storage-sweeper",
+                                                 daemon=True)
+                self._sweeper.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print("Error sweeping storage:", str(e))
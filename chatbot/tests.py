@@ -0,0 +1,1760 @@
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from chatbot import metrics
+from chatbot.cache import ResponseCache, cache_key, fingerprint
+from chatbot.docstore import DocumentStore
+from chatbot.extractive import LocalAnswerer
+from chatbot.context import ContextBuilder, Summarizer, count_tokens
+from chatbot.corpus import CorpusIndex, CorpusIndexes
+from chatbot.fake_gemini import FakeGemini
+from chatbot.mapreduce import NO_EVIDENCE, REDUCE_HEADER, MapReduce, asks_about_whole_document
+from chatbot.normalize import normalize_pages
+from chatbot.overview import Overviews, parse_overview
+from chatbot.retrieval import DocumentIndex, split_chunks
+from chatbot.sessions import SessionStore
+from chatbot.singleflight import SingleFlight
+from chatbot.storage import QuotaExceeded, StorageManager
+from chatbot.upstream import AsyncGeminiClient, CircuitBreaker, CircuitOpenError, GeminiClient, UpstreamError
+
+
+def load_chat_app():
+    """Import the Flask app with its databases in a temp dir."""
+    os.environ.setdefault("DB_ENGINE", "django.db.backends.sqlite3")
+    os.environ.setdefault("DB_NAME", os.path.join(tempfile.mkdtemp(), "db.sqlite3"))
+    os.environ.setdefault("DOCSTORE_DB", os.path.join(tempfile.mkdtemp(), "documents.db"))
+    os.environ.setdefault("SESSION_DB", os.path.join(tempfile.mkdtemp(), "sessions.db"))
+    os.environ.setdefault("CORPUS_DIR", tempfile.mkdtemp())
+    os.environ.setdefault("STORAGE_DB", os.path.join(tempfile.mkdtemp(), "storage.db"))
+    os.environ.setdefault("GEMINI_API_KEY", "test-key")
+    # Overviews would make upstream calls in the background of every upload
+    os.environ.setdefault("OVERVIEW_ENABLED", "0")
+    from chatbot import chat
+    if not getattr(chat, "_test_migrated", False):
+        from django.core.management import call_command
+        call_command("migrate", verbosity=0)
+        chat._test_migrated = True
+    return chat
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class GeminiClientTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGemini(latency=0).start()
+        self.addCleanup(self.fake.stop)
+
+    def client(self, **kwargs):
+        kwargs.setdefault("backoff_base", 0.001)
+        return GeminiClient(self.fake.url, "test-key", **kwargs)
+
+    def test_generate_returns_text(self):
+        text = self.client().generate("hello")
+        self.assertIn("canned answer", text)
+
+    def test_connections_are_reused(self):
+        client = self.client()
+        for _ in range(5):
+            client.generate("hello")
+        self.assertEqual(self.fake.requests, 5)
+        self.assertEqual(self.fake.connections, 1)
+
+    def test_retries_5xx_then_succeeds(self):
+        self.fake.fail_next(503, 500)
+        text = self.client(max_retries=3).generate("hello")
+        self.assertIn("canned answer", text)
+        self.assertEqual(self.fake.requests, 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.fake.fail_next(429, 429, 429)
+        with self.assertRaises(UpstreamError) as ctx:
+            self.client(max_retries=2).generate("hello")
+        self.assertEqual(ctx.exception.status, 429)
+        self.assertEqual(self.fake.requests, 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.fake.fail_next(400)
+        with self.assertRaises(UpstreamError) as ctx:
+            self.client().generate("hello")
+        self.assertEqual(ctx.exception.status, 400)
+        self.assertEqual(self.fake.requests, 1)
+
+    def test_read_timeout(self):
+        self.fake.latency = 0.5
+        start = time.monotonic()
+        with self.assertRaises(UpstreamError):
+            self.client(read_timeout=0.1).generate("hello")
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_backoff_is_jittered_and_capped(self):
+        client = self.client(backoff_base=1.0, backoff_max=4.0)
+        delays = [client.backoff(10) for _ in range(50)]
+        self.assertTrue(all(0 <= d <= 4.0 for d in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertEqual(client.backoff(0, retry_after=2.5), 2.5)
+
+    def test_breaker_opens_and_fails_fast(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+        client = self.client(max_retries=0, breaker=breaker)
+        self.fake.fail_next(503, 503)
+        for _ in range(2):
+            with self.assertRaises(UpstreamError):
+                client.generate("hello")
+        self.assertEqual(breaker.state, "open")
+
+        with self.assertRaises(CircuitOpenError):
+            client.generate("hello")
+        self.assertEqual(self.fake.requests, 2)
+
+    def test_breaker_half_open_trial(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        client = self.client(max_retries=0, breaker=breaker)
+        self.fake.fail_next(500)
+        with self.assertRaises(UpstreamError):
+            client.generate("hello")
+
+        clock.now = 11
+        self.assertEqual(breaker.state, "half-open")
+        self.fake.fail_next(500)
+        with self.assertRaises(UpstreamError):
+            client.generate("hello")
+        self.assertEqual(breaker.state, "open")
+
+        clock.now = 22
+        self.assertIn("canned answer", client.generate("hello"))
+        self.assertEqual(breaker.state, "closed")
+
+    def test_unexpected_trial_errors_reopen_the_breaker(self):
+        import requests
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        client = self.client(max_retries=0, breaker=breaker)
+        clock.now = 11
+        with mock.patch.object(client.session, "post", side_effect=requests.exceptions.ChunkedEncodingError("cut")):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                client.generate("hello")
+        self.assertEqual(breaker.state, "open")
+        clock.now = 22
+        self.assertIn("canned answer", client.generate("hello"))
+
+        # A cancelled trial on the asyncio client is not left running either
+        async_client = AsyncGeminiClient(self.fake.url, "test-key", max_retries=0, breaker=breaker)
+        breaker.record_failure()
+        clock.now = 33
+        session = mock.Mock(post=mock.AsyncMock(side_effect=asyncio.CancelledError))
+        with mock.patch.object(async_client, "_session", session):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(async_client.generate("hello"))
+        self.assertEqual(breaker.state, "open")
+        clock.now = 44
+        self.assertEqual(breaker.state, "half-open")
+        self.assertTrue(breaker.allow())
+
+
+class ChatStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGemini(latency=0, stream_chunks=5, stream_delay=0).start()
+        self.addCleanup(self.fake.stop)
+        self.chat = load_chat_app()
+        for patcher in (
+            mock.patch.object(self.chat, "gemini", GeminiClient(self.fake.url, "test-key", max_retries=0)),
+            mock.patch.object(self.chat, "response_cache", ResponseCache()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = self.chat.app.test_client()
+        self.session_id = f"stream-{self.id()}"
+        self.client.post("/new_chat", json={"session_id": self.session_id})
+
+    def events(self, response):
+        events = []
+        for block in response.get_data(as_text=True).split("\n\n"):
+            if not block:
+                continue
+            fields = dict(line.split(": ", 1) for line in block.splitlines())
+            events.append((fields.get("event"), json.loads(fields["data"])))
+        return events
+
+    def test_relays_chunks_and_saves_reply(self):
+        resp = self.client.post("/chat_stream", json={"session_id": self.session_id, "message": "hi"})
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        events = self.events(resp)
+
+        texts = [data["text"] for event, data in events if event is None]
+        self.assertGreaterEqual(len(texts), 5)
+        self.assertEqual(events[-1], ("done", {"done": True}))
+
+        reply = "".join(texts)
+        self.assertEqual(reply, self.fake.reply_text("hi"))
+        history = self.client.get(f"/get_history/{self.session_id}").get_json()
+        self.assertEqual([(m["role"], m["text"]) for m in history], [("user", "hi"), ("model", reply)])
+
+    def test_upstream_error_before_stream(self):
+        self.fake.fail_next(500)
+        resp = self.client.post("/chat_stream", json={"session_id": self.session_id, "message": "hi"})
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertFalse(resp.get_json()["success"])
+
+    def test_unknown_session(self):
+        resp = self.client.post("/chat_stream", json={"session_id": "missing", "message": "hi"})
+        self.assertEqual(resp.status_code, 400)
+
+
+class CoalescingTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGemini(latency=0.3).start()
+        self.addCleanup(self.fake.stop)
+        self.chat = load_chat_app()
+        from chatbot import asgi
+        self.asgi = asgi
+        for patcher in (
+            mock.patch.object(self.chat, "gemini", GeminiClient(self.fake.url, "test-key", max_retries=0)),
+            mock.patch.object(asgi, "gemini", AsyncGeminiClient(self.fake.url, "test-key", max_retries=0)),
+            mock.patch.object(self.chat, "response_cache", ResponseCache(max_entries=0)),
+            mock.patch.object(self.chat, "inflight", SingleFlight()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = self.chat.app.test_client()
+        self.sessions = [f"class-{self.id()}-{i}" for i in range(10)]
+        for session_id in self.sessions:
+            self.client.post("/new_chat", json={"session_id": session_id})
+
+    def test_identical_questions_share_one_upstream_call(self):
+        def ask(session_id):
+            return self.client.post("/chat", json={"session_id": session_id,
+                                                   "message": "What is the credit count?"}).get_json()
+
+        with ThreadPoolExecutor(len(self.sessions)) as pool:
+            replies = list(pool.map(ask, self.sessions))
+
+        self.assertEqual(self.fake.requests, 1)
+        self.assertEqual({r["response"] for r in replies}, {self.fake.reply_text("What is the credit count?")})
+        stats = self.client.get("/cache_stats").get_json()["inflight"]
+        self.assertEqual((stats["upstream_calls"], stats["coalesced"]), (1, 9))
+        for session_id in self.sessions:
+            history = self.client.get(f"/get_history/{session_id}").get_json()
+            self.assertEqual([m["role"] for m in history], ["user", "model"])
+
+    def test_errors_reach_every_waiter(self):
+        self.fake.fail_next(400)
+        with ThreadPoolExecutor(4) as pool:
+            replies = list(pool.map(lambda s: self.client.post("/chat", json={"session_id": s, "message": "hi"}),
+                                    self.sessions[:4]))
+        self.assertEqual(self.fake.requests, 1)
+        self.assertTrue(all(not r.get_json()["success"] for r in replies))
+
+    def test_asgi_requests_are_coalesced(self):
+        async def run():
+            try:
+                return await asyncio.gather(*(
+                    call_asgi(self.asgi.application, "POST", "/chat", {"session_id": s, "message": "Syllabus?"})
+                    for s in self.sessions))
+            finally:
+                await self.asgi.gemini.aclose()
+
+        results = asyncio.run(run())
+        self.assertTrue(all(status == 200 and json.loads(body)["success"] for status, body in results))
+        self.assertEqual(self.fake.requests, 1)
+        self.assertEqual(self.chat.inflight.coalesced, 9)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def test_key_normalizes_question(self):
+        self.assertEqual(cache_key("doc", "What is  the credit count?", "m"),
+                         cache_key("doc", "what is the credit count", "m"))
+        self.assertNotEqual(cache_key("doc", "q", "m"), cache_key("other", "q", "m"))
+        self.assertNotEqual(cache_key("doc", "q", "m"), cache_key("doc", "q", "m2"))
+
+    def test_lru_eviction_and_counters(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        self.assertEqual(cache.get("a"), "1")
+        cache.set("c", "3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "3")
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = ResponseCache(ttl=10, clock=clock)
+        cache.set("a", "1")
+        clock.now = 11
+        self.assertIsNone(cache.get("a"))
+
+    def test_disk_tier_survives_restart(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.db")
+        ResponseCache(path=path).set("a", "1")
+        cache = ResponseCache(path=path)
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.stats()["disk_hits"], 1)
+
+    def test_chat_serves_repeats_from_cache(self):
+        chat = load_chat_app()
+        with FakeGemini(latency=0) as fake, \
+                mock.patch.object(chat, "gemini", GeminiClient(fake.url, "test-key")), \
+                mock.patch.object(chat, "response_cache", ResponseCache()):
+            client = chat.app.test_client()
+            for i, message in enumerate(("What is the syllabus?", "what is the syllabus", "What is the syllabus?")):
+                client.post("/new_chat", json={"session_id": f"cached-{i}"})
+                resp = client.post("/chat", json={"session_id": f"cached-{i}", "message": message})
+                self.assertTrue(resp.get_json()["success"])
+            self.assertEqual(fake.requests, 1)
+
+            client.post("/new_chat", json={"session_id": "cached-fresh"})
+            client.post("/chat", json={"session_id": "cached-fresh", "message": "What is the syllabus?",
+                                       "no_cache": True})
+            self.assertEqual(fake.requests, 2)
+            self.assertEqual(client.get("/cache_stats").get_json()["hits"], 2)
+
+    def test_follow_ups_after_different_conversations_are_not_shared(self):
+        chat = load_chat_app()
+        with FakeGemini(latency=0) as fake, \
+                mock.patch.object(chat, "gemini", GeminiClient(fake.url, "test-key")), \
+                mock.patch.object(chat, "response_cache", ResponseCache()):
+            client = chat.app.test_client()
+            for session_id, opening in (("follow-a", "What is unit 1 about?"), ("follow-b", "Who teaches unit 4?")):
+                client.post("/new_chat", json={"session_id": session_id})
+                client.post("/chat", json={"session_id": session_id, "message": opening})
+                client.post("/chat", json={"session_id": session_id, "message": "Tell me more"})
+            self.assertEqual(fake.requests, 4)
+
+            # The same conversation again is answered from the cache
+            client.post("/new_chat", json={"session_id": "follow-c"})
+            client.post("/chat", json={"session_id": "follow-c", "message": "What is unit 1 about?"})
+            client.post("/chat", json={"session_id": "follow-c", "message": "Tell me more"})
+            self.assertEqual(fake.requests, 4)
+
+
+class HistoryEndpointTests(unittest.TestCase):
+    def setUp(self):
+        self.chat = load_chat_app()
+        self.client = self.chat.app.test_client()
+        self.session_id = f"history-{time.monotonic_ns()}"
+        for i in range(25):
+            self.chat.save_to_db(self.session_id, "user", f"message {i}")
+
+    def get(self, query="", **headers):
+        return self.client.get(f"/get_history/{self.session_id}{query}", headers=headers)
+
+    def test_cursor_pagination(self):
+        full = self.get().get_json()
+        self.assertEqual([m["text"] for m in full], [f"message {i}" for i in range(25)])
+        ids = [m["id"] for m in full]
+
+        newest = self.get("?before=999999999&limit=10").get_json()
+        self.assertEqual([m["id"] for m in newest], ids[-10:])
+        older = self.get(f"?before={newest[0]['id']}&limit=10").get_json()
+        self.assertEqual([m["id"] for m in older], ids[5:15])
+
+        self.assertEqual([m["id"] for m in self.get(f"?since={ids[19]}").get_json()], ids[20:])
+        self.assertEqual([m["id"] for m in self.get(f"?since={ids[2]}&limit=3").get_json()], ids[3:6])
+        self.assertEqual(self.get("?limit=abc").status_code, 400)
+
+    def test_unchanged_history_is_not_modified(self):
+        resp = self.get("?limit=10")
+        etag = resp.headers["ETag"]
+        self.assertEqual(self.get("?limit=10", **{"If-None-Match": etag}).status_code, 304)
+        # Another view of the same history has its own tag
+        self.assertEqual(self.get("?limit=5", **{"If-None-Match": etag}).status_code, 200)
+
+        self.chat.save_to_db(self.session_id, "model", "new reply")
+        resp = self.get("?limit=10", **{"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()[-1]["text"], "new reply")
+
+    def test_streams_large_history_in_batches(self):
+        store = self.chat.history_store
+        for i in range(1200):
+            store.add(self.session_id, "model", f"bulk {i}")
+        chunks = list(store.json_chunks(self.session_id))
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(len(json.loads("".join(chunks))), 1225)
+
+
+class DjangoHistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.chat = load_chat_app()
+        from django.contrib.auth.models import User
+        from django.test import Client
+        name = f"student{time.monotonic_ns()}"
+        self.user = User.objects.create_user(name, password="pw")
+        self.client = Client(HTTP_HOST="localhost")
+        self.client.login(username=name, password="pw")
+
+    def test_reads_the_rows_written_by_the_shared_store(self):
+        store = self.chat.history_store
+        store.add("course", "user", "What is the credit count?", user_id=self.user.id)
+        store.add("course", "model", "Four credits.", user_id=self.user.id)
+        # Same session id without a user belongs to the Flask service
+        store.add("course", "user", "anonymous", user_id=None)
+        store.flush()
+
+        resp = self.client.get("/techjays/history/course/")
+        history = json.loads(b"".join(resp.streaming_content))
+        self.assertEqual([(m["role"], m["text"]) for m in history],
+                         [("user", "What is the credit count?"), ("model", "Four credits.")])
+        resp = self.client.get("/techjays/history/course/", HTTP_IF_NONE_MATCH=resp["ETag"])
+        self.assertEqual(resp.status_code, 304)
+
+        sessions = self.client.get("/techjays/history/").json()
+        self.assertEqual([s["session_id"] for s in sessions], ["course"])
+
+
+class HistoryWriteFailureTests(unittest.TestCase):
+    def setUp(self):
+        load_chat_app()
+        from chatbot.history import HistoryStore
+        from techjays.models import ChatHistory
+        self.ChatHistory = ChatHistory
+        self.store = HistoryStore(flush_interval=0.01, retries=2, retry_backoff=0.001)
+        self.addCleanup(self.store.close)
+        self.session = f"failing-{time.monotonic_ns()}"
+        self.bulk_create = ChatHistory.objects.bulk_create
+
+    def messages(self):
+        return [m for _, m in self.store.history(self.session)]
+
+    def test_failed_batches_are_retried(self):
+        calls = []
+
+        def flaky(*args, **kwargs):
+            calls.append(1)
+            if len(calls) < 3:
+                raise RuntimeError("database is locked")
+            return self.bulk_create(*args, **kwargs)
+
+        retries = metrics.HISTORY_WRITE_ERRORS.value(kind="retry")
+        with mock.patch.object(self.ChatHistory.objects, "bulk_create", flaky):
+            self.store.add(self.session, "user", "one")
+            self.store.add(self.session, "model", "two")
+            self.assertTrue(self.store.flush())
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(metrics.HISTORY_WRITE_ERRORS.value(kind="retry"), retries + 2)
+        self.assertEqual(self.messages(), ["one", "two"])
+
+    def test_one_bad_row_does_not_drop_the_batch(self):
+        save = self.ChatHistory.save
+
+        def save_unless_bad(row, *args, **kwargs):
+            if row.message == "bad":
+                raise ValueError("bad row")
+            return save(row, *args, **kwargs)
+
+        dropped = metrics.HISTORY_WRITE_ERRORS.value(kind="dropped")
+        with mock.patch.object(self.ChatHistory.objects, "bulk_create", side_effect=ValueError("bad row")), \
+                mock.patch.object(self.ChatHistory, "save", save_unless_bad), \
+                self.assertLogs("chatbot.history", "WARNING"):
+            for message in ("before", "bad", "after"):
+                self.store.add(self.session, "user", message)
+            self.assertFalse(self.store.flush())
+        self.assertEqual(metrics.HISTORY_WRITE_ERRORS.value(kind="dropped"), dropped + 1)
+        self.assertEqual(self.messages(), ["before", "after"])
+        self.assertTrue(self.store.flush())
+
+
+class HistoryExportTests(unittest.TestCase):
+    def setUp(self):
+        self.chat = load_chat_app()
+        from django.contrib.auth.models import User
+        from django.test import Client
+        self.name = f"student{time.monotonic_ns()}"
+        self.user = User.objects.create_user(self.name)
+        self.client = Client(HTTP_HOST="localhost")
+        self.client.force_login(self.user)
+        store = self.chat.history_store
+        for i in range(5):
+            store.add("course", "user", f"question {i}", user_id=self.user.id)
+        store.add("other", "user", "elsewhere", user_id=self.user.id)
+        store.add("course", "user", "anonymous", user_id=None)
+        store.flush()
+
+    def read(self, data):
+        import gzip
+        return [json.loads(line) for line in gzip.decompress(data).splitlines()]
+
+    def test_exports_one_scope_as_gzipped_json_lines(self):
+        from chatbot.history import iter_jsonl_gz
+        rows = self.read(b"".join(iter_jsonl_gz(
+            self.chat.history_store.export(batch=2, user_id=self.user.id, session_id="course"), chunk_bytes=64)))
+        self.assertEqual([r["message"] for r in rows], [f"question {i}" for i in range(5)])
+        self.assertEqual({r["user"] for r in rows}, {self.name})
+
+        resp = self.client.get("/chatbot/history_export/")
+        self.assertEqual(resp["Content-Type"], "application/gzip")
+        rows = self.read(b"".join(resp.streaming_content))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(len(self.read(b"".join(self.client.get(
+            "/chatbot/history_export/", {"session_id": "other"}).streaming_content))), 1)
+        self.assertEqual(self.read(b"".join(self.client.get(
+            "/chatbot/history_export/", {"since": "2999-01-01"}).streaming_content)), [])
+        self.assertEqual(self.client.get("/chatbot/history_export/", {"until": "yesterday"}).status_code, 400)
+
+        # The Flask service exports its own, user-less rows
+        resp = self.chat.app.test_client().get("/export_history/course")
+        self.assertEqual([r["message"] for r in self.read(resp.data)][-1:], ["anonymous"])
+
+    def test_import_round_trip_in_batches(self):
+        from chatbot.history import import_rows
+        from techjays.models import ChatHistory
+        exported = list(self.chat.history_store.export(user_id=self.user.id))
+        ghost = dict(exported[0], user="nobody-here")
+        before = ChatHistory.objects.filter(user=self.user).count()
+        self.assertEqual(import_rows(exported + [ghost], batch_size=4), (6, 1))
+        imported = ChatHistory.objects.filter(user=self.user).order_by("id")[before:]
+        self.assertEqual([(r.session_id, r.message, r.timestamp.isoformat()) for r in imported],
+                         [(r["session_id"], r["message"], r["timestamp"]) for r in exported])
+
+    def test_reads_the_legacy_session_database(self):
+        import sqlite3
+        from chatbot.history import legacy_rows
+        path = os.path.join(tempfile.mkdtemp(), "chat_session.db")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE chat_history (session_id TEXT, role TEXT, message TEXT)")
+        conn.executemany("INSERT INTO chat_history VALUES (?, ?, ?)", [("s", "user", "hi"), ("s", "model", "hello")])
+        conn.commit()
+        conn.close()
+        self.assertEqual([(r["role"], r["message"], r["user"]) for r in legacy_rows(path)],
+                         [("user", "hi", None), ("model", "hello", None)])
+
+
+class DjangoChatViewTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGemini(latency=0).start()
+        self.addCleanup(self.fake.stop)
+        self.chat = load_chat_app()
+        self.jobs = self.chat.ExtractionJobs(workers=1)
+        self.addCleanup(self.jobs.shutdown)
+        folder = tempfile.mkdtemp()
+        self.store = DocumentStore(os.path.join(folder, "documents.db"), folder)
+        for patcher in (
+            mock.patch.object(self.chat, "gemini", GeminiClient(self.fake.url, "test-key", max_retries=0)),
+            mock.patch.object(self.chat, "response_cache", ResponseCache()),
+            mock.patch.object(self.chat, "extraction_jobs", self.jobs),
+            mock.patch.object(self.chat, "document_store", self.store),
+            mock.patch.object(self.chat, "corpus_indexes", CorpusIndexes(tempfile.mkdtemp())),
+            mock.patch.dict(self.chat.app.config, {"UPLOAD_FOLDER": folder}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        from django.contrib.auth.models import User
+        from django.test import Client
+        self.Client = Client
+        self.clients = []
+        for i in range(2):
+            client = Client(HTTP_HOST="localhost")
+            client.force_login(User.objects.create_user(f"student{time.monotonic_ns()}"))
+            self.clients.append(client)
+        self.client = self.clients[0]
+        self.client.post("/chatbot/new_chat/", {"session_id": "course"}, content_type="application/json")
+
+    def post(self, path, data, client=None):
+        return (client or self.client).post(path, data, content_type="application/json")
+
+    def test_chat_is_answered_in_process_and_scoped_to_the_user(self):
+        resp = self.post("/chatbot/chat/", {"session_id": "course", "message": "hello"})
+        self.assertTrue(resp.json()["success"])
+        self.assertEqual(self.fake.requests, 1)
+
+        history = json.loads(b"".join(self.client.get("/chatbot/history/course/").streaming_content))
+        self.assertEqual([m["role"] for m in history], ["user", "model"])
+
+        # The same session id means nothing to another user
+        other = self.clients[1]
+        self.assertEqual(self.post("/chatbot/chat/", {"session_id": "course", "message": "hi"}, other).status_code,
+                         400)
+        self.assertEqual(json.loads(b"".join(other.get("/chatbot/history/course/").streaming_content)), [])
+        self.assertEqual(self.Client(HTTP_HOST="localhost").get("/chatbot/history/course/").status_code, 401)
+
+    def test_stream_and_delete(self):
+        resp = self.post("/chatbot/chat_stream/", {"session_id": "course", "message": "hi"})
+        body = b"".join(resp.streaming_content).decode()
+        self.assertIn("event: done", body)
+        self.assertTrue(self.post("/chatbot/delete_chat/", {"session_id": "course"}).json()["success"])
+        self.assertEqual(self.post("/chatbot/chat/", {"session_id": "course", "message": "hi"}).status_code, 400)
+
+    def test_upload_extracts_in_background(self):
+        path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads", "resume.pdf")
+        with open(path, "rb") as f:
+            resp = self.client.post("/chatbot/upload/", {"session_id": "course", "file": f})
+        self.assertEqual(resp.status_code, 202)
+        job_id = resp.json()["job_id"]
+        deadline = time.monotonic() + 30
+        while self.client.get(f"/chatbot/upload_status/{job_id}/").json()["state"] == "running":
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        self.assertTrue(self.chat.session_store.get(f"user-{self.client.session['_auth_user_id']}:course").text)
+        self.assertEqual(self.store.stats()["documents"], 1)
+        self.assertEqual(self.client.get("/chatbot/document_overview/course/").json()["state"], "unavailable")
+        self.assertEqual(self.clients[1].get("/chatbot/document_overview/course/").status_code, 404)
+
+        # The document also joined the user's corpus, and only theirs
+        corpus = self.client.get("/chatbot/corpus/").json()
+        self.assertEqual([d["name"] for d in corpus["documents"]], ["resume.pdf"])
+        self.assertEqual(self.clients[1].get("/chatbot/corpus/").json()["documents"], [])
+        passages = self.client.get("/chatbot/corpus/search/", {"q": "skills projects"}).json()["passages"]
+        self.assertEqual(passages[0]["name"], "resume.pdf")
+        document = corpus["documents"][0]["document"]
+        self.assertEqual(self.post("/chatbot/corpus/remove/", {"document": document}).status_code, 200)
+        self.assertEqual(self.post("/chatbot/corpus/remove/", {"document": document}).status_code, 404)
+
+    def test_site_uploads_join_the_corpus(self):
+        from django.contrib.auth.models import User
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.test import RequestFactory, override_settings
+        from techjays import views as site_views
+        user = User.objects.create_user(f"student{time.monotonic_ns()}")
+        request = RequestFactory().post("/techjays/upload/", {"file": SimpleUploadedFile(
+            "optics.txt", b"Optical fibre carries light by total internal reflection.\n" * 5)})
+        request.user = user
+        with override_settings(MEDIA_ROOT=tempfile.mkdtemp()), mock.patch.object(site_views, "messages"):
+            self.assertEqual(site_views.upload_file(request).status_code, 302)
+
+        corpus = self.chat.corpus_indexes.get(user.pk)
+        deadline = time.monotonic() + 30
+        while not corpus.documents():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        self.assertEqual([name for _, name, _ in corpus.documents()], ["optics.txt"])
+        self.assertEqual(corpus.passages("optical fibre light")[0][0], "optics.txt")
+
+    def test_upload_limits_and_csrf(self):
+        with mock.patch.dict(self.chat.app.config, {"UPLOAD_MAX_BYTES": 1024}):
+            resp = self.client.post("/chatbot/upload/", {"session_id": "course",
+                                                         "file": io.BytesIO(b"%PDF" + b"0" * 4096)})
+        self.assertEqual(resp.status_code, 413)
+        self.assertEqual([f for f in os.listdir(self.store.blob_dir) if f.endswith(".part")], [])
+
+        strict = self.Client(HTTP_HOST="localhost", enforce_csrf_checks=True)
+        strict.cookies = self.client.cookies
+        self.assertEqual(strict.post("/chatbot/upload/", {"session_id": "course"}).status_code, 403)
+        self.assertEqual(self.post("/chatbot/new_chat/", {"session_id": "x"}, strict).status_code, 403)
+
+    def test_health_and_metrics(self):
+        self.assertEqual(self.Client(HTTP_HOST="localhost").get("/chatbot/health/").json(),
+                         {"database": "ok", "upstream": "closed"})
+        # Metrics are for staff and the configured scrapers only
+        self.assertEqual(self.client.get("/chatbot/metrics/").status_code, 403)
+        from django.test import override_settings
+        with override_settings(METRICS_ALLOWED_IPS=["127.0.0.1"]):
+            self.assertEqual(self.Client(HTTP_HOST="localhost").get("/chatbot/metrics/").status_code, 200)
+
+    def test_management_commands_do_not_start_the_service(self):
+        import subprocess
+        import sys
+        workdir = tempfile.mkdtemp()
+        manage = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "manage.py")
+        env = dict(os.environ, DB_ENGINE="django.db.backends.sqlite3",
+                   DB_NAME=os.path.join(tempfile.mkdtemp(), "db.sqlite3"))
+        for name in ("DOCSTORE_DB", "SESSION_DB", "STORAGE_DB", "CORPUS_DIR"):
+            env.pop(name, None)
+        subprocess.run([sys.executable, manage, "check"], cwd=workdir, env=env, check=True, capture_output=True)
+        self.assertEqual(os.listdir(workdir), [])
+
+
+class CorpusIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = CorpusIndex(self.directory, chunk_chars=200, overlap_chars=0)
+        self.index.add("networks", "networks.md",
+                       "The physical layer transmits raw bits over copper, fibre and radio.\n" * 3 +
+                       "Ethernet frames carry a destination MAC address.\n" * 3)
+        self.index.add("course", "course.pdf",
+                       "Signals and systems is a four credit course.\n" * 3 +
+                       "The evaluation is 50 percent internal and 50 percent end semester.\n" * 3)
+
+    def test_batched_search_finds_passages_across_documents(self):
+        physical, credits = self.index.search(["physical layer bits", "how many credits is signals and systems"], k=2)
+        rows = dict(self.index._connection().execute("SELECT row, document FROM chunks"))
+        self.assertEqual(rows[physical[0][0]], "networks")
+        self.assertEqual(rows[credits[0][0]], "course")
+        self.assertGreater(physical[0][1], physical[-1][1] - 1e-6)
+        self.assertNotIn("networks.md", [name for name, _ in self.index.passages("physical layer",
+                                                                                exclude="networks")])
+
+    def test_tombstones_hide_documents_until_compacted_away(self):
+        self.assertEqual(self.index.add("course", "course.pdf", "again"), 0)
+        self.assertTrue(self.index.remove("networks"))
+        self.assertEqual([name for name, _ in self.index.passages("physical layer bits")], [])
+        stats = self.index.stats()
+        self.assertGreater(stats["tombstones"], 0)
+
+        size = stats["vector_bytes"]
+        self.assertEqual(self.index.compact(), stats["chunks"])
+        self.assertLess(self.index.stats()["vector_bytes"], size)
+        self.assertEqual(self.index.stats()["tombstones"], 0)
+
+        # A fresh instance (another process) reads the same files
+        reopened = CorpusIndex(self.directory, chunk_chars=200, overlap_chars=0)
+        self.assertEqual(reopened.passages("four credit course")[0][0], "course.pdf")
+        self.assertEqual([d for d, _, _ in reopened.documents()], ["course"])
+
+    def test_compaction_copies_outside_the_lock(self):
+        self.index.remove("networks")
+        copy_rows = self.index._copy_rows
+        during = []
+
+        def copy_and_change(src, dst, rows):
+            if not during:
+                # Neither blocks: the lock is free while the vectors are copied
+                during.append(self.index.add("optics", "optics.md", "Fibre carries light.\n" * 3))
+                during.append(self.index.remove("course"))
+            copy_rows(src, dst, rows)
+
+        with mock.patch.object(self.index, "_copy_rows", copy_and_change):
+            kept = self.index.compact()
+        self.assertEqual(during[1], True)
+        # The course chunks removed meanwhile stay as tombstones for next time
+        stats = self.index.stats()
+        self.assertEqual(kept, stats["chunks"] + stats["tombstones"])
+        self.assertEqual(stats["chunks"], during[0])
+        self.assertEqual([name for name, _ in self.index.passages("fibre carries light")], ["optics.md"])
+        self.assertEqual(self.index.passages("four credit course"), [])
+        self.assertEqual(self.index.compact(), during[0])
+        self.assertEqual(self.index.passages("fibre carries light")[0][0], "optics.md")
+
+    def test_prompt_includes_other_documents(self):
+        chat = load_chat_app()
+        chat.session_store.create("corpus")
+        chat.session_store.set_document("corpus", "course", "Signals and systems is a four credit course.")
+        chat.session_store.append_message("corpus", "user", "What does the physical layer transmit?")
+        prompt = chat.build_prompt("corpus", "What does the physical layer transmit?", self.index)
+        self.assertIn("From your other documents:", prompt)
+        self.assertIn("[networks.md]", prompt)
+        self.assertNotIn("[course.pdf]", prompt)
+        self.assertNotEqual(chat.answer_cache_key("corpus", "q", self.index), chat.answer_cache_key("corpus", "q"))
+
+
+class RetrievalTests(unittest.TestCase):
+    def test_chunks_break_on_lines_and_overlap(self):
+        text = "\n".join(f"line {i:02d} " + "x" * 40 for i in range(20))
+        chunks = split_chunks(text, chunk_chars=200, overlap_chars=100)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= 200 for chunk in chunks))
+        for chunk, following in zip(chunks, chunks[1:]):
+            lines = chunk.splitlines()
+            # Whole lines only, and the next chunk repeats the last ones
+            self.assertTrue(all(line.startswith("line ") for line in lines))
+            self.assertTrue(following.startswith(lines[-1]) or following.startswith(lines[-2]))
+            self.assertIn(lines[-1], following.splitlines())
+        self.assertEqual(chunks[0].splitlines()[0], "line 00 " + "x" * 40)
+        self.assertEqual(chunks[-1].splitlines()[-1], "line 19 " + "x" * 40)
+
+    def test_lines_longer_than_a_chunk_are_split_on_spaces(self):
+        chunks = split_chunks("word " * 100, chunk_chars=60, overlap_chars=0)
+        self.assertTrue(all(0 < len(chunk) <= 60 for chunk in chunks))
+        self.assertEqual(" ".join(chunks).split(), ["word"] * 100)
+
+    def test_empty_document_and_empty_query(self):
+        empty = DocumentIndex("")
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.top_chunks("anything"), [])
+        self.assertEqual(empty.context_for("anything"), "")
+
+        index = DocumentIndex("alpha\n" * 3 + "beta\n" * 3, chunk_chars=12, overlap_chars=0)
+        # Nothing to match: the start of the document, in order
+        self.assertEqual(index.top_chunks("", k=2), [0, 1])
+        self.assertEqual(index.top_chunks("zeta", k=2), [0, 1])
+
+    def test_ranks_chunks_by_bm25(self):
+        corpus = [
+            "the signals course covers sampling",
+            "fourier transform fourier series and fourier analysis",
+            "the lab covers the fourier transform once",
+            "grading is by continuous assessment",
+        ]
+        index = DocumentIndex("\n".join(corpus), chunk_chars=60, overlap_chars=0)
+        self.assertEqual(index.chunks, corpus)
+        self.assertEqual(index.top_chunks("fourier"), [1, 2])
+        self.assertEqual(index.top_chunks("fourier grading"), [3, 1, 2])
+        self.assertEqual(index.top_chunks("fourier", k=1), [1])
+        # Over budget chunks are skipped, not cut
+        self.assertEqual(index.top_chunks("fourier", budget_chars=45), [2])
+        self.assertEqual(index.context_for("grading fourier"), "\n\n".join(corpus[1:]))
+
+
+class SessionStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "sessions.db")
+        self.documents = {}
+        self.store = SessionStore(self.path, budget_bytes=64 * 1024, make_index=DocumentIndex,
+                                  load_text=lambda digest: self.documents.get(digest, ""))
+
+    def test_evicts_least_recently_used_and_reloads(self):
+        text = "lecture notes " * 2000
+        for i in range(5):
+            self.documents[f"doc{i}"] = text
+            self.store.create(f"s{i}")
+            self.store.set_document(f"s{i}", f"doc{i}", text)
+            self.store.append_message(f"s{i}", "user", f"question {i}")
+
+        stats = self.store.stats()
+        self.assertLessEqual(stats["bytes_in_memory"], stats["budget_bytes"])
+        self.assertGreater(stats["evictions"], 0)
+        self.assertEqual(stats["sessions"], 5)
+
+        session = self.store.get("s0")
+        self.assertEqual(session.text, text)
+        self.assertEqual(session.messages, [{"role": "user", "text": "question 0", "tokens": 2}])
+        self.assertIsNotNone(session.index)
+        self.assertEqual(self.store.stats()["loads"], 1)
+
+    def test_other_processes_see_changes(self):
+        other = SessionStore(self.path)
+        self.store.create("shared")
+        self.assertIsNotNone(other.get("shared"))
+
+        other.append_message("shared", "user", "hi")
+        self.assertEqual(self.store.get("shared").messages, [{"role": "user", "text": "hi", "tokens": 1}])
+
+        self.assertIsNone(self.store.delete("shared"))
+        self.assertNotIn("shared", other)
+        self.assertFalse(other.append_message("shared", "user", "gone"))
+
+    def test_cached_get_reads_only_the_revision(self):
+        self.documents["doc"] = "lecture notes " * 2000
+        self.store.create("s")
+        self.store.set_document("s", "doc", self.documents["doc"])
+        conn = self.store._connection()
+        # The text is kept once, in the document store
+        self.assertNotIn("text", [row[1] for row in conn.execute('PRAGMA table_info(sessions)')])
+
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            self.assertEqual(self.store.get("s").text, self.documents["doc"])
+        finally:
+            conn.set_trace_callback(None)
+        self.assertEqual(statements, ["SELECT revision FROM sessions WHERE session_id = 's'"])
+
+        # A session loaded from disk reads its text through load_text
+        other = SessionStore(self.path, load_text=self.documents.get)
+        self.assertEqual(other.get("s").text, self.documents["doc"])
+
+
+class ConversationContextTests(unittest.TestCase):
+    def setUp(self):
+        self.store = SessionStore(os.path.join(tempfile.mkdtemp(), "sessions.db"))
+        self.builder = ContextBuilder(budget_tokens=300, summary_tokens=60)
+        self.summarize_calls = 0
+
+    def summarize(self, prompt):
+        # Stand-in for the model: keep the tail of the prompt, which the
+        # builder then caps at summary_tokens
+        self.summarize_calls += 1
+        return " ".join(prompt.split()[-80:])
+
+    def talk(self, turns, summarizer):
+        sizes = []
+        self.store.create("long")
+        for i in range(turns):
+            question = f"Question {i}: what does section {i % 17} of the syllabus say about grading?"
+            self.store.append_message("long", "user", question)
+            session = self.store.get("long")
+            conversation = self.builder.build(session.summary, session.messages[session.summarized:-1])
+            sizes.append(count_tokens(conversation))
+            self.store.append_message("long", "model", f"Answer {i}: section {i % 17} covers " + "details " * 20)
+            if summarizer:
+                summarizer.request("long")
+                summarizer.join()
+        return sizes
+
+    def test_prompt_stays_bounded_over_long_session(self):
+        summarizer = Summarizer(self.store, self.builder, self.summarize)
+        sizes = self.talk(500, summarizer)
+        self.assertLessEqual(max(sizes), 300)
+        self.assertLess(max(sizes[-100:]) - min(sizes[-100:]), 150)
+
+        session = self.store.get("long")
+        self.assertTrue(session.summary)
+        self.assertLessEqual(count_tokens(session.summary), 60)
+        self.assertGreater(session.summarized, 900)
+        self.assertEqual(summarizer.failures, 0)
+        # Turns are folded in batches, not one summary call per turn
+        self.assertLess(self.summarize_calls, 250)
+
+    def test_budget_holds_while_summarizer_lags(self):
+        sizes = self.talk(500, None)
+        self.assertLessEqual(max(sizes), 300)
+        self.assertEqual(self.store.get("long").summarized, 0)
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGemini(latency=0.01).start()
+        self.addCleanup(self.fake.stop)
+        self.chat = load_chat_app()
+        for patcher in (
+            mock.patch.object(self.chat, "gemini", GeminiClient(self.fake.url, "test-key", max_retries=0)),
+            mock.patch.object(self.chat, "response_cache", ResponseCache()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = self.chat.app.test_client()
+        self.client.post("/new_chat", json={"session_id": "metrics"})
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram("t_seconds", "test", ("stage",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value, stage='say "hi"')
+        lines = histogram.render()
+        self.assertIn('t_seconds_bucket{stage="say \\"hi\\"",le="0.1"} 1', lines)
+        self.assertIn('t_seconds_bucket{stage="say \\"hi\\"",le="1.0"} 3', lines)
+        self.assertIn('t_seconds_bucket{stage="say \\"hi\\"",le="+Inf"} 4', lines)
+        self.assertIn('t_seconds_count{stage="say \\"hi\\""} 4', lines)
+
+    def test_chat_stages_and_counters_reach_metrics(self):
+        before = metrics.STAGE_SECONDS.samples(("chat", "gemini"))[0]
+        self.client.post("/new_chat", json={"session_id": "metrics-2"})
+        self.client.post("/chat", json={"session_id": "metrics", "message": "hello"})
+        self.client.post("/chat", json={"session_id": "metrics-2", "message": "hello"})
+        # The second answer came from the cache, so only one upstream round trip
+        self.assertEqual(metrics.STAGE_SECONDS.samples(("chat", "gemini"))[0], before + 1)
+
+        body = self.client.get("/metrics").get_data(as_text=True)
+        for stage in ("save_to_db", "cache_lookup", "build_prompt", "upstream_request", "upstream_parse"):
+            self.assertIn(f'chatbot_stage_seconds_count{{route="chat",stage="{stage}"}}', body)
+        self.assertIn('chatbot_response_cache_lookups_total{result="hit"} 1', body)
+        self.assertIn('chatbot_request_seconds_bucket{route="chat",status="200",le="+Inf"}', body)
+        self.assertRegex(body, r"\nchatbot_sessions \d+\n")
+
+    def test_operator_endpoints_are_gated(self):
+        remote = {"REMOTE_ADDR": "203.0.113.9"}
+        for path in ("/metrics", "/debug/profiles", "/cache_stats", "/session_stats"):
+            self.assertEqual(self.client.get(path, environ_base=remote).status_code, 403)
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+        with mock.patch.object(self.chat, "METRICS_TOKEN", "s3cret"):
+            self.assertEqual(self.client.get("/metrics", environ_base=remote,
+                                             headers={"X-Metrics-Token": "wrong"}).status_code, 403)
+            self.assertEqual(self.client.get("/metrics", environ_base=remote,
+                                             headers={"X-Metrics-Token": "s3cret"}).status_code, 200)
+        with mock.patch.object(self.chat, "METRICS_ALLOWED_IPS", set()):
+            self.assertEqual(self.client.get("/session_stats").status_code, 403)
+
+    def test_upstream_errors_are_counted(self):
+        before = metrics.UPSTREAM_ERRORS.value(kind="error")
+        self.fake.fail_next(400)
+        self.client.post("/chat", json={"session_id": "metrics", "message": "bad", "no_cache": True})
+        self.assertEqual(metrics.UPSTREAM_ERRORS.value(kind="error"), before + 1)
+
+    def test_profiler_keeps_slowest_requests(self):
+        profiler = metrics.SamplingProfiler(keep=2, interval=0.001)
+        for seconds in (0.01, 0.05, 0.03):
+            profiler.begin()
+            time.sleep(seconds)
+            profiler.end("sleep", seconds)
+        profiles = profiler.profiles()
+        self.assertEqual([p["duration_ms"] for p in profiles], [50.0, 30.0])
+        self.assertGreater(profiles[0]["samples"], 0)
+        self.assertIn("test_profiler_keeps_slowest_requests", profiles[0]["folded"])
+
+        self.assertEqual(self.client.get("/debug/profiles").status_code, 404)
+        with mock.patch.object(self.chat, "profiler", metrics.SamplingProfiler(keep=1)):
+            self.client.post("/new_chat", json={"session_id": "metrics"})
+            self.assertEqual(self.client.get("/debug/profiles").get_json()["profiles"][0]["route"], "new_chat")
+
+
+class MapReduceTests(unittest.TestCase):
+    def setUp(self):
+        # Ten shards; only those about fibre have an answer
+        self.text = "\n".join(f"Part {i} is about {'fibre optics' if i in (2, 7) else 'circuits'}. " + "x" * 80
+                              for i in range(10))
+        self.running = 0
+        self.peak = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def generate(self, prompt):
+        with self.lock:
+            self.calls += 1
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        if "fibre" not in prompt.split("\n\nQuestion:")[0]:
+            return NO_EVIDENCE
+        return "Fibre is covered in " + prompt.split("Part ", 2)[2].split(" is about")[0]
+
+    def test_asks_every_shard_within_the_concurrency_limit(self):
+        mapper = MapReduce(self.generate, shard_chars=120, concurrency=3, enough=0, overlap_chars=0)
+        partials, stats = mapper.map("what about fibre?", self.text)
+        self.assertEqual(stats["shards"], 10)
+        self.assertEqual(self.calls, 10)
+        self.assertLessEqual(self.peak, 3)
+        self.assertGreater(self.peak, 1)
+        # Partial answers come back in document order
+        self.assertEqual(partials, [(2, "Fibre is covered in 2"), (7, "Fibre is covered in 7")])
+        self.assertEqual((stats["relevant"], stats["cancelled"]), (2, 0))
+
+    def test_cancels_remaining_shards_once_enough_evidence(self):
+        mapper = MapReduce(self.generate, shard_chars=120, concurrency=2, enough=2, overlap_chars=0)
+        partials, stats = mapper.map("what about fibre?", self.text)
+        # The shards mentioning fibre are asked first
+        self.assertEqual([i for i, _ in partials], [2, 7])
+        self.assertLess(self.calls, 10)
+        self.assertGreater(stats["cancelled"], 0)
+
+    def test_no_call_in_flight_is_wasted_once_enough_evidence(self):
+        mapper = MapReduce(self.generate, shard_chars=120, concurrency=4, enough=2, overlap_chars=0)
+        partials, stats = mapper.map("what about fibre?", self.text)
+        # Only as many calls are made at once as answers are still needed
+        self.assertEqual([i for i, _ in partials], [2, 7])
+        self.assertEqual((self.calls, self.peak), (2, 2))
+        self.assertEqual((stats["answered"], stats["cancelled"]), (2, 8))
+
+    def test_failures(self):
+        def broken(prompt):
+            raise UpstreamError("boom")
+        with self.assertRaises(UpstreamError):
+            MapReduce(broken, shard_chars=120, overlap_chars=0).map("fibre", self.text)
+
+        def flaky(prompt):
+            if "Part 2 " in prompt:
+                raise UpstreamError("boom")
+            return self.generate(prompt)
+        partials, stats = MapReduce(flaky, shard_chars=120, enough=0, overlap_chars=0).map("fibre", self.text)
+        self.assertEqual(([i for i, _ in partials], stats["failed"]), ([7], 1))
+
+        def circuit_open(prompt):
+            raise CircuitOpenError("open")
+        with self.assertRaises(CircuitOpenError):
+            MapReduce(circuit_open, shard_chars=120, overlap_chars=0).map("fibre", self.text)
+
+    def test_oversized_document_is_answered_map_reduce(self):
+        chat = load_chat_app()
+        with FakeGemini(latency=0) as fake, \
+                mock.patch.object(chat, "gemini", GeminiClient(fake.url, "test-key")), \
+                mock.patch.object(chat, "response_cache", ResponseCache(max_entries=0)), \
+                mock.patch.object(chat, "RETRIEVAL_ENABLED", False), \
+                mock.patch.object(chat, "CONTEXT_WINDOW_CHARS", 500), \
+                mock.patch.object(chat.map_reduce, "shard_chars", 250), \
+                mock.patch.object(chat.map_reduce, "enough", 0):
+            client = chat.app.test_client()
+            client.post("/new_chat", json={"session_id": "long"})
+            chat.session_store.set_document("long", "long", self.text)
+            self.assertIn(REDUCE_HEADER, chat.build_prompt("long", "what about fibre?"))
+            shards = chat.map_reduce.last_run["shards"]
+            self.assertGreater(shards, 1)
+
+            fake.reset_stats()
+            resp = client.post("/chat", json={"session_id": "long", "message": "what about fibre?"})
+            self.assertTrue(resp.get_json()["success"])
+            # One call per shard, then the reduce call
+            self.assertEqual(fake.requests, shards + 1)
+
+    def test_whole_document_questions_are_answered_map_reduce_with_retrieval_on(self):
+        self.assertTrue(asks_about_whole_document("Summarize this document"))
+        self.assertTrue(asks_about_whole_document("List all the course outcomes"))
+        self.assertFalse(asks_about_whole_document("what about fibre?"))
+        chat = load_chat_app()
+        with FakeGemini(latency=0) as fake, \
+                mock.patch.object(chat, "gemini", GeminiClient(fake.url, "test-key")), \
+                mock.patch.object(chat, "RETRIEVAL_ENABLED", True), \
+                mock.patch.object(chat, "RETRIEVAL_BUDGET_CHARS", 300), \
+                mock.patch.object(chat, "CONTEXT_WINDOW_CHARS", 500), \
+                mock.patch.object(chat.map_reduce, "shard_chars", 250), \
+                mock.patch.object(chat.map_reduce, "enough", 0):
+            client = chat.app.test_client()
+            client.post("/new_chat", json={"session_id": "whole"})
+            chat.session_store.set_document("whole", "whole", self.text)
+            self.assertNotIn(REDUCE_HEADER, chat.build_prompt("whole", "what about fibre?"))
+            self.assertEqual(fake.requests, 0)
+            self.assertIn(REDUCE_HEADER, chat.build_prompt("whole", "Summarize the fibre parts"))
+            self.assertGreater(fake.requests, 1)
+
+            fake.reset_stats()
+            with mock.patch.object(chat, "MAP_REDUCE_ALWAYS", True):
+                self.assertIn(REDUCE_HEADER, chat.build_prompt("whole", "what about fibre?"))
+            # Under the window, the whole text rather than a few passages
+            with mock.patch.object(chat, "CONTEXT_WINDOW_CHARS", len(self.text) + 1):
+                self.assertIn("Part 9 is about circuits", chat.build_prompt("whole", "Summarize it"))
+
+
+class StorageManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = StorageManager(os.path.join(tempfile.mkdtemp(), "storage.db"), user_quota_bytes=250,
+                                      global_quota_bytes=1000, ttl=100, grace=10)
+        self.live = set()
+        self.deleted = []
+        self.storage.add_root(self.directory, r"doc-\d+|\.upload-.*\.part",
+                              referenced=lambda path: os.path.basename(path) in self.live,
+                              on_delete=self.deleted.append)
+
+    def write(self, name, size, user_id=None, session_id=None, age=0):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(path, (time.time() - age, time.time() - age))
+        if user_id is not None or session_id is not None:
+            self.storage.track(path, user_id, session_id, accessed=time.time() - age)
+        return path
+
+    def test_usage_and_quotas(self):
+        self.write("doc-1", 100, user_id=1, session_id="a")
+        self.write("doc-2", 100, user_id=1, session_id="b")
+        self.write("doc-3", 300, user_id=2, session_id="c")
+        self.assertEqual(self.storage.usage(1), {"files": 2, "bytes": 200})
+        self.assertEqual(self.storage.usage(), {"files": 3, "bytes": 500})
+        self.storage.check_quota(1, 50)
+        with self.assertRaisesRegex(QuotaExceeded, "quota exceeded"):
+            self.storage.check_quota(1, 51)
+        with self.assertRaisesRegex(QuotaExceeded, "full"):
+            self.storage.check_quota(None, 501)
+
+    def test_sweeps_orphaned_expired_and_stray_files(self):
+        self.live.update({"doc-1", "doc-2", "doc-5"})
+        kept = self.write("doc-1", 10, user_id=1, age=50)
+        orphan = self.write("doc-3", 10, user_id=1, age=50)
+        expired = self.write("doc-2", 10, user_id=1, age=200)
+        young_orphan = self.write("doc-4", 10, user_id=1, age=1)
+        stray = self.write(".upload-abc.part", 10, age=50)
+        untracked = self.write("doc-5", 10, age=50)
+        unmanaged = self.write("notes.txt", 10, age=500)
+        missing = self.write("doc-6", 10, user_id=1, age=50)
+        os.remove(missing)
+
+        report = self.storage.sweep()
+        self.assertEqual(report, {"missing": 1, "orphans": 1, "expired": 1, "evicted": 0, "untracked": 1})
+        self.assertEqual(sorted(self.deleted), sorted([orphan, expired, stray]))
+        for path in (kept, young_orphan, untracked, unmanaged):
+            self.assertTrue(os.path.exists(path))
+        # A file still referenced but never recorded is adopted
+        self.assertEqual(self.storage.usage()["files"], 3)
+
+    def test_recently_used_files_outlive_the_ttl(self):
+        self.live.update({"doc-1", "doc-2"})
+        used = self.write("doc-1", 10, user_id=1, age=200)
+        unused = self.write("doc-2", 10, user_id=1, age=200)
+        self.storage.touch(used)
+        # Only the first touch in a touch_interval is written
+        self.storage.touch(used, now=time.time() - 500)
+        # Files of a root that does not expire stay while they are listed
+        listed = tempfile.mkdtemp()
+        self.storage.add_root(listed, referenced=lambda path: path.endswith("keep"), expires=False)
+        kept, dropped = (os.path.join(listed, name) for name in ("keep", "drop"))
+        for path in (kept, dropped):
+            with open(path, "wb") as f:
+                f.write(b"x" * 600)
+            self.storage.track(path, user_id=2, accessed=time.time() - 500)
+
+        report = self.storage.sweep()
+        self.assertEqual((report["expired"], report["orphans"], report["evicted"]), (1, 1, 0))
+        self.assertEqual([os.path.exists(p) for p in (used, unused, kept, dropped)], [True, False, True, False])
+
+    def test_chat_turns_mark_the_document_used(self):
+        chat = load_chat_app()
+        folder = tempfile.mkdtemp()
+        store = DocumentStore(os.path.join(folder, "documents.db"), folder)
+        storage = StorageManager(os.path.join(folder, "storage.db"), ttl=100, grace=10)
+        with FakeGemini(latency=0) as fake, \
+                mock.patch.object(chat, "gemini", GeminiClient(fake.url, "test-key")), \
+                mock.patch.object(chat, "document_store", store), \
+                mock.patch.object(chat, "storage", storage), \
+                mock.patch.object(chat, "extraction_jobs", mock.Mock()), \
+                mock.patch.dict(chat.app.config, {"UPLOAD_FOLDER": folder}):
+            storage.add_root(folder, referenced=store.referenced)
+            client = chat.app.test_client()
+            client.post("/new_chat", json={"session_id": "used"})
+            client.post("/upload", data={"session_id": "used", "file": (io.BytesIO(b"a" * 10), "a.txt")})
+            path = store.path(chat.session_store.get("used").document)
+            storage.track(path, accessed=time.time() - 200)
+            client.post("/chat", json={"session_id": "used", "message": "hello"})
+            self.assertEqual(storage.sweep()["expired"], 0)
+            self.assertTrue(os.path.exists(path))
+
+    def test_evicts_least_recently_used_over_global_quota(self):
+        self.live.update(f"doc-{i}" for i in range(6))
+        paths = [self.write(f"doc-{i}", 200, user_id=i, age=60 - i) for i in range(6)]
+        self.storage.touch(paths[0])
+        report = self.storage.sweep()
+        # 1200 bytes down to 90% of 1000: the two least recently used go
+        self.assertEqual(report["evicted"], 2)
+        self.assertEqual([os.path.exists(p) for p in paths], [True, False, False, True, True, True])
+
+    def test_sweeps_in_batches(self):
+        self.storage.batch_size = 2
+        for i in range(5):
+            self.write(f"doc-{i}", 10, user_id=1, age=50)
+        swept = [self.storage.sweep()["orphans"] for _ in range(3)]
+        self.assertEqual(swept, [2, 2, 1])
+
+    def test_uploads_over_quota_are_refused_and_swept_files_come_back(self):
+        chat = load_chat_app()
+        folder = tempfile.mkdtemp()
+        store = DocumentStore(os.path.join(folder, "documents.db"), folder)
+        storage = StorageManager(os.path.join(folder, "storage.db"), global_quota_bytes=1)
+        with mock.patch.object(chat, "document_store", store), \
+                mock.patch.object(chat, "storage", storage), \
+                mock.patch.object(chat, "extraction_jobs", mock.Mock()), \
+                mock.patch.dict(chat.app.config, {"UPLOAD_FOLDER": folder}):
+            client = chat.app.test_client()
+            client.post("/new_chat", json={"session_id": "quota"})
+            resp = client.post("/upload", data={"session_id": "quota", "file": (io.BytesIO(b"a" * 10), "a.txt")})
+            self.assertEqual(resp.status_code, 507)
+            self.assertEqual([name for name in os.listdir(folder) if name.startswith(".upload-")], [])
+
+            storage.global_quota_bytes = 0
+            resp = client.post("/upload", data={"session_id": "quota", "file": (io.BytesIO(b"a" * 10), "a.txt")})
+            self.assertEqual(resp.status_code, 202)
+            self.assertEqual(storage.usage()["bytes"], 10)
+            digest = chat.session_store.get("quota").document
+            store.put(digest, "text", [0])
+
+            # The file is swept while the chat still holds it; its text stays
+            # and the next upload of the same bytes restores the file
+            os.remove(store.blob_path(digest, ".txt"))
+            storage.sweep()
+            self.assertEqual(storage.usage()["files"], 0)
+            client.post("/new_chat", json={"session_id": "again"})
+            resp = client.post("/upload", data={"session_id": "again", "file": (io.BytesIO(b"a" * 10), "a.txt")})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(store.stats()["references"], 2)
+            self.assertEqual(store.get(digest)[0], "text")
+            self.assertEqual(storage.usage()["files"], 1)
+
+
+class NormalizeTests(unittest.TestCase):
+    def test_strips_running_headers_page_numbers_and_repeats(self):
+        repeated = "Each course is evaluated by continuous assessment and an end semester exam. " * 4
+        courses = ["Signals", "Circuits", "Networks", "Controls"]
+        pages = [
+            f"ECE Curriculum 2023\n\n{course}   covers\tthe real-\ntime  {course.lower()} trans-\nmission.\n\n\n"
+            f"{repeated}\n\n{course} credits\n{i % 2 + 2}\nPage {i + 1} of 4"
+            for i, course in enumerate(courses)
+        ]
+        cleaned, report = normalize_pages(pages + ["transmission"])
+        self.assertEqual(cleaned[0], f"Signals covers the real-time signals transmission.\n\n"
+                                     f"{repeated.strip()}\n\nSignals credits\n2")
+        # The repeated paragraph is kept once, the credit cell on every page
+        self.assertEqual(cleaned[1], "Circuits covers the real-time circuits transmission.\n\nCircuits credits\n3")
+        self.assertEqual(report["boilerplate_lines"], 4)
+        self.assertEqual(report["page_numbers"], 4)
+        self.assertEqual(report["hyphenations"], 8)
+        self.assertEqual(report["duplicate_paragraphs"], 3)
+        self.assertEqual(report["bytes_saved"], report["bytes_before"] - report["bytes_after"])
+        self.assertGreater(report["tokens_saved"], 0)
+
+    def test_list_bullets_and_lines_that_change_edge_are_kept(self):
+        # Every page starts with a bullet list; "Outcomes" starts two pages
+        # and ends two others
+        pages = [f"{'Outcomes' if i < 2 else '•'}\nunit {i} objective\nmore on unit {i}\n"
+                 f"unit {i} reading\nunit {i} credits\n{'Outcomes' if i in (2, 3) else f'unit {i} end'}"
+                 for i in range(6)]
+        cleaned, report = normalize_pages(pages)
+        self.assertEqual(cleaned, pages)
+        self.assertEqual(report["boilerplate_lines"], 0)
+
+    def test_short_documents_are_left_alone(self):
+        pages = ["Header\nfirst page", "Header\n2"]
+        self.assertEqual(normalize_pages(pages)[0], pages)
+
+
+class OverviewGemini(FakeGemini):
+    def reply_text(self, prompt):
+        if prompt.startswith("Read the document below"):
+            return ("**SUMMARY:** A signals course syllabus.\n"
+                    "OUTLINE:\n- Units\n- Grading\nKEY TERMS:\nFourier, 4 credits")
+        return f"Answer to: {prompt.rpartition('User question: ')[2]}"
+
+
+class OverviewTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = OverviewGemini(latency=0).start()
+        self.addCleanup(self.fake.stop)
+        self.chat = load_chat_app()
+        folder = tempfile.mkdtemp()
+        self.store = DocumentStore(os.path.join(folder, "documents.db"), folder)
+        self.overviews = Overviews(self.store, lambda prompt: self.chat.gemini.generate(prompt),
+                                   self.chat.starter_prompts)
+        for patcher in (
+            mock.patch.object(self.chat, "gemini", GeminiClient(self.fake.url, "test-key", max_retries=0)),
+            mock.patch.object(self.chat, "response_cache", ResponseCache()),
+            mock.patch.object(self.chat, "document_store", self.store),
+            mock.patch.object(self.chat, "overviews", self.overviews),
+            mock.patch.object(self.chat, "OVERVIEW_ENABLED", True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = self.chat.app.test_client()
+
+    def upload(self, session_id, text):
+        path = os.path.join(self.store.blob_dir, "upload.part")
+        with open(path, "w") as f:
+            f.write(text)
+        digest = fingerprint(text)
+        self.store.acquire(digest, path, ".txt")
+        self.client.post("/new_chat", json={"session_id": session_id})
+        self.chat.session_store.set_document(session_id, digest, "")
+        self.chat.upload_jobs[session_id] = "job"
+        self.chat.document_ready(session_id, "job", digest, text, [0])
+        self.overviews.join()
+        return digest
+
+    def test_parses_sections_and_keeps_unformatted_replies(self):
+        self.assertEqual(parse_overview("SUMMARY: A resume.\nOUTLINE:\n* Skills\nKEY TERMS: Python; SQL"),
+                         {"summary": "A resume.", "outline": ["Skills"], "key_terms": ["Python", "SQL"]})
+        self.assertEqual(parse_overview("Just prose."), {"summary": "Just prose.", "outline": [], "key_terms": []})
+
+    def test_starter_questions_are_answered_without_upstream_calls(self):
+        digest = self.upload("overview", "Signals and systems. " * 1000)
+        # The overview call and one per starter question
+        self.assertEqual(self.fake.requests, 1 + len(self.overviews.questions))
+        status = self.client.get("/document_overview/overview").get_json()
+        self.assertEqual((status["state"], status["summary"], status["outline"], status["key_terms"]),
+                         ("ready", "A signals course syllabus.", ["Units", "Grading"], ["Fourier", "4 credits"]))
+
+        self.fake.reset_stats()
+        resp = self.client.post("/chat", json={"session_id": "overview", "message": "what is this document about"})
+        self.assertEqual(resp.get_json()["response"], "Answer to: What is this document about?")
+        self.assertEqual(self.fake.requests, 0)
+
+        # Other questions see the overview next to the retrieved passages
+        self.assertIn("A signals course syllabus.", self.chat.build_prompt("overview", "Who teaches it?"))
+
+        # The same bytes again reuse it; the last release deletes it
+        self.overviews.request(digest, "Signals and systems. " * 1000)
+        self.overviews.join()
+        self.assertEqual(self.fake.requests, 0)
+        self.client.post("/delete_chat", json={"session_id": "overview"})
+        self.assertIsNone(self.store.get_overview(digest))
+        self.assertEqual(self.client.get("/document_overview/overview").status_code, 404)
+
+
+RESUME = """JANE DOE
+CONTACT
+9876543210
+jane.doe@example.com
+linkedin.com/in/janedoe
+DATE OF BIRTH : 01.02.1995
+Built a STM32 based cautery controller.
+"""
+
+CURRICULUM = """SEMESTER I
+Code
+Title
+L T P
+Credit
+23MAT122
+Calculus, Matrix Algebra and Ordinary
+Differential Equations
+3 1 0
+4
+23ENG101
+Technical Communication
+2 0 3
+3
+23ENG233
+Technical Communication
+2 0 0
+2
+
+23EEE201 SIGNALS & SYSTEMS
+L-T-P-C: 3-1-0-4
+Course Objectives
+"""
+
+POLICY = """Leave policy
+Employees accrue 1.5 days of paid leave per month. Unused leave lapses at the end of the year.
+Exit policy
+The notice period for resignation is 60 days.
+Reimbursements are processed within 14 working days of submission.
+"""
+
+
+class LocalAnswerTests(unittest.TestCase):
+    def setUp(self):
+        self.answerer = LocalAnswerer(threshold=0.8)
+
+    def test_contact_details_and_fields(self):
+        answer, confidence, kinds = self.answerer.answer("Which email address and phone number are listed?", RESUME)
+        self.assertEqual(answer, "Email: jane.doe@example.com\nPhone: 9876543210")
+        self.assertEqual(kinds, ["email", "phone"])
+        self.assertGreaterEqual(confidence, 0.8)
+        self.assertEqual(self.answerer.route("What is the LinkedIn profile?", RESUME), "Link: linkedin.com/in/janedoe")
+        self.assertEqual(self.answerer.route("What is the date of birth?", RESUME), "01.02.1995")
+        # Explanations and things the document does not hold go upstream
+        self.assertIsNone(self.answerer.route("Why is the email address important?", RESUME))
+        self.assertIsNone(self.answerer.route("What is the GitHub profile?", RESUME))
+        self.assertIsNone(self.answerer.route("What projects are listed?", RESUME))
+        # Keywords alone are not lookups, nor are questions about more than the fact
+        self.assertIsNone(self.answerer.route("Does the document mention email etiquette?", RESUME))
+        self.assertIsNone(self.answerer.route("Is a phone allowed in the exam?", RESUME))
+        self.assertIsNone(self.answerer.route("What email client does she use?", RESUME))
+
+    def test_course_credits_from_table_and_headings(self):
+        # Course facts are only read on request
+        self.assertIsNone(self.answerer.route("credits of 23ENG233", CURRICULUM))
+        self.answerer = LocalAnswerer(threshold=0.8, courses=True)
+        route = self.answerer.route
+        self.assertEqual(route("How many credits is Calculus, Matrix Algebra and Ordinary Differential Equations?",
+                               CURRICULUM),
+                         "23MAT122 Calculus, Matrix Algebra and Ordinary Differential Equations: "
+                         "4 credits (L-T-P 3-1-0).")
+        self.assertEqual(route("What is the credit count for signals and systems?", CURRICULUM),
+                         "23EEE201 SIGNALS & SYSTEMS: 4 credits (L-T-P 3-1-0).")
+        self.assertEqual(route("credits of 23ENG233", CURRICULUM),
+                         "23ENG233 Technical Communication: 2 credits (L-T-P 2-0-0).")
+        self.assertEqual(route("What is the course code for Signals and Systems?", CURRICULUM),
+                         "The course code of SIGNALS & SYSTEMS is 23EEE201.")
+        # Two courses share the title, and no course is named at all
+        self.assertIsNone(route("How many credits does Technical Communication carry?", CURRICULUM))
+        self.assertIsNone(route("What is the credit count for the course?", CURRICULUM))
+        self.assertEqual(self.answerer.stats()["local"], 4)
+        self.assertEqual(self.answerer.stats()["upstream"], 2)
+
+    def test_passages_of_any_document(self):
+        index = DocumentIndex(POLICY, chunk_chars=120, overlap_chars=0)
+        route = self.answerer.route
+        self.assertEqual(route("What is the notice period for resignation?", POLICY, index=index),
+                         "The notice period for resignation is 60 days.")
+        self.assertEqual(route("How many days of paid leave accrue per month?", POLICY, index=index),
+                         "Employees accrue 1.5 days of paid leave per month.")
+        # A word the document never uses, a heading alone, and an explanation
+        self.assertIsNone(route("What is the notice period for interns?", POLICY, index=index))
+        self.assertIsNone(route("What is the leave policy?", POLICY, index=index))
+        self.assertIsNone(route("Why is the notice period 60 days?", POLICY, index=index))
+        # Nor does a curriculum's credit question match a title without credits
+        self.assertIsNone(route("What is the credit count for signals and systems?", CURRICULUM,
+                                index=DocumentIndex(CURRICULUM)))
+
+    def test_lookups_skip_the_upstream_call(self):
+        fake = FakeGemini(latency=0).start()
+        self.addCleanup(fake.stop)
+        chat = load_chat_app()
+        for patcher in (
+            mock.patch.object(chat, "gemini", GeminiClient(fake.url, "test-key", max_retries=0)),
+            mock.patch.object(chat, "response_cache", ResponseCache()),
+            mock.patch.object(chat, "local_answerer", self.answerer),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        client = chat.app.test_client()
+        client.post("/new_chat", json={"session_id": "lookup"})
+        chat.session_store.set_document("lookup", "resume", RESUME)
+
+        resp = client.post("/chat", json={"session_id": "lookup", "message": "What email is on this resume?"})
+        self.assertEqual(resp.get_json()["response"], "Email: jane.doe@example.com")
+        self.assertEqual(fake.requests, 0)
+        resp = client.post("/chat", json={"session_id": "lookup", "message": "Summarize her experience."})
+        self.assertIn("canned answer", resp.get_json()["response"])
+        self.assertEqual(fake.requests, 1)
+
+
+class UploadJobTests(unittest.TestCase):
+    def setUp(self):
+        self.chat = load_chat_app()
+        self.jobs = self.chat.ExtractionJobs(workers=1)
+        self.addCleanup(self.jobs.shutdown)
+        folder = tempfile.mkdtemp()
+        self.store = DocumentStore(os.path.join(folder, "documents.db"), folder)
+        for patcher in (
+            mock.patch.object(self.chat, "extraction_jobs", self.jobs),
+            mock.patch.object(self.chat, "document_store", self.store),
+            mock.patch.dict(self.chat.app.config, {"UPLOAD_FOLDER": folder}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = self.chat.app.test_client()
+        self.client.post("/new_chat", json={"session_id": "upload"})
+
+    def upload(self, backend, session_id="upload", path=os.path.join("uploads", "resume.pdf")):
+        path = os.path.join(os.path.dirname(os.path.dirname(__file__)), path)
+        with open(path, "rb") as f:
+            resp = self.client.post("/upload", data={"session_id": session_id, "backend": backend or "",
+                                                     "file": (f, os.path.basename(path))})
+        if resp.status_code == 200:
+            return {"state": "done", "cached": True}
+        self.assertEqual(resp.status_code, 202)
+        job_id = resp.get_json()["job_id"]
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            status = self.client.get(f"/upload_status/{job_id}").get_json()
+            if status["state"] != "running":
+                return status
+            time.sleep(0.05)
+        self.fail("extraction did not finish")
+
+    def test_extracts_in_background_with_both_backends(self):
+        for backend in ("pymupdf", "pypdf2"):
+            self.client.post("/remove_document", json={"session_id": "upload"})
+            status = self.upload(backend)
+            self.assertEqual(status["state"], "done")
+            self.assertEqual(status["backend"], backend)
+            self.assertEqual(status["pages_done"], status["pages_total"])
+            self.assertGreaterEqual(status["normalization"]["bytes_saved"], 0)
+            session = self.chat.session_store.get("upload")
+            self.assertTrue(session.text)
+            self.assertIsNotNone(session.index)
+
+    def test_identical_uploads_share_storage_and_skip_extraction(self):
+        self.assertEqual(self.upload("pymupdf")["state"], "done")
+        self.client.post("/new_chat", json={"session_id": "other"})
+        self.assertTrue(self.upload("pymupdf", session_id="other").get("cached"))
+        self.assertEqual(self.chat.session_store.get("other").text, self.chat.session_store.get("upload").text)
+        self.assertEqual(self.store.stats()["documents"], 1)
+        self.assertEqual(self.store.stats()["references"], 2)
+
+        self.client.post("/remove_document", json={"session_id": "upload"})
+        self.assertEqual(self.store.stats()["references"], 1)
+        self.client.post("/delete_chat", json={"session_id": "other"})
+        self.assertEqual(self.store.stats()["documents"], 0)
+        self.assertEqual([f for f in os.listdir(self.store.blob_dir) if f.endswith(".pdf")], [])
+
+    def test_streams_batches_in_page_order_with_few_in_flight(self):
+        from chatbot.extraction import EXTRACTORS, join_pages
+        path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads",
+                            "amrita-btech-electrical-and-computer-engineering-curriculum-syllabus-2023.pdf")
+        jobs = self.chat.ExtractionJobs(workers=1, batch_pages=16, normalize=False)
+        self.addCleanup(jobs.shutdown)
+        pieces, submitted, done = [], [], threading.Event()
+
+        def on_text(piece):
+            pieces.append(piece)
+            submitted.append(jobs.jobs[job_id].submitted)
+
+        def on_done(text, page_offsets):
+            self.assertIsNone(text)
+            pieces.append(page_offsets)
+            done.set()
+
+        job_id = jobs.submit(path, "pymupdf", on_done=on_done, on_text=on_text, on_error=lambda e: done.set())
+        self.assertTrue(done.wait(60))
+        self.assertEqual(jobs.status(job_id)["state"], "done")
+        text, page_offsets = join_pages(list(EXTRACTORS["pymupdf"].iter_pages(path)))
+        *pieces, offsets = pieces
+        self.assertEqual(("".join(pieces), offsets), (text, page_offsets))
+        # One piece per batch, each sent before the whole document was asked for
+        self.assertEqual(len(pieces), 16)
+        self.assertLessEqual(submitted[0], 3)
+
+    def test_streamed_text_is_joined_in_the_document_store(self):
+        self.assertEqual(self.upload("pymupdf")["state"], "done")
+        session = self.chat.session_store.get("upload")
+        self.assertEqual(self.store.get(session.document)[0], session.text)
+        self.assertEqual(self.store._conn.execute('SELECT COUNT(*) FROM document_parts').fetchone()[0], 0)
+
+    def test_extracts_docx_by_section(self):
+        status = self.upload(None, path=os.path.join("media", "uploads", "physical_layer.docx"))
+        self.assertEqual(status["state"], "done")
+        self.assertEqual(status["backend"], "docx")
+        self.assertGreater(status["pages_total"], 1)
+        self.assertEqual(status["pages_done"], status["pages_total"])
+        text = self.chat.session_store.get("upload").text
+        self.assertTrue(text.startswith("Understanding the Physical Layer"))
+
+    def test_failed_extraction_releases_the_document(self):
+        resp = self.client.post("/upload", data={"session_id": "upload",
+                                                 "file": (io.BytesIO(b"not a zip archive"), "broken.docx")})
+        self.assertEqual(resp.status_code, 202)
+        job_id = resp.get_json()["job_id"]
+        deadline = time.monotonic() + 30
+        while "upload" in self.chat.upload_jobs and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.jobs.status(job_id)["state"], "failed")
+        self.assertNotIn("upload", self.chat.upload_jobs)
+        self.assertIsNone(self.chat.session_store.get("upload").document)
+        self.assertEqual(self.store.stats()["references"], 0)
+
+    def test_documents_are_finished_off_the_pool_result_thread(self):
+        threads = []
+        document_ready = self.chat.document_ready
+
+        def record_thread(*args):
+            threads.append(threading.current_thread().name)
+            document_ready(*args)
+
+        with mock.patch.object(self.chat, "document_ready", record_thread):
+            self.assertEqual(self.upload("pymupdf")["state"], "done")
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith("extraction-finish"))
+
+    def test_text_sections_split_on_headings_and_size(self):
+        from chatbot.extraction import EXTRACTORS, SECTION_CHARS, choose_extractor
+        path = os.path.join(self.store.blob_dir, "notes.md")
+        with open(path, "w") as f:
+            f.write("intro\n# One\nfirst\n## Two\nsecond\f\nthird\n")
+            f.write(("x" * 99 + "\n") * (SECTION_CHARS // 50))
+        extractor = choose_extractor("notes.md")
+        self.assertIs(extractor, EXTRACTORS["text"])
+        sections = list(extractor.iter_pages(path))
+        self.assertEqual(sections[:3], ["intro", "# One\nfirst", "## Two\nsecond"])
+        self.assertTrue(sections[3].startswith("third\n"))
+        self.assertGreater(len(sections), 4)
+        self.assertTrue(all(len(s) <= SECTION_CHARS + 100 for s in sections))
+        self.assertEqual(list(extractor.iter_pages(path, 1, 3)), sections[1:3])
+
+    def test_rejects_unsupported_type_and_mismatched_backend(self):
+        for name, backend in (("x.exe", ""), ("x.docx", "pypdf2")):
+            resp = self.client.post("/upload", data={"session_id": "upload", "backend": backend,
+                                                     "file": (io.BytesIO(b"data"), name)})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_rejects_unknown_backend(self):
+        with open(__file__, "rb") as f:
+            resp = self.client.post("/upload", data={"session_id": "upload", "backend": "ocr",
+                                                     "file": (f, "x.pdf")})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual([f for f in os.listdir(self.store.blob_dir) if f.endswith(".part")], [])
+
+    def test_rejected_uploads_leave_no_part_file(self):
+        for session_id, name in (("", "a.txt"), ("upload", "a.exe"), ("nope", "a.txt")):
+            data = {"session_id": session_id, "file": (io.BytesIO(b"data"), name)}
+            # Inside the request, before Flask's own teardown closes the files
+            with self.chat.app.test_request_context("/upload", method="POST", data=data):
+                resp = self.chat.app.make_response(self.chat.upload_file())
+                self.assertEqual(resp.status_code, 400)
+                self.assertEqual([f for f in os.listdir(self.store.blob_dir) if f.endswith(".part")], [])
+
+    def test_rejects_oversized_upload(self):
+        with mock.patch.dict(self.chat.app.config, {"UPLOAD_MAX_BYTES": 1024}):
+            resp = self.client.post("/upload", data={"session_id": "upload",
+                                                     "file": (io.BytesIO(b"%PDF" + b"0" * 4096), "big.pdf")})
+        self.assertEqual(resp.status_code, 413)
+        self.assertFalse(resp.get_json()["success"])
+        self.assertEqual([f for f in os.listdir(self.store.blob_dir) if f.endswith(".part")], [])
+
+    def test_unknown_job(self):
+        self.assertEqual(self.client.get("/upload_status/nope").status_code, 404)
+
+
+async def call_asgi(app, method, path, body=None, query=b""):
+    """Run one request through an ASGI app, return (status, body bytes)."""
+    scope = {"type": "http", "method": method, "path": path, "headers": [], "query_string": query}
+    messages = [{"type": "http.request", "body": json.dumps(body).encode() if body else b""}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:])
+
+
+class AsgiChatTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGemini(latency=0.2).start()
+        self.addCleanup(self.fake.stop)
+        self.chat = load_chat_app()
+        from chatbot import asgi
+        self.asgi = asgi
+        for patcher in (
+            mock.patch.object(asgi, "gemini", AsyncGeminiClient(self.fake.url, "test-key", max_retries=0)),
+            mock.patch.object(self.chat, "response_cache", ResponseCache(max_entries=0)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.chat.session_store.create("asgi")
+
+    def test_concurrent_chats_share_one_worker(self):
+        async def run():
+            try:
+                return await asyncio.gather(*(
+                    call_asgi(self.asgi.application, "POST", "/chat", {"session_id": "asgi", "message": f"q{i}"})
+                    for i in range(50)))
+            finally:
+                await self.asgi.gemini.aclose()
+
+        start = time.monotonic()
+        results = asyncio.run(run())
+        # 50 calls of 0.2s each overlap instead of running back to back
+        self.assertLess(time.monotonic() - start, 2.0)
+        for status, body in results:
+            self.assertEqual(status, 200)
+            self.assertTrue(json.loads(body)["success"])
+
+        status, body = asyncio.run(call_asgi(self.asgi.application, "GET", "/get_history/asgi"))
+        self.assertEqual(len(json.loads(body)), 100)
+        status, body = asyncio.run(call_asgi(self.asgi.application, "GET", "/get_history/asgi", query=b"limit=10"))
+        self.assertEqual(len(json.loads(body)), 10)
+
+    def test_database_work_stays_off_the_event_loop(self):
+        on_loop = []
+        save_to_db = self.chat.save_to_db
+
+        def record_loop():
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+
+        def record(*args):
+            record_loop()
+            save_to_db(*args)
+
+        async def run():
+            try:
+                for path in ("/chat", "/chat_stream"):
+                    status, _ = await call_asgi(self.asgi.application, "POST", path,
+                                                {"session_id": "asgi", "message": path})
+                    self.assertEqual(status, 200)
+            finally:
+                await self.asgi.gemini.aclose()
+
+        def record_cache(*args):
+            record_loop()
+            cache_set(*args)
+
+        cache_set = self.chat.response_cache.set
+        with mock.patch.object(self.chat, "save_to_db", record), \
+                mock.patch.object(self.chat.response_cache, "set", record_cache):
+            asyncio.run(run())
+        # The question and the reply of both chats, and both replies cached
+        self.assertEqual(on_loop, [False] * 6)
+
+    def test_async_views_are_instrumented(self):
+        errors = metrics.UPSTREAM_ERRORS.value(kind="error")
+        circuit_open = metrics.UPSTREAM_ERRORS.value(kind="circuit_open")
+        gemini_spans = metrics.STAGE_SECONDS.samples(("chat", "gemini"))[0]
+        requests = metrics.REQUEST_SECONDS.samples(("chat", "200"))[0]
+
+        self.chat.session_store.create("asgi-metrics")
+
+        async def run():
+            try:
+                await call_asgi(self.asgi.application, "POST", "/chat",
+                                {"session_id": "asgi-metrics", "message": "ok", "no_cache": True})
+                self.fake.fail_next(400)
+                await call_asgi(self.asgi.application, "POST", "/chat_stream",
+                                {"session_id": "asgi-metrics", "message": "bad", "no_cache": True})
+                with mock.patch.object(self.asgi.gemini.breaker, "allow", return_value=False):
+                    status, _ = await call_asgi(self.asgi.application, "POST", "/chat",
+                                                {"session_id": "asgi-metrics", "message": "open", "no_cache": True})
+                    self.assertEqual(status, 503)
+            finally:
+                await self.asgi.gemini.aclose()
+
+        asyncio.run(run())
+        self.assertEqual(metrics.UPSTREAM_ERRORS.value(kind="error"), errors + 1)
+        self.assertEqual(metrics.UPSTREAM_ERRORS.value(kind="circuit_open"), circuit_open + 1)
+        self.assertEqual(metrics.STAGE_SECONDS.samples(("chat", "gemini"))[0], gemini_spans + 2)
+        self.assertEqual(metrics.REQUEST_SECONDS.samples(("chat", "200"))[0], requests + 1)
+        self.assertGreater(metrics.STAGE_SECONDS.samples(("chat_stream", "build_prompt"))[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
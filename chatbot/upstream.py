@@ -0,0 +1,357 @@
+"""Pooled, resilient HTTP client for the Gemini API.
+
+One requests.Session is shared by every chat so TCP+TLS connections are
+kept alive and reused.  Every call has connect and read timeouts, 429/5xx
+responses are retried with jittered exponential backoff, and a circuit
+breaker fails fast while the upstream is unhealthy instead of tying up
+workers on calls that are going to fail anyway.
+
+GeminiClient blocks the calling thread; AsyncGeminiClient offers the same
+behaviour to asyncio code.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from chatbot import metrics
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    """The Gemini API could not produce an answer."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures.
+
+    While open every call is rejected.  After reset_timeout seconds one
+    trial call is let through (half-open); its outcome closes the circuit
+    again or re-opens it for another reset_timeout.  A trial that ends
+    any other way counts as a failure (abort_trial).
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self._trial_running = False
+
+    def abort_trial(self):
+        """End a trial call that stopped without an outcome (an unexpected
+        error, a cancelled coroutine) as a failure, so the next one can run."""
+        with self._lock:
+            if self._trial_running:
+                self._trial_running = False
+                self.failures += 1
+                self.opened_at = self.clock()
+
+
+class BaseGeminiClient:
+    """Configuration, backoff and response classification shared by the
+    blocking and asyncio clients."""
+
+    def __init__(self, base_url, api_key, model="gemini-2.0-flash",
+                 connect_timeout=3.05, read_timeout=60.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0,
+                 pool_size=32, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+
+    def url(self, method):
+        return f"{self.base_url}/v1beta/models/{self.model}:{method}"
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to sleep before retry number attempt (0-based), full jitter."""
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _start_attempt(self):
+        if not self.breaker.allow():
+            raise CircuitOpenError("Gemini API circuit breaker is open")
+
+    def _connection_failed(self, e):
+        self.breaker.record_failure()
+        return UpstreamError(f"Connection to Gemini API failed: {e}")
+
+    def _timed_out(self, e):
+        # A read timeout means the call may still be running upstream,
+        # so it is not retried
+        self.breaker.record_failure()
+        return UpstreamError(f"Gemini API timed out: {e}")
+
+    def _check_status(self, status, headers, text):
+        """Return None for success or the retryable error and its Retry-After.
+
+        text is a callable so the body is only read for rejected requests.
+        """
+        if status < 400:
+            self.breaker.record_success()
+            return None
+        if status not in RETRY_STATUSES:
+            # The upstream is healthy, it just rejected this request
+            self.breaker.record_success()
+            raise UpstreamError(f"Gemini API returned {status}: {text()[:200]}", status=status)
+        self.breaker.record_failure()
+        error = UpstreamError(f"Gemini API returned {status}", status=status)
+        return error, parse_retry_after(headers.get("Retry-After"))
+
+    def _params(self, params):
+        return {"key": self.api_key, **(params or {})}
+
+
+class GeminiClient(BaseGeminiClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Content-Type"] = "application/json"
+
+    def post(self, method, payload, params=None, **kwargs):
+        """POST payload to a model method, retrying transient failures.
+
+        Returns the successful requests.Response.  Raises CircuitOpenError
+        when the breaker is open and UpstreamError when retries run out or
+        the request is rejected.
+        """
+        attempt = 0
+        while True:
+            self._start_attempt()
+            try:
+                try:
+                    response = self.session.post(
+                        self.url(method), params=self._params(params), json=payload,
+                        timeout=self.timeout, **kwargs)
+                except requests.ConnectionError as e:
+                    error, retry_after = self._connection_failed(e), None
+                except requests.Timeout as e:
+                    raise self._timed_out(e)
+                else:
+                    failed = self._check_status(response.status_code, response.headers, lambda: response.text)
+                    if failed is None:
+                        return response
+                    error, retry_after = failed
+                    response.close()
+            except BaseException:
+                self.breaker.abort_trial()
+                raise
+
+            if attempt >= self.max_retries:
+                raise error
+            metrics.UPSTREAM_RETRIES.inc()
+            time.sleep(self.backoff(attempt, retry_after))
+            attempt += 1
+
+    def generate_content(self, payload):
+        return self.post("generateContent", payload).json()
+
+    def generate(self, prompt):
+        """Send a single-turn prompt and return the model's text."""
+        with metrics.span("upstream_request"):
+            response = self.post("generateContent", prompt_payload(prompt))
+        with metrics.span("upstream_parse"):
+            return response_text(response.json())
+
+    def stream(self, prompt):
+        """Start a streamed generation and return an iterator of text pieces.
+
+        The request is made (and retried) before this returns, so upstream
+        errors surface here rather than halfway through the stream.
+        """
+        response = self.post("streamGenerateContent", prompt_payload(prompt),
+                             params={"alt": "sse"}, stream=True)
+        return iter_sse_text(response)
+
+
+class AsyncGeminiClient(BaseGeminiClient):
+    """The same client for asyncio code, built on an aiohttp.ClientSession.
+
+    Waiting on the upstream only parks a coroutine, so one worker can have
+    as many calls in flight as the connection pool allows.  The session is
+    created on first use so it binds to the server's event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    total=None, connect=self.connect_timeout, sock_read=self.read_timeout),
+            )
+        return self._session
+
+    async def post(self, method, payload, params=None):
+        """Async version of GeminiClient.post, returning an aiohttp response.
+
+        The caller must release() the response once it has read it.
+        """
+        attempt = 0
+        while True:
+            self._start_attempt()
+            try:
+                try:
+                    response = await self.session.post(self.url(method), params=self._params(params), json=payload)
+                except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+                    error, retry_after = self._connection_failed(e), None
+                except asyncio.TimeoutError as e:
+                    raise self._timed_out(e)
+                except aiohttp.ClientError as e:
+                    error, retry_after = self._connection_failed(e), None
+                else:
+                    body = await response.text() if response.status >= 400 else ""
+                    failed = self._check_status(response.status, response.headers, lambda: body)
+                    if failed is None:
+                        return response
+                    error, retry_after = failed
+                    response.release()
+            except BaseException:
+                # Including a cancelled request: the trial must not stay running
+                self.breaker.abort_trial()
+                raise
+
+            if attempt >= self.max_retries:
+                raise error
+            metrics.UPSTREAM_RETRIES.inc()
+            await asyncio.sleep(self.backoff(attempt, retry_after))
+            attempt += 1
+
+    async def generate(self, prompt):
+        response = await self.post("generateContent", prompt_payload(prompt))
+        try:
+            data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise UpstreamError(f"Error reading Gemini API response: {e}")
+        finally:
+            response.release()
+        return response_text(data)
+
+    async def stream(self, prompt):
+        response = await self.post("streamGenerateContent", prompt_payload(prompt), params={"alt": "sse"})
+        return aiter_sse_text(response)
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def prompt_payload(prompt):
+    return {"contents": [{"parts": [{"text": prompt}]}]}
+
+
+def sse_text(line):
+    """Text carried by one SSE line, or None for other lines and events."""
+    if not line or not line.startswith("data:"):
+        return None
+    data = json.loads(line[5:])
+    try:
+        return "".join(part.get("text", "") for part in data['candidates'][0]['content']['parts'])
+    except (KeyError, IndexError, TypeError):
+        # Trailing events may only carry usage metadata
+        return None
+
+
+def iter_sse_text(response):
+    """Yield the text of each server-sent event in a streamed response."""
+    # text/event-stream is always UTF-8, whatever requests guesses
+    response.encoding = "utf-8"
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            text = sse_text(line)
+            if text is not None:
+                yield text
+    except requests.RequestException as e:
+        raise UpstreamError(f"Gemini API stream was interrupted: {e}")
+    finally:
+        response.close()
+
+
+async def aiter_sse_text(response):
+    try:
+        async for line in response.content:
+            text = sse_text(line.decode("utf-8").strip())
+            if text is not None:
+                yield text
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise UpstreamError(f"Gemini API stream was interrupted: {e}")
+    finally:
+        response.release()
+
+
+def response_text(data):
+    try:
+        return data['candidates'][0]['content']['parts'][0]['text']
+    except (KeyError, IndexError, TypeError):
+        raise UpstreamError("Unexpected response from Gemini API")
+
+
+def parse_retry_after(value):
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,24 @@
+from django.urls import path
+from . import views
+
+# Same endpoints as the Flask app (chatbot/chat.py), for logged-in users
+app_name = 'chatbot'
+
+urlpatterns = [
+    path('new_chat/', views.new_chat, name='new_chat'),
+    path('chat/', views.chat_view, name='chat'),
+    path('chat_stream/', views.chat_stream, name='chat_stream'),
+    path('upload/', views.upload, name='upload'),
+    path('upload_status/<str:job_id>/', views.upload_status, name='upload_status'),
+    path('history/', views.chat_sessions, name='chat_sessions'),
+    path('history_export/', views.history_export, name='history_export'),
+    path('history/<str:session_id>/', views.chat_history, name='chat_history'),
+    path('document_overview/<str:session_id>/', views.document_overview, name='document_overview'),
+    path('remove_document/', views.remove_document, name='remove_document'),
+    path('delete_chat/', views.delete_chat, name='delete_chat'),
+    path('corpus/', views.corpus_documents, name='corpus'),
+    path('corpus/search/', views.corpus_search, name='corpus_search'),
+    path('corpus/remove/', views.corpus_remove, name='corpus_remove'),
+    path('health/', views.health, name='health'),
+    path('metrics/', views.metrics_view, name='metrics'),
+]
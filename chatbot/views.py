@@ -0,0 +1,468 @@
+"""The chat API as Django views, for users logged in to the Django site.
+
+These serve the same endpoints as the Flask app in chatbot.chat, in the
+Django process itself, so the browser talks to one server and a request
+goes straight from the view to Gemini.  The upstream client, answer cache,
+session and document stores, extraction pool and history writer are the
+ones chatbot.chat creates; using it here shares them rather than building
+a second set.  It is imported on the first request (chatbot.service), so
+manage.py commands do not open its databases or start its threads.
+
+Chats belong to the logged-in user: the session store key is prefixed
+with the user's id, and history rows carry the user, so one user cannot
+read or continue another's chat by guessing its id.  Every document a
+user uploads is also added to their corpus index (chatbot.corpus), and
+questions draw on it as well as on the chat's own document.
+"""
+import functools
+import json
+import time
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.db import connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import condition, require_GET, require_POST
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+
+from chatbot import metrics
+from chatbot.docstore import HashedUpload
+from chatbot.extraction import choose_extractor, new_job_id
+from chatbot.history import export_filters, history_etag, history_query, iter_jsonl_gz
+from chatbot.service import chat
+from chatbot.storage import QuotaExceeded
+from chatbot.upstream import CircuitOpenError
+
+
+def session_key(request, session_id):
+    return f"user-{request.user.pk}:{session_id}"
+
+
+def api_view(view):
+    """JSON 401 instead of a login redirect, plus request timing."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({"success": False, "error": "Login required"}, status=401)
+        route = view.__name__
+        metrics.begin_request(route)
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = view(request, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, status=status)
+            metrics.end_request()
+    return wrapper
+
+
+def user_corpus(request):
+    """The user's index over all their uploads, or None if it is off."""
+    return chat.corpus_indexes.get(request.user.pk) if chat.CORPUS_ENABLED else None
+
+
+def index_document(user_id, digest, name, text):
+    # Runs after extraction; a failure here must not fail the upload
+    try:
+        chat.corpus_indexes.get(user_id).add(digest, name, text)
+    except Exception as e:
+        print("Error indexing document:", str(e))
+
+
+def read_json(request):
+    try:
+        return json.loads(request.body or b"{}")
+    except ValueError:
+        return {}
+
+
+def save_to_db(request, session_id, role, message):
+    chat.history_store.add(session_id, role, message, user_id=request.user.pk)
+
+
+def record_reply(request, session_id, model_text):
+    key = session_key(request, session_id)
+    chat.session_store.append_message(key, "model", model_text)
+    save_to_db(request, session_id, "model", model_text)
+    chat.summarizer.request(key)
+
+
+@require_POST
+@api_view
+def new_chat(request):
+    key = session_key(request, read_json(request).get("session_id"))
+    chat.clear_document(key)
+    chat.session_store.create(key)
+    return JsonResponse({"success": True})
+
+
+def start_turn(request, data):
+    """Record the user's message; return (key, cache key, cached answer or None).
+
+    None for an unknown session.
+    """
+    session_id = data.get("session_id")
+    user_message = data.get("message")
+    key = session_key(request, session_id)
+    with metrics.span("append_message"):
+        if not chat.session_store.append_message(key, "user", user_message):
+            return None
+    with metrics.span("save_to_db"):
+        save_to_db(request, session_id, "user", user_message)
+    chat.touch_document(key)
+    with metrics.span("cache_lookup"):
+        cache_key = chat.answer_cache_key(key, user_message, user_corpus(request))
+        cached = None if data.get("no_cache") else chat.ready_answer(key, user_message, cache_key)
+    return key, cache_key, cached
+
+
+@require_POST
+@api_view
+def chat_view(request):
+    with metrics.span("parse_request"):
+        data = read_json(request)
+    turn = start_turn(request, data)
+    if turn is None:
+        return JsonResponse({"success": False, "error": "Invalid session ID"}, status=400)
+    key, cache_key, model_text = turn
+    user_message = data.get("message")
+
+    if model_text is None:
+        with metrics.span("build_prompt"):
+            prompt = chat.build_prompt(key, user_message, user_corpus(request))
+        try:
+            with metrics.span("gemini"):
+                model_text = chat.inflight.do(chat.answer_cache_key(key, prompt),
+                                              lambda: chat.gemini.generate(prompt))
+        except CircuitOpenError:
+            metrics.UPSTREAM_ERRORS.inc(kind="circuit_open")
+            return JsonResponse({"success": False, "error": "Gemini API is temporarily unavailable."}, status=503)
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(kind="error")
+            print("Error connecting to Gemini API:", str(e))
+            return JsonResponse({"success": False, "error": "Error connecting to Gemini API."})
+        chat.response_cache.set(cache_key, model_text)
+
+    with metrics.span("record_reply"):
+        record_reply(request, data.get("session_id"), model_text)
+    return JsonResponse({"success": True, "response": model_text})
+
+
+@require_POST
+@api_view
+def chat_stream(request):
+    data = read_json(request)
+    turn = start_turn(request, data)
+    if turn is None:
+        return JsonResponse({"success": False, "error": "Invalid session ID"}, status=400)
+    key, cache_key, cached = turn
+
+    if cached is not None:
+        pieces = iter([cached])
+    else:
+        try:
+            pieces = chat.gemini.stream(chat.build_prompt(key, data.get("message"), user_corpus(request)))
+        except CircuitOpenError:
+            metrics.UPSTREAM_ERRORS.inc(kind="circuit_open")
+            return JsonResponse({"success": False, "error": "Gemini API is temporarily unavailable."}, status=503)
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(kind="error")
+            print("Error connecting to Gemini API:", str(e))
+            return JsonResponse({"success": False, "error": "Error connecting to Gemini API."})
+
+    def generate():
+        parts = []
+        try:
+            for text in pieces:
+                parts.append(text)
+                yield chat.sse_event({"text": text})
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(kind="stream")
+            print("Error streaming from Gemini API:", str(e))
+            yield chat.sse_event({"error": "Error connecting to Gemini API."}, event="error")
+            return
+
+        model_text = "".join(parts)
+        if cached is None:
+            chat.response_cache.set(cache_key, model_text)
+        record_reply(request, data.get("session_id"), model_text)
+        yield chat.sse_event({"done": True}, event="done")
+
+    response = StreamingHttpResponse(generate(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+class HashedUploadHandler(FileUploadHandler):
+    """Writes file parts straight into a HashedUpload, as the Flask app does.
+
+    Going over the size limit stops reading the upload and sets too_large.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.too_large = False
+        self.upload = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.upload = HashedUpload(chat.app.config['UPLOAD_FOLDER'], chat.app.config['UPLOAD_MAX_BYTES'])
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            self.upload.write(raw_data)
+        except RequestEntityTooLarge:
+            # HashedUpload has already deleted the partial file
+            self.too_large = True
+            raise StopUpload(connection_reset=False)
+        return None
+
+    def file_complete(self, file_size):
+        self.upload.seek(0)
+        return UploadedFile(self.upload, self.file_name, self.content_type, file_size, self.charset,
+                            self.content_type_extra)
+
+    def upload_interrupted(self):
+        if self.upload is not None:
+            self.upload.close()
+
+
+# The upload handler has to be in place before the CSRF check reads the
+# form, so CSRF is checked inside, as Django's docs recommend
+@csrf_exempt
+@require_POST
+@api_view
+def upload(request):
+    handler = HashedUploadHandler(request)
+    request.upload_handlers = [handler]
+    try:
+        return _upload(request, handler)
+    finally:
+        # Closing an upload that was turned away deletes its .part file
+        # now; one that was stored has been kept and is only closed
+        request.close()
+
+
+@csrf_protect
+def _upload(request, handler):
+    with metrics.span("receive"):
+        session_id = request.POST.get("session_id")
+        file = request.FILES.get("file")
+    if handler.too_large:
+        limit_mb = chat.app.config['UPLOAD_MAX_BYTES'] / (1024 * 1024)
+        return JsonResponse({"success": False, "error": f"File is too large (limit {limit_mb:g} MB)"}, status=413)
+    if file is None or not session_id:
+        return JsonResponse({"success": False, "error": "Missing file or session_id"}, status=400)
+
+    filename = secure_filename(file.name)
+    try:
+        extractor = choose_extractor(filename, file.content_type, request.POST.get("backend"),
+                                     chat.EXTRACT_BACKEND)
+    except ValueError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+
+    key = session_key(request, session_id)
+    if key not in chat.session_store:
+        return JsonResponse({"success": False, "error": "Invalid session ID"}, status=400)
+
+    with metrics.span("store"):
+        try:
+            digest, filepath = chat.store_upload(file.file, filename, key, request.user.pk)
+        except QuotaExceeded as e:
+            return JsonResponse({"success": False, "error": str(e)}, status=507)
+    with metrics.span("set_document"):
+        chat.clear_document(key)
+        stored = chat.document_store.get(digest)
+        chat.session_store.set_document(key, digest, stored[0] if stored else "")
+
+    user_id = request.user.pk
+    if stored is not None:
+        chat.prepare_overview(digest, stored[0])
+        if chat.CORPUS_ENABLED:
+            index_document(user_id, digest, filename, stored[0])
+        return JsonResponse({"success": True, "message": "File uploaded and processed"})
+
+    job_id = new_job_id()
+    chat.upload_jobs[key] = job_id
+    started = time.perf_counter()
+
+    def extracted(text, page_offsets):
+        metrics.EXTRACTION_SECONDS.observe(time.perf_counter() - started, backend=extractor.name)
+        text = chat.document_ready(key, job_id, digest, text, page_offsets)
+        if chat.CORPUS_ENABLED:
+            index_document(user_id, digest, filename, text)
+
+    try:
+        with metrics.span("submit"):
+            chat.extraction_jobs.submit(filepath, extractor.name, job_id=job_id, on_done=extracted,
+                                        on_text=lambda piece: chat.document_store.append_text(digest, job_id, piece),
+                                        on_error=lambda error: chat.extraction_failed(key, job_id, digest, error))
+    except Exception as e:
+        chat.clear_document(key)
+        return JsonResponse({"success": False, "error": f"Error reading document: {str(e)}"}, status=500)
+
+    return JsonResponse({"success": True, "job_id": job_id, "message": "File uploaded, processing started"},
+                        status=202)
+
+
+@require_GET
+@api_view
+def upload_status(request, job_id):
+    status = chat.extraction_jobs.status(job_id)
+    if status is None:
+        return JsonResponse({"success": False, "error": "Unknown job ID"}, status=404)
+    return JsonResponse({"success": True, **status})
+
+
+@require_GET
+@api_view
+def chat_sessions(request):
+    sessions = chat.history_store.sessions(request.user.pk)
+    return JsonResponse([{"session_id": session_id, "last_message": last} for session_id, last in sessions],
+                        safe=False)
+
+
+def chat_history_etag(request, session_id):
+    if not request.user.is_authenticated:
+        return None
+    try:
+        query = history_query(request.GET, chat.HISTORY_PAGE_MAX)
+    except ValueError:
+        return None
+    return history_etag(chat.history_store.version(session_id, request.user.pk), *query)
+
+
+@require_GET
+@api_view
+@condition(etag_func=chat_history_etag)
+def chat_history(request, session_id):
+    # ?since=<id> for newer messages, ?before=<id>&limit=<n> for older ones;
+    # no limit streams the whole history
+    try:
+        query = history_query(request.GET, chat.HISTORY_PAGE_MAX)
+    except ValueError:
+        return JsonResponse({"success": False, "error": "since, before and limit must be integers"}, status=400)
+    response = StreamingHttpResponse(chat.history_store.json_chunks(session_id, *query, user_id=request.user.pk),
+                                     content_type="application/json")
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+@require_GET
+@api_view
+def history_export(request):
+    """The user's history as gzipped JSON Lines.
+
+    Everything, or one ?session_id=, optionally limited to ?since= and
+    ?until= (ISO dates).  manage.py import_history loads it elsewhere.
+    """
+    try:
+        filters = export_filters(request.GET)
+    except ValueError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+    filters["user_id"] = request.user.pk
+    if request.GET.get("session_id"):
+        filters["session_id"] = request.GET["session_id"]
+    response = StreamingHttpResponse(iter_jsonl_gz(chat.history_store.export(**filters)),
+                                     content_type="application/gzip")
+    response["Content-Disposition"] = 'attachment; filename="chat-history.jsonl.gz"'
+    return response
+
+
+@require_GET
+@api_view
+def document_overview(request, session_id):
+    """Summary, outline and key terms of the chat's document, and the
+    starter questions answered without waiting."""
+    status = chat.overview_status(session_key(request, session_id))
+    if status is None:
+        return JsonResponse({"success": False, "error": "No document in this session"}, status=404)
+    return JsonResponse({"success": True, **status})
+
+
+@require_POST
+@api_view
+def remove_document(request):
+    key = session_key(request, read_json(request).get("session_id"))
+    if key not in chat.session_store:
+        return JsonResponse({"success": False, "error": "Session not found"}, status=400)
+    chat.clear_document(key)
+    return JsonResponse({"success": True, "message": "Document removed for session"})
+
+
+@require_POST
+@api_view
+def delete_chat(request):
+    key = session_key(request, read_json(request).get("session_id"))
+    chat.upload_jobs.pop(key, None)
+    digest = chat.session_store.delete(key)
+    if digest:
+        chat.document_store.release(digest)
+    return JsonResponse({"success": True})
+
+
+@require_GET
+@api_view
+def corpus_documents(request):
+    corpus = chat.corpus_indexes.get(request.user.pk)
+    return JsonResponse({
+        "success": True,
+        "documents": [{"document": document, "name": name, "chunks": chunks}
+                      for document, name, chunks in corpus.documents()],
+        "stats": corpus.stats(),
+    })
+
+
+@require_GET
+@api_view
+def corpus_search(request):
+    """Passages matching ?q= across all of the user's documents."""
+    question = request.GET.get("q", "")
+    if not question:
+        return JsonResponse({"success": False, "error": "Missing q"}, status=400)
+    started = time.perf_counter()
+    passages = chat.corpus_indexes.get(request.user.pk).passages(
+        question, chat.CORPUS_TOP_K, chat.CORPUS_BUDGET_CHARS)
+    return JsonResponse({
+        "success": True,
+        "passages": [{"name": name, "text": text} for name, text in passages],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    })
+
+
+@require_POST
+@api_view
+def corpus_remove(request):
+    """Stop using a document for answers; its chunks are tombstoned."""
+    document = read_json(request).get("document")
+    if not chat.corpus_indexes.remove(request.user.pk, document):
+        return JsonResponse({"success": False, "error": "Document not found"}, status=404)
+    return JsonResponse({"success": True})
+
+
+@require_GET
+def health(request):
+    """Liveness for load balancers: the database answers, and the breaker state."""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        database = "ok"
+    except Exception as e:
+        print("Health check failed:", str(e))
+        database = "unavailable"
+    status = 200 if database == "ok" else 503
+    return JsonResponse({"database": database, "upstream": chat.gemini.breaker.state}, status=status)
+
+
+@require_GET
+def metrics_view(request):
+    """Prometheus metrics, for staff users and settings.METRICS_ALLOWED_IPS."""
+    if not (request.user.is_staff or request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS):
+        return HttpResponse("Forbidden", status=403, content_type="text/plain")
+    return HttpResponse(metrics.registry.render(), content_type="text/plain; version=0.0.4")
@@ -24,6 +24,7 @@ from django.urls import path, include
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('techjays/', include('techjays.urls')),  # Adjust for your app
+    path('chatbot/', include('chatbot.urls')),    # Chat API for the chat page
     
     ] 
 if settings.DEBUG:
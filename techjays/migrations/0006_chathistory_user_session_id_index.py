@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-18 04:09
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('techjays', '0005_chathistory_user_session_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['user', 'session_id', 'id'], name='chathistory_user_session_id'),
+        ),
+    ]
@@ -10,11 +10,20 @@ class UploadedFile(models.Model):
         return f"{self.user.username} - {self.file.name}"
 
 class ChatHistory(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Messages written by the Flask chat service have no user
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     session_id = models.CharField(max_length=100)
     role = models.CharField(max_length=50)
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # History pages and exports seek and order by id within a session
+            models.Index(fields=['user', 'session_id', 'id'], name='chathistory_user_session_id'),
+            # The sessions list takes each session's latest timestamp
+            models.Index(fields=['user', 'session_id', 'timestamp'], name='chathistory_user_session_ts'),
+        ]
+
     def __str__(self):
         return f"{self.session_id} - {self.role} - {self.message[:30]}"
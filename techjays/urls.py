@@ -1,6 +1,7 @@
 from django.conf import settings
 from django.conf.urls.static import static
 from django.urls import path
+from chatbot import views as chatbot_views
 from . import views
 
 urlpatterns = [
@@ -9,6 +10,8 @@ urlpatterns = [
     path('login_view/', views.login_view, name='login'),         # Login page
     path('logout_view/', views.logout_view, name='logout'),      # Logout functionality
     path('chatbot/', views.chatbot_view, name='chatbot'),        # Chatbot main page
+    path('history/', chatbot_views.chat_sessions, name='chat_sessions'),  # The user's chats
+    path('history/<str:session_id>/', chatbot_views.chat_history, name='chat_history'),
    
     
 ]
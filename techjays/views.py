@@ -1,11 +1,30 @@
+import os
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.conf import settings
+from chatbot.service import chat, on_load
+from chatbot.storage import QuotaExceeded
 from .forms import RegisterForm, FileUploadForm
 from .models import UploadedFile, ChatHistory
 
+
+def uploaded_file_name(path):
+    return os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, "/")
+
+
+# Files under media/documents/ count against the user's storage quota and
+# are swept once their UploadedFile row is gone.  They are the user's own
+# list of documents, so they never expire or get evicted while listed.
+on_load(lambda chat: chat.storage.add_root(
+    os.path.join(settings.MEDIA_ROOT, "documents"),
+    referenced=lambda path: UploadedFile.objects.filter(file=uploaded_file_name(path)).exists(),
+    expires=False,
+))
+
 def welcome(request):
     return render(request, 'welcome.html')
 
@@ -43,6 +62,7 @@ def logout_view(request):
     return redirect('login')
 
 @login_required
+@ensure_csrf_cookie  # the page's API calls send it back in X-CSRFToken
 def chatbot_view(request):
     return render(request, 'chat.html')
 
@@ -51,11 +71,23 @@ def upload_file(request):
     if request.method == 'POST':
         form = FileUploadForm(request.POST, request.FILES)
         if form.is_valid():
+            try:
+                chat.storage.check_quota(request.user.pk, request.FILES['file'].size)
+            except QuotaExceeded as e:
+                messages.error(request, str(e))
+                return redirect('chatbot')
             uploaded_file = form.save(commit=False)
             uploaded_file.user = request.user
             uploaded_file.save()
+            chat.storage.track(uploaded_file.file.path, request.user.pk)
+            # Searchable from the chat once extracted, as chat uploads are
+            try:
+                chat.index_upload(request.user.pk, uploaded_file.file.path,
+                                  os.path.basename(uploaded_file.file.name))
+            except Exception as e:
+                print("Error indexing upload:", str(e))
             messages.success(request, 'File uploaded successfully.')
             return redirect('chatbot')  # or wherever your chat page is routed
     else:
         form = FileUploadForm()
-    return render(request, 'chat.html', {'form': form})
\ No newline at end of file
+    return render(request, 'chat.html', {'form': form})